@@ -1,263 +1,706 @@
-import os
-import google.generativeai as genai
-from typing import List, Dict
-import time
-
-class AIHandler:
-    def __init__(self, api_key: str, vertex_project_id: str = None, vertex_location: str = "global", instruction_path: str = None, instruction_text: str = None):
-        genai.configure(api_key=api_key)
-        
-        # User requested specific model "gemini-3-pro-preview"
-        # We try this first. If it fails (invalid), we might need a fallback, 
-        # but for now we trust the user's request.
-        self.model_name = "gemini-3-pro-preview" 
-
-        if instruction_text:
-            self.system_instruction = instruction_text
-        elif instruction_path:
-            with open(instruction_path, 'r', encoding='utf-8') as f:
-                self.system_instruction = f.read()
-        else:
-            raise ValueError("Either instruction_path or instruction_text must be provided.")
-
-        print(f"Initializing Gemini with model: {self.model_name}")
-        self.model = genai.GenerativeModel(
-            model_name=self.model_name,
-            system_instruction=self.system_instruction,
-            safety_settings=[
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-            ]
-        )
-
-    def generate_article_flow(self, main_kw: str, sub_kws: str, goal: str, slug: str, prompt_dict: Dict[str, str], progress_callback=None, step_callback=None) -> Dict[str, str]:
-        """
-        Executes the multi-step flow using Gemini only.
-        """
-        chat = self.model.start_chat(history=[])
-        full_log = "" 
-        
-        # 1. Prepare Initial Prompt
-        initial_prompt_template = prompt_dict.get("Initial", "")
-        
-        # Handle if Initial is a dict (from new Editor)
-        if isinstance(initial_prompt_template, dict):
-            # "Initial" usually doesn't have checks, just use exec
-            initial_prompt_template = initial_prompt_template.get("exec", "")
-
-        if not initial_prompt_template:
-            raise ValueError("No 'Initial' prompt found.")
-
-        try:
-            user_prompt = initial_prompt_template.format(
-                main_kw=main_kw, sub_kws=sub_kws, goal=goal, slug=slug
-            )
-        except KeyError as e:
-            print(f"Warning: Prompt format error {e}. Using raw prompt.")
-            user_prompt = initial_prompt_template
-        
-        print(f"--- [Gemini] STEP 1: Initializing for '{main_kw}' ---")
-        if progress_callback:
-            progress_callback("STEP 1: Planning (Gemini)")
-            
-        try:
-            response = self._send_message_with_retry(chat, user_prompt)
-            full_log += f"\n\n--- User ---\n{user_prompt}\n\n--- Gemini ---\n{response.text}"
-        except Exception as e:
-            print(f"Initial prompt failed: {e}")
-            return {"content": "", "image_prompts": "", "title": "", "description": ""}
-
-        # 2. Loop through Steps
-        step_keys = [k for k in prompt_dict.keys() if k.startswith("STEP")]
-        
-        for step in step_keys:
-            prompt_data = prompt_dict[step]
-            
-            # Helper to build prompt string from Dict or String
-            exec_text = ""
-            check_text = ""
-            
-            if isinstance(prompt_data, dict):
-                exec_text = prompt_data.get("exec", "")
-                check_text = prompt_data.get("check", "")
-            else:
-                # Legacy String Structure - Try to auto-split
-                val = prompt_data
-                if "**【自己チェック】**" in val:
-                    parts = val.split("**【自己チェック】**")
-                    exec_text = parts[0].replace("**【実行内容】**", "").strip()
-                    check_text = parts[1].strip()
-                else:
-                    exec_text = val
-                    check_text = ""
-
-            # Format prompt (slug/kw injection)
-            try:
-                # DEBUG LOGGING for Attribute Error investigation (Exec Text)
-                if isinstance(exec_text, dict):
-                    print(f"CRITICAL ERROR DETECTED at {step}: exec_text is a DICT!")
-                    print(f"Content: {exec_text}")
-                    exec_text = str(exec_text)
-
-                # DEBUG LOGGING for Attribute Error investigation (Check Text)
-                if isinstance(check_text, dict):
-                    print(f"CRITICAL ERROR DETECTED at {step}: check_text is a DICT!")
-                    print(f"Content: {check_text}")
-                    check_text = str(check_text)
-
-                formatted_exec = exec_text.format(slug=slug, main_kw=main_kw)
-                formatted_check = check_text.format(slug=slug, main_kw=main_kw) if check_text else ""
-            except Exception as e:
-                print(f"Format Error at {step}: {e}")
-                formatted_exec = exec_text
-                formatted_check = check_text
-
-            print(f"--- [Gemini] Proceeding to {step} ---")
-            
-            # PHASE 1: Execution (Draft)
-            if progress_callback:
-                progress_callback(f"{step} 実行中 (Draft)...")
-                
-            draft_prompt = f"""
-            次の {step} を実行してください。
-
-            {formatted_exec}
-            
-            出力をお願いします。
-            """
-            
-            try:
-                # 1. Draft
-                response = self._send_message_with_retry(chat, draft_prompt)
-                full_log += f"\n\n--- User ({step} - Draft) ---\n{draft_prompt}\n\n--- Gemini ---\n{response.text}"
-                final_response_text = response.text
-                
-                # Callback for Draft (Optional mapping: "STEP X (Draft)")
-                if step_callback:
-                     step_callback(f"{step} (Draft)", response.text)
-
-                # PHASE 2: Self-Check (Refine) - ONLY if check_text exists
-                if formatted_check.strip():
-                    if progress_callback:
-                        progress_callback(f"{step} 自己チェック中 (Refine)...")
-                    
-                    refine_prompt = f"""
-                    ありがとうございます。
-                    直前の出力結果に対して、以下の【自己チェック基準】を用いて厳密にチェックし、
-                    問題がある場合は修正した【最終結果】を出力してください。
-                    問題がない場合も、そのまま出力してください。
-                    
-                    **【自己チェック基準】**
-                    {formatted_check}
-                    
-                    出力は修正後のコンテンツのみをお願いします。
-                    """
-                    
-                    response = self._send_message_with_retry(chat, refine_prompt)
-                    full_log += f"\n\n--- User ({step} - Refine) ---\n{refine_prompt}\n\n--- Gemini ---\n{response.text}"
-                    final_response_text = response.text
-
-                # Callback with FINAL result
-                if step_callback:
-                    step_callback(step, final_response_text)
-
-            except Exception as e:
-                print(f"Error at {step}: {e}")
-                import traceback
-                traceback.print_exc()
-                break
-        
-        return self._parse_output(full_log)
-    
-    def _send_message_with_retry(self, chat, content, retries=10, delay=30):
-        from google.api_core import exceptions
-        for attempt in range(retries):
-            try:
-                return chat.send_message(content)
-            except exceptions.ResourceExhausted:
-                print(f"[Gemini] Rate limit. Wait {delay}s... (Attempt {attempt+1}/{retries})")
-                time.sleep(delay)
-            except Exception as e:
-                # If invalid model name, it might throw 404 or 400 here.
-                if "404" in str(e) or "not found" in str(e).lower():
-                    print(f"Error: Model {self.model_name} not found. Please check the model name.")
-                raise e
-        raise Exception("Gemini Max Retries")
-
-    def _parse_output(self, text: str) -> Dict[str, str]:
-        """
-        Parses the full conversation log.
-        """
-        import re
-        
-        # 1. Image Prompts
-        image_prompts = ""
-        if "---IMAGE_START---" in text and "---IMAGE_END---" in text:
-            pattern = re.compile(r"---IMAGE_START---(.*?)---IMAGE_END---", re.DOTALL)
-            match = pattern.search(text)
-            if match:
-                image_prompts = match.group(1).strip()
-        if "STEP 6" in text:
-            parts = text.split("STEP 6")
-            if len(parts) > 1:
-                raw_prompts = parts[-1].strip()
-                cleanup_markers = ["**【作業完了】**", "これ以上の工程は", "引き続きのご承認"]
-                for marker in cleanup_markers:
-                    if marker in raw_prompts:
-                        raw_prompts = raw_prompts.split(marker)[0]
-                image_prompts = raw_prompts.strip()
-        
-        # 2. Content (Step 5/7 - Largest HTML block)
-        html_matches = re.findall(r'```html(.*?)```', text, re.DOTALL)
-        if not html_matches:
-            # Fallback
-            html_matches = re.findall(r'```(.*?)```', text, re.DOTALL)
-            
-        content = ""
-        if html_matches:
-            content = max(html_matches, key=len).strip()
-            content = self._post_process_html(content)
-            
-        # 3. Parsing for Title/Desc
-        title = "タイトル取得失敗"
-        description = "ディスクリプション取得失敗"
-
-        title_match = re.search(r'---TITLE_START---(.*?)---TITLE_END---', text, re.DOTALL)
-        if title_match:
-            title = title_match.group(1).strip()
-
-        desc_match = re.search(r'---DESC_START---(.*?)---DESC_END---', text, re.DOTALL)
-        if desc_match:
-            description = desc_match.group(1).strip()
-            
-        return {
-            "title": title,
-            "description": description,
-            "content": content,
-            "image_prompts": image_prompts
-        }
-
-    def _post_process_html(self, html: str) -> str:
-        """Replaces custom tags, markdown artifacts, and unwanted classes."""
-        import re
-        
-        replacements = {
-            "<numlist>": '<div class="numlist">',
-            "</numlist>": '</div>',
-            "<normalBox>": '<div class="normalBox">',
-            "</normalBox>": '</div>',
-            "<flow>": '<div class="flow">',
-            "</flow>": '</div>',
-            "<qa-box01>": '<div class="qa-box01">',
-            "</qa-box01>": '</div>',
-        }
-        for old, new in replacements.items():
-            html = html.replace(old, new)
-            
-        html = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', html)
-        html = re.sub(r'<p class="[^"]*">', r'<p>', html)
-        html = re.sub(r'(<img\s+[^>]*>)', r'<div class="img-100">\1</div>', html)
-        
-        return html
+import google.generativeai as genai
+from typing import List, Dict
+import time
+import json
+import hashlib
+import threading
+import traceback
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from rate_limiter import get_gemini_limiter
+from chat_history import ChatHistoryManager
+from prompt_plan import compile_prompts, critical_path_length
+from events import LOG, STEP_STARTED, STEP_FINISHED, RETRY, run_log
+from metrics import METRICS, in_context
+
+# User requested specific model "gemini-3-pro-preview"
+# We try this first. If it fails (invalid), we might need a fallback, 
+# but for now we trust the user's request.
+MODEL_NAME = "gemini-3-pro-preview"
+
+# Upper bound on steps of one row running at the same time (independent branches of the step graph)
+MAX_PARALLEL_STEPS = 4
+
+# Conservative chars-per-token ratio for mostly Japanese text (used for TPM pacing only)
+CHARS_PER_TOKEN = 2
+
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+def instruction_bundle_key(model_name: str, system_instruction: str, safety_settings: List[Dict[str, str]], api_key: str = "") -> str:
+    """Hash identifying a model setup: two handlers with the same key are interchangeable."""
+    payload = json.dumps([model_name, system_instruction, safety_settings, api_key], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+# Marker blocks the prompts ask Gemini to emit
+SECTION_MARKERS = {
+    "title": ("---TITLE_START---", "---TITLE_END---"),
+    "description": ("---DESC_START---", "---DESC_END---"),
+    "image_prompts": ("---IMAGE_START---", "---IMAGE_END---"),
+}
+
+class SectionScanner:
+    """
+    Incremental extractor for marker blocks and ``` fenced blocks.
+    feed() only searches the newly received text (plus a marker-length overlap),
+    so scanning a response costs O(length) however it is chunked.
+    on_section(name, value) fires once per block as soon as its closing marker arrives;
+    fenced blocks are reported as "html" (```html) or "code".
+    """
+
+    FENCE = "```"
+
+    def __init__(self, on_section=None):
+        self.on_section = on_section
+        self.text = ""
+        self.sections: Dict[str, str] = {}
+        self.html_blocks: List[str] = []
+        self.code_blocks: List[str] = []
+        self._open = {}          # marker name -> content start offset
+        self._search_from = {}   # marker name -> offset to resume searching from
+        self._fence_open = None  # content start of the currently open fence
+        self._fence_from = 0
+
+    def feed(self, delta: str):
+        self.text += delta
+        for name, (start_marker, end_marker) in SECTION_MARKERS.items():
+            if name in self.sections:
+                continue
+            if name not in self._open:
+                i = self.text.find(start_marker, self._search_from.get(name, 0))
+                if i < 0:
+                    self._search_from[name] = max(0, len(self.text) - len(start_marker) + 1)
+                    continue
+                self._open[name] = i + len(start_marker)
+                self._search_from[name] = self._open[name]
+            j = self.text.find(end_marker, self._search_from[name])
+            if j < 0:
+                self._search_from[name] = max(self._open[name], len(self.text) - len(end_marker) + 1)
+                continue
+            self.sections[name] = self.text[self._open[name]:j].strip()
+            self._emit(name, self.sections[name])
+        self._scan_fences()
+
+    def _scan_fences(self):
+        while True:
+            i = self.text.find(self.FENCE, self._fence_from)
+            if i < 0:
+                self._fence_from = max(self._fence_from, len(self.text) - len(self.FENCE) + 1)
+                return
+            self._fence_from = i + len(self.FENCE)
+            if self._fence_open is None:
+                self._fence_open = self._fence_from
+                continue
+            block = self.text[self._fence_open:i]
+            self._fence_open = None
+            if block.startswith("html"):
+                self.html_blocks.append(block[4:])
+                self._emit("html", block[4:])
+            else:
+                self.code_blocks.append(block)
+                self._emit("code", block)
+
+    def _emit(self, name, value):
+        if self.on_section:
+            self.on_section(name, value)
+
+class StepResultStore:
+    """
+    Final response of each step, parsed once on arrival.
+    A step's draft is stored provisionally and replaced by its refined version.
+    Extraction only looks at model responses (never at prompts, which contain the
+    marker templates themselves):
+    - title / description / image prompts: marker blocks; a later step overrides an earlier one.
+    - content: the longest ```html block (plain ``` blocks only if no step produced html).
+    - image prompts fall back to the STEP 6 response when no IMAGE markers were emitted.
+    """
+
+    IMAGE_STEP = "STEP 6"
+    IMAGE_CLEANUP_MARKERS = ["**【作業完了】**", "これ以上の工程は", "引き続きのご承認"]
+
+    def __init__(self):
+        # step -> {"text", "sections", "html", "code"}
+        self.steps: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+
+    def add(self, step: str, text: str, scanner: "SectionScanner" = None):
+        if scanner is None:
+            scanner = SectionScanner()
+            scanner.feed(text)
+        self.steps[step] = {
+            "text": text,
+            "sections": dict(scanner.sections),
+            # Only the longest block of each kind is kept per step
+            "html": max(scanner.html_blocks, key=len) if scanner.html_blocks else "",
+            "code": max(scanner.code_blocks, key=len) if scanner.code_blocks else "",
+        }
+
+    def text(self, step: str) -> str:
+        entry = self.steps.get(step)
+        return entry["text"] if entry else ""
+
+    def result(self) -> Dict[str, str]:
+        sections = {}
+        html = ""
+        code = ""
+        for entry in self.steps.values():
+            sections.update(entry["sections"])
+            if len(entry["html"]) > len(html):
+                html = entry["html"]
+            if len(entry["code"]) > len(code):
+                code = entry["code"]
+
+        image_prompts = sections.get("image_prompts", "")
+        if not image_prompts and self.IMAGE_STEP in self.steps:
+            raw_prompts = self.steps[self.IMAGE_STEP]["text"]
+            for marker in self.IMAGE_CLEANUP_MARKERS:
+                if marker in raw_prompts:
+                    raw_prompts = raw_prompts.split(marker)[0]
+            image_prompts = raw_prompts.strip()
+
+        return {
+            "title": sections.get("title", "タイトル取得失敗"),
+            "description": sections.get("description", "ディスクリプション取得失敗"),
+            "content": (html or code).strip(),
+            "image_prompts": image_prompts,
+        }
+
+class AIHandler:
+    def __init__(self, api_key: str, vertex_project_id: str = None, vertex_location: str = "global", instruction_path: str = None, instruction_text: str = None, model_factory=None):
+        """
+        model_factory(model_name=, system_instruction=, safety_settings=) builds the model chats
+        are opened on (default: genai.GenerativeModel). Offline benchmarks pass a fake here.
+        """
+        if model_factory is None:
+            genai.configure(api_key=api_key)
+            model_factory = genai.GenerativeModel
+        
+        self.model_name = MODEL_NAME
+        self.safety_settings = SAFETY_SETTINGS
+
+        if instruction_text:
+            self.system_instruction = instruction_text
+        elif instruction_path:
+            with open(instruction_path, 'r', encoding='utf-8') as f:
+                self.system_instruction = f.read()
+        else:
+            raise ValueError("Either instruction_path or instruction_text must be provided.")
+
+        run_log(f"Initializing Gemini with model: {self.model_name}")
+        self.model = model_factory(
+            model_name=self.model_name,
+            system_instruction=self.system_instruction,
+            safety_settings=self.safety_settings
+        )
+        self.bundle_key = instruction_bundle_key(self.model_name, self.system_instruction, self.safety_settings, api_key)
+
+        # None = process-wide Gemini limiter (see rate_limiter.py)
+        self.rate_limiter = None
+
+    def _chat_model(self, context_cache=None):
+        """Model to open chats on: bound to the cached instruction prefix when context_cache has one."""
+        if context_cache:
+            cached_model = context_cache.get_model(self.bundle_key, self.model_name, self.system_instruction, self.safety_settings)
+            if cached_model is not None:
+                return cached_model
+        return self.model
+
+    def generate_article_flow(self, main_kw: str, sub_kws: str, goal: str, slug: str, prompt_dict, progress_callback=None, step_callback=None, stream: bool = False, chunk_callback=None, section_callback=None, journal=None, step_cache=None, replay_cached: bool = False, history_budget: int = 0, keep_steps=(), parallel_steps: int = MAX_PARALLEL_STEPS, validator=None, cancel_event=None, event_callback=None, context_cache=None) -> Dict[str, str]:
+        """
+        Executes the multi-step flow using Gemini only.
+        prompt_dict: A PromptPlan (prompt_plan.py), or a prompt definition compiled here.
+        Steps form a dependency graph (see prompt_plan.step_dependencies): each step runs on its own chat
+        forked from the turns of its upstream steps, and steps whose dependencies are met run
+        concurrently (up to parallel_steps). Callbacks are always invoked on the calling thread.
+        journal: Optional RowJournal (step_journal.py). Completed steps are recorded as they finish;
+                 on a rerun they are restored and only the missing steps run. If a step fails, the
+                 result carries "incomplete_step".
+        step_cache: Optional StepOutputCache. Every completed step is stored under a content key
+                 (model, system instruction, upstream outputs, the step's own prompts). With
+                 replay_cached, cached steps are replayed without calling Gemini, so only a changed
+                 step and the steps downstream of it are regenerated.
+        stream: Consume responses as chunks. chunk_callback(label, text_delta) receives partial text,
+                section_callback(label, name, value) fires as soon as a marker block (title, description,
+                image prompts, html) is closed. Time-to-first-token per call is returned under "ttft".
+        history_budget: Token budget for the chat history (0 = no limit). The ChatHistoryManager always
+                 collapses superseded drafts; with a budget it also drops the oldest steps not listed
+                 in keep_steps (default: steps a later prompt mentions by name). Input tokens sent per
+                 call are returned under "tokens_sent".
+        validator: Optional ConformanceValidator (conformance.py). A draft containing HTML is checked
+                 locally first: if it conforms, the self-check round trip is skipped; otherwise the
+                 violations are listed in the refine prompt. Skipped steps are returned under
+                 "skipped_refines".
+        cancel_event: Optional threading.Event checked between steps. Once set, no further step is
+                 started; running steps finish and the row ends incomplete (resumable from the journal).
+        event_callback: Optional emit(kind, message="", step=None, **data) (events.RowEmitter.emit) for
+                 typed STEP_STARTED / STEP_FINISHED (duration, tokens, calls) and RETRY events.
+        context_cache: Optional ContextCacheBackend (context_cache.py) the chats are opened on;
+                 None = always send the full instruction. Passed per call because handlers are shared.
+        """
+        plan = compile_prompts(prompt_dict)
+        dependencies = plan.dependencies
+        step_order = plan.step_order
+        lineage = plan.lineage
+
+        # Restore completed steps of an interrupted run
+        restored = journal.load() if journal else OrderedDict()
+        history_manager = ChatHistoryManager(history_budget, keep_steps or plan.referenced_steps, chars_per_token=CHARS_PER_TOKEN)
+
+        step_turns = OrderedDict()  # step -> turns of every completed step (restored, replayed or generated)
+        step_responses = {}         # step -> [(text, scanner)], merged into the results in step order
+        step_cache_keys = {}
+        ttft = {}
+        tokens_sent = {}
+        skipped_refines = []
+        replayed_steps = 0
+        step_started = {}
+
+        # Callbacks raised on worker threads are queued and run here, on the calling thread
+        events = queue.Queue()
+
+        def queued(callback):
+            if not callback:
+                return None
+            return lambda *args, **kwargs: events.put((callback, args, kwargs))
+
+        def drain():
+            while True:
+                try:
+                    callback, args, kwargs = events.get_nowait()
+                except queue.Empty:
+                    return
+                callback(*args, **kwargs)
+
+        emit = queued(event_callback)
+
+        def log(message, step=None, **data):
+            """Flow messages go to the row's events (the current run's bus when the caller passed no event_callback)."""
+            if emit:
+                emit(LOG, message, step=step, **data)
+            else:
+                run_log(message, step, **data)
+
+        def fork_chat(step):
+            """A chat whose history holds only the step's upstream steps (in flow order)."""
+            history = history_manager.history(lineage[step])
+            return self._chat_model(context_cache).start_chat(history=history)
+
+        def cache_key(step, *prompts):
+            """Content key of a step: its direct dependencies' keys and outputs plus its own prompts."""
+            if not step_cache:
+                return ""
+            upstream = dependencies.get(step, [])
+            if not upstream:
+                return step_cache.step_key(step_cache.base_key(self.model_name, self.system_instruction), "", step, *prompts)
+            parent_key = "+".join(step_cache_keys[name] for name in upstream)
+            parent_output = "\n".join(step_turns[name][-1][2] for name in upstream)
+            return step_cache.step_key(parent_key, parent_output, step, *prompts)
+
+        def complete(step, key, turns, restored_step=False):
+            """Bookkeeping once a step's final output exists (journal, step cache, history budget)."""
+            if journal and not restored_step:
+                journal.complete_step(step)
+            history_manager.add_step(step, turns)
+            if step_cache:
+                step_cache.put(key, turns)
+            step_cache_keys[step] = key
+            step_turns[step] = turns
+
+        def restore(step, key, turns, replayed=False):
+            """Replays a journaled or cached step into the results and the mapping callbacks."""
+            nonlocal replayed_steps
+            if replayed:
+                replayed_steps += 1
+                log(f"--- [Cache] Replaying {step} (unchanged) ---", step)
+                if journal:
+                    for phase, prompt, response in turns:
+                        journal.record_turn(step, phase, prompt, response)
+            step_responses[step] = [(response, None) for _phase, _prompt, response in turns]
+            if step_callback and step != "Initial":
+                for phase, _prompt, response in turns:
+                    if phase == "draft":
+                        step_callback(f"{step} (Draft)", response)
+                step_callback(step, turns[-1][2])
+            complete(step, key, turns, restored_step=not replayed)
+
+        def start(step):
+            step_started[step] = time.monotonic()
+            if emit:
+                emit(STEP_STARTED, step=step)
+
+        def finish(step, turns):
+            if not emit or step not in step_started:
+                return
+            duration = time.monotonic() - step_started[step]
+            tokens = tokens_sent.get(f"{step} (Draft)", 0) + tokens_sent.get(step, 0)
+            emit(STEP_FINISHED, f"{step} finished in {duration:.1f}s ({tokens} input tokens, {len(turns)} calls)",
+                 step=step, duration=round(duration, 3), tokens=tokens, calls=len(turns))
+
+        def send(step, chat, content, label):
+            """Returns (text, scanner): every response is scanned exactly once."""
+            sent_chars = self._request_chars(chat, content)
+            retries = []
+
+            def on_retry(attempt, delay, e):
+                retries.append(delay)
+                if emit:
+                    emit(RETRY, f"{label}: {type(e).__name__}, retry {attempt} in {delay:.1f}s",
+                         step=step, attempt=attempt, delay=round(delay, 2), error=type(e).__name__)
+
+            started = time.monotonic()
+            try:
+                if not stream:
+                    response = self._send_message_with_retry(chat, content, on_retry)
+                    text = response.text
+                    scanner = SectionScanner()
+                    scanner.feed(text)
+                else:
+                    response, scanner = self._send_message_streaming(chat, content, label, ttft, queued(chunk_callback), queued(section_callback), on_retry,
+                                                                     on_first_token=lambda seconds: log(f"[Gemini] {label}: first token after {seconds:.1f}s", step))
+                    text = response.text
+            except Exception:
+                METRICS.record("gemini", label, time.monotonic() - started, ok=False, step=step,
+                               retries=len(retries), backoff=sum(retries))
+                raise
+            usage = getattr(response, "usage_metadata", None)
+            prompt_tokens = getattr(usage, "prompt_token_count", 0) if usage is not None else 0
+            METRICS.record("gemini", label, time.monotonic() - started, step=step, retries=len(retries), backoff=sum(retries),
+                           tokens_in=prompt_tokens or sent_chars // CHARS_PER_TOKEN,
+                           tokens_out=getattr(usage, "candidates_token_count", 0) if usage is not None else 0)
+            history_manager.observe(sent_chars, prompt_tokens)
+            tokens_sent[label] = prompt_tokens or sent_chars // CHARS_PER_TOKEN
+            log(f"[Gemini] {label}: {tokens_sent[label]} input tokens{'' if prompt_tokens else ' (estimated)'}", step)
+            return text, scanner
+
+        def run_step(step, chat, formatted_exec, formatted_check):
+            """Draft (+ refine) of one step on its forked chat. Returns (turns, responses, error)."""
+            turns = []
+            responses = []
+            notify_progress = queued(progress_callback)
+            notify_step = queued(step_callback)
+            try:
+                # PHASE 1: Execution (Draft)
+                if notify_progress:
+                    notify_progress(f"{step} 実行中 (Draft)...")
+
+                draft_prompt = f"""
+            次の {step} を実行してください。
+
+            {formatted_exec}
+            
+            出力をお願いします。
+            """
+
+                text, scanner = send(step, chat, draft_prompt, f"{step} (Draft)")
+                # Provisional result for the step; replaced if the refine phase succeeds
+                responses.append((text, scanner))
+                if journal:
+                    journal.record_turn(step, "draft", draft_prompt, text)
+                turns.append(("draft", draft_prompt, text))
+
+                # Callback for Draft (Optional mapping: "STEP X (Draft)")
+                if notify_step:
+                    notify_step(f"{step} (Draft)", text)
+
+                # Mechanical rules first: a conforming HTML draft needs no self-check round trip
+                violations = []
+                if formatted_check.strip() and validator and scanner.html_blocks:
+                    violations = validator.validate(max(scanner.html_blocks, key=len))
+                    if not violations:
+                        skipped_refines.append(step)
+                        log(f"[Validator] {step}: draft conforms to the parts list; self-check skipped.", step)
+                        return turns, responses, None
+                    log(f"[Validator] {step}: {len(violations)} violations; sending self-check.", step)
+
+                # PHASE 2: Self-Check (Refine) - ONLY if check_text exists
+                if formatted_check.strip():
+                    if notify_progress:
+                        notify_progress(f"{step} 自己チェック中 (Refine)...")
+
+                    violation_text = ""
+                    if violations:
+                        violation_text = "\n\n**【機械チェックで検出された違反】**\n" + "\n".join(f"- {v}" for v in violations)
+
+                    refine_prompt = f"""
+                    ありがとうございます。
+                    直前の出力結果に対して、以下の【自己チェック基準】を用いて厳密にチェックし、
+                    問題がある場合は修正した【最終結果】を出力してください。
+                    問題がない場合も、そのまま出力してください。
+                    
+                    **【自己チェック基準】**
+                    {formatted_check}{violation_text}
+                    
+                    出力は修正後のコンテンツのみをお願いします。
+                    """
+
+                    text, scanner = send(step, chat, refine_prompt, step)
+                    responses.append((text, scanner))
+                    if journal:
+                        journal.record_turn(step, "refine", refine_prompt, text)
+                    turns.append(("refine", refine_prompt, text))
+                return turns, responses, None
+            except Exception as e:
+                log(f"Error at {step}: {e}", step, traceback=traceback.format_exc())
+                return turns, responses, e
+
+        if restored:
+            log(f"[Journal] Resuming '{main_kw}': {len(restored)} completed steps restored (last: {next(reversed(restored))}).")
+        
+        # 1. Prepare Initial Prompt
+        user_prompt = plan.render_initial(main_kw, sub_kws, goal, slug)
+        
+        initial_key = cache_key("Initial", user_prompt)
+        initial_cached = step_cache.get(initial_key) if step_cache and replay_cached else None
+        if "Initial" in restored:
+            restore("Initial", initial_key, restored["Initial"])
+        elif initial_cached:
+            restore("Initial", initial_key, initial_cached, replayed=True)
+        else:
+            log(f"--- [Gemini] STEP 1: Initializing for '{main_kw}' ---")
+            if progress_callback:
+                progress_callback("STEP 1: Planning (Gemini)")
+                
+            try:
+                start("Initial")
+                text, scanner = send("Initial", fork_chat("Initial"), user_prompt, "Initial")
+                drain()
+                step_responses["Initial"] = [(text, scanner)]
+                if journal:
+                    journal.record_turn("Initial", "exec", user_prompt, text)
+                complete("Initial", initial_key, [("exec", user_prompt, text)])
+                finish("Initial", step_turns["Initial"])
+                drain()
+            except Exception as e:
+                drain()
+                log(f"Initial prompt failed: {e}", "Initial")
+                return {"content": "", "image_prompts": "", "title": "", "description": "", "incomplete_step": "Initial"}
+
+        # 2. Run the steps as their dependencies complete
+        if any(dependencies[step] != [previous] for previous, step in zip(step_order, step_order[1:])):
+            log(f"[Flow] {len(dependencies)} steps, critical path {critical_path_length(dependencies)} steps.")
+
+        waiting = list(dependencies)
+        running = {}
+        failed_steps = []
+
+        def launch_ready(pool):
+            """Starts every step whose dependencies are complete; restored/cached steps finish inline."""
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            progressed = True
+            while progressed and not failed_steps:
+                progressed = False
+                for step in list(waiting):
+                    if len(running) >= max(1, parallel_steps):
+                        return
+                    if any(name not in step_turns for name in dependencies[step]):
+                        continue
+                    waiting.remove(step)
+                    progressed = True
+
+                    formatted_exec, formatted_check = plan.steps[step].render(slug, main_kw)
+                    step_key = cache_key(step, formatted_exec, formatted_check)
+                    if step in restored:
+                        restore(step, step_key, restored[step])
+                        continue
+                    step_cached = step_cache.get(step_key) if step_cache and replay_cached else None
+                    if step_cached:
+                        restore(step, step_key, step_cached, replayed=True)
+                        continue
+
+                    log(f"--- [Gemini] Proceeding to {step} ---", step)
+                    start(step)
+                    future = pool.submit(in_context(run_step), step, fork_chat(step), formatted_exec, formatted_check)
+                    running[future] = (step, step_key)
+
+        with ThreadPoolExecutor(max_workers=max(1, parallel_steps)) as pool:
+            while True:
+                launch_ready(pool)
+                if not running:
+                    break
+                done, _ = wait(running, timeout=0.2, return_when=FIRST_COMPLETED)
+                drain()
+                for future in done:
+                    step, step_key = running.pop(future)
+                    turns, responses, error = future.result()
+                    step_responses[step] = responses
+                    if error is not None:
+                        failed_steps.append(step)
+                        continue
+                    complete(step, step_key, turns)
+                    finish(step, turns)
+                    # Callback with FINAL result
+                    if step_callback:
+                        step_callback(step, turns[-1][2])
+        drain()
+        if waiting and cancel_event is not None and cancel_event.is_set():
+            log(f"[Flow] Cancelled before {waiting[0]}.")
+
+        incomplete_step = None
+        if failed_steps:
+            incomplete_step = min(failed_steps, key=step_order.index)
+        elif waiting:
+            incomplete_step = waiting[0]
+
+        results = StepResultStore()
+        for step in step_order:
+            for text, scanner in step_responses.get(step, []):
+                results.add(step, text, scanner)
+        
+        result = results.result()
+        result["content"] = self._post_process_html(result["content"]) if result["content"] else ""
+        result["ttft"] = ttft
+        result["replayed_steps"] = replayed_steps
+        result["tokens_sent"] = tokens_sent
+        result["skipped_refines"] = skipped_refines
+        if history_manager.dropped_steps:
+            log(f"[History] Dropped from context to stay within {history_budget} tokens: {', '.join(history_manager.dropped_steps)}")
+        if incomplete_step:
+            result["incomplete_step"] = incomplete_step
+        return result
+
+    def _send_message_with_retry(self, chat, content, on_retry=None):
+        """Sends one chat turn through the shared rate limiter (pacing, backoff, transient retries)."""
+        limiter = self.rate_limiter or get_gemini_limiter()
+        estimated = self._estimate_request_tokens(chat, content)
+        try:
+            response = limiter.call(lambda: chat.send_message(content), estimated_tokens=estimated, on_retry=on_retry)
+        except Exception as e:
+            # If invalid model name, it might throw 404 or 400 here.
+            if "404" in str(e) or "not found" in str(e).lower():
+                run_log(f"Error: Model {self.model_name} not found. Please check the model name.")
+            raise
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            limiter.record_usage(estimated, getattr(usage, "total_token_count", 0))
+        return response
+
+    def _send_message_streaming(self, chat, content, label, ttft, chunk_callback=None, section_callback=None, on_retry=None, on_first_token=None):
+        """
+        Streaming variant of _send_message_with_retry.
+        Chunks are forwarded as they arrive and scanned for closing markers; the returned
+        response is fully resolved (same state as a non-streamed call).
+        on_first_token(seconds) is called once the first text chunk arrives.
+        """
+        limiter = self.rate_limiter or get_gemini_limiter()
+        estimated = self._estimate_request_tokens(chat, content)
+
+        def run():
+            started = time.monotonic()
+            scanner = SectionScanner(on_section=(lambda name, value: section_callback(label, name, value)) if section_callback else None)
+            try:
+                response = chat.send_message(content, stream=True)
+                for chunk in response:
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Chunks without text parts (e.g. only a finish reason)
+                        continue
+                    if label not in ttft:
+                        ttft[label] = time.monotonic() - started
+                        if on_first_token:
+                            on_first_token(ttft[label])
+                    scanner.feed(text)
+                    if chunk_callback:
+                        chunk_callback(label, text)
+                return response, scanner
+            except Exception:
+                # A broken stream leaves a half-received turn in the chat; drop it before retrying
+                if getattr(chat, "_last_received", None) is not None:
+                    chat.rewind()
+                ttft.pop(label, None)
+                raise
+
+        try:
+            response, scanner = limiter.call(run, estimated_tokens=estimated, on_retry=on_retry)
+        except Exception as e:
+            if "404" in str(e) or "not found" in str(e).lower():
+                run_log(f"Error: Model {self.model_name} not found. Please check the model name.")
+            raise
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            limiter.record_usage(estimated, getattr(usage, "total_token_count", 0))
+        return response, scanner
+
+    def _estimate_request_tokens(self, chat, content: str) -> int:
+        """Rough input size of the next call (system instruction + history + prompt) for TPM pacing."""
+        return self._request_chars(chat, content) // CHARS_PER_TOKEN + 1
+
+    def _request_chars(self, chat, content: str) -> int:
+        chars = len(self.system_instruction) + len(content)
+        for message in getattr(chat, "history", []):
+            for part in getattr(message, "parts", []):
+                chars += len(getattr(part, "text", "") or "")
+        return chars
+
+    def _post_process_html(self, html: str) -> str:
+        """Replaces custom tags, markdown artifacts, and unwanted classes."""
+        import re
+        
+        replacements = {
+            "<numlist>": '<div class="numlist">',
+            "</numlist>": '</div>',
+            "<normalBox>": '<div class="normalBox">',
+            "</normalBox>": '</div>',
+            "<flow>": '<div class="flow">',
+            "</flow>": '</div>',
+            "<qa-box01>": '<div class="qa-box01">',
+            "</qa-box01>": '</div>',
+        }
+        for old, new in replacements.items():
+            html = html.replace(old, new)
+            
+        html = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', html)
+        html = re.sub(r'<p class="[^"]*">', r'<p>', html)
+        html = re.sub(r'(<img\s+[^>]*>)', r'<div class="img-100">\1</div>', html)
+        
+        return html
+
+
+class AIHandlerPool:
+    """
+    LRU pool of AIHandler instances keyed by model name, system instruction and safety settings.
+    A handler holds no per-row state (each generate_article_flow opens its own chat),
+    so rows with the same site / rules share one configured GenerativeModel.
+    model_factory is passed to every AIHandler created (see AIHandler).
+    The API key is not part of the key: genai.configure is process-global, so there is one key
+    at a time. A call with another key drops the pooled handlers (reconfigured on creation).
+    """
+
+    def __init__(self, maxsize: int = 8, model_factory=None):
+        self.maxsize = maxsize
+        self.model_factory = model_factory
+        self._handlers = OrderedDict()
+        self._api_key = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, api_key: str, instruction_text: str) -> AIHandler:
+        key = instruction_bundle_key(MODEL_NAME, instruction_text, SAFETY_SETTINGS)
+        with self._lock:
+            if api_key != self._api_key:
+                self._handlers.clear()
+                self._api_key = api_key
+            handler = self._handlers.get(key)
+            if handler is not None:
+                self._handlers.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                handler = AIHandler(api_key, instruction_text=instruction_text, model_factory=self.model_factory)
+                self._handlers[key] = handler
+                if len(self._handlers) > self.maxsize:
+                    self._handlers.popitem(last=False)
+            return handler
+
+    def stats(self) -> str:
+        return f"{self.hits} hits / {self.misses} misses ({len(self._handlers)} pooled)"
+
+
+# Shared by every process_batch call in this process (CLI and Streamlit reruns)
+AI_HANDLER_POOL = AIHandlerPool()
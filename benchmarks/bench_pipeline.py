@@ -0,0 +1,203 @@
+"""
+Offline end-to-end benchmark of process_batch: real pipeline, flow, rate limiter, write buffer
+and WP client against the in-process fakes of benchmarks/fakes.py. No quota is spent.
+
+    python benchmarks/bench_pipeline.py                      # every scenario
+    python benchmarks/bench_pipeline.py baseline throttled --rows 50 --json results.json
+
+Each scenario runs in a fresh interpreter (pools, caches and the RSS peak are per process)
+and reports rows/min, API calls per row, peak RSS and time to the first completed row.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SITE_NAME = "bench"
+
+# name -> settings (command line options override them for every selected scenario)
+SCENARIOS = {
+    "smoke": {"rows": 4, "workers": 2, "latency": 0.02, "sigma": 0.3},
+    "baseline": {"rows": 20, "workers": 4, "latency": 0.2, "sigma": 0.4},
+    "throttled": {"rows": 20, "workers": 4, "latency": 0.2, "sigma": 0.4, "error_rate": 0.1},
+    "stream": {"rows": 20, "workers": 4, "latency": 0.2, "sigma": 0.4, "stream": True},
+    "wp_bulk": {"rows": 20, "workers": 4, "latency": 0.2, "sigma": 0.4, "wp_bulk": True, "wp_latency": 0.05},
+    "multi_tab": {"rows": 20, "workers": 4, "latency": 0.2, "sigma": 0.4, "tabs": 4},
+}
+
+DEFAULTS = {
+    "rows": 10, "workers": 1, "latency": 0.2, "sigma": 0.4, "error_rate": 0.0, "retry_after": 0.05,
+    "response_chars": 4000, "stream": False, "wp_bulk": False, "wp_latency": 0.0, "seed": 1, "tabs": 1,
+}
+
+
+class FirstRowSink:
+    """Event sink noting when rows finish (time to first completed row, completed count)."""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.first_done = None
+        self.done = 0
+
+    def handle(self, event):
+        from events import ROW_DONE
+        if event.kind == ROW_DONE:
+            self.done += 1
+            if self.first_done is None:
+                self.first_done = time.monotonic() - self.started
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_scenario(name: str, settings: dict, verbose: bool = False) -> dict:
+    """Runs one scenario in this process and returns its measurements."""
+    from fakes import FakeGemini, FakeSheetsClient, LatencyModel, WPStubServer, task_rows
+    import main
+    from ai_handler import AIHandlerPool
+    from config_manager import load_prompts
+    from events import CallbackSink, EventBus
+    from sheet_handler import SheetHandler, TabCache
+    from step_journal import STEP_JOURNAL
+
+    workdir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    # Journal and step cache must start empty, or rows would be replayed from an earlier run
+    STEP_JOURNAL.path = os.path.join(workdir, "journal.sqlite3")
+
+    gemini = FakeGemini(LatencyModel(settings["latency"], settings["sigma"], seed=settings["seed"]),
+                        error_rate=settings["error_rate"], retry_after=settings["retry_after"],
+                        response_chars=settings["response_chars"], seed=settings["seed"])
+    # Rows are split over the tabs; with several tabs they run as one multi-sheet process_batch
+    client = FakeSheetsClient()
+    tabs = [f"Sheet{i + 1}" for i in range(max(1, settings["tabs"]))]
+    for i, tab in enumerate(tabs):
+        first, last = settings["rows"] * i // len(tabs), settings["rows"] * (i + 1) // len(tabs)
+        client.spreadsheet.add_worksheet_rows(tab, task_rows(last - first, SITE_NAME, start=first))
+    url = "https://docs.google.com/spreadsheets/d/benchmark-sheet"
+    sheet = SheetHandler(client=client, tab_cache=TabCache(path=os.path.join(workdir, "tab_cache.json")))
+    sheet.connect(url, tabs[0])
+    sheets = None
+    if len(tabs) > 1:
+        sheets = [{"sheet": sheet, "label": tabs[0]}] + [{"sheet": sheet.for_worksheet(url, tab), "label": tab} for tab in tabs[1:]]
+
+    with WPStubServer(latency=settings["wp_latency"]) as wp:
+        started = time.monotonic()
+        progress = FirstRowSink(started)
+        sinks = [progress]
+        if verbose:
+            sinks.append(CallbackSink(print))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if verbose else output):
+            main.process_batch(
+                "benchmark-key", "", manual_prompts=load_prompts(), manual_common_rules="ベンチマーク用の共通ルール",
+                workers=settings["workers"], stream=settings["stream"], wp_bulk=settings["wp_bulk"],
+                events=EventBus(sinks), sheet=sheet, sheets=sheets, sites_config={SITE_NAME: wp.site_config()},
+                ai_pool=AIHandlerPool(model_factory=gemini),
+                metrics_jsonl=os.path.join(workdir, "metrics.jsonl"),
+            )
+        elapsed = time.monotonic() - started
+
+    rows = progress.done
+    per_row = (lambda calls: round(calls / rows, 2) if rows else None)
+    sheets = client.counter
+    return {
+        "scenario": name,
+        "settings": settings,
+        "rows": rows,
+        "seconds": round(elapsed, 2),
+        "rows_per_min": round(rows / elapsed * 60, 1) if elapsed else 0.0,
+        "first_row_seconds": round(progress.first_done, 2) if progress.first_done is not None else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "calls_per_row": {
+            "gemini": per_row(gemini.counter.counts.get("send_message", 0)),
+            "sheets": per_row(sheets.total),
+            "wp": per_row(wp.counter.total),
+        },
+        "gemini_429": gemini.counter.counts.get("429", 0),
+        "sheets_quota": sheets.quota_report(),
+        "metrics_jsonl": os.path.join(workdir, "metrics.jsonl"),
+    }
+
+
+def format_results(results) -> str:
+    lines = [f"{'Scenario':<10} {'rows':>5} {'rows/min':>9} {'1st row s':>9} {'RSS MB':>7} "
+             f"{'gemini/row':>10} {'sheets/row':>10} {'wp/row':>7} {'429s':>5}  sheets quota"]
+    for r in results:
+        calls = r["calls_per_row"]
+        quota = ", ".join(f"{kind} {q['peak_per_min']}/{q['quota']}/min{' EXCEEDED' if q['exceeded'] else ''}"
+                          for kind, q in r["sheets_quota"].items())
+        first = f"{r['first_row_seconds']:.1f}" if r["first_row_seconds"] is not None else "-"
+        lines.append(f"{r['scenario']:<10} {r['rows']:>5} {r['rows_per_min']:>9.1f} {first:>9} {r['peak_rss_mb']:>7.1f} "
+                     f"{calls['gemini'] or 0:>10.1f} {calls['sheets'] or 0:>10.2f} {calls['wp'] or 0:>7.2f} "
+                     f"{r['gemini_429']:>5}  {quota}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark of process_batch (no API quota used)")
+    parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--rows", type=int, help="Pending rows in the fake sheet")
+    parser.add_argument("--workers", type=int, help="process_batch workers")
+    parser.add_argument("--tabs", type=int, help="Worksheets the rows are spread over (one multi-sheet run)")
+    parser.add_argument("--latency", type=float, help="Median Gemini response time in seconds")
+    parser.add_argument("--sigma", type=float, help="Spread (log-normal sigma) of the Gemini response time")
+    parser.add_argument("--error-rate", type=float, help="Share of Gemini calls failing with 429")
+    parser.add_argument("--retry-after", type=float, help="Retry delay the injected 429s ask for (seconds)")
+    parser.add_argument("--response-chars", type=int, help="Size of each canned Gemini response")
+    parser.add_argument("--wp-latency", type=float, help="Delay of each WP stub request in seconds")
+    parser.add_argument("--seed", type=int, help="Random seed for latency and 429 injection")
+    parser.add_argument("--json", type=str, help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the run log")
+    parser.add_argument("--single", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    overrides = {key: value for key, value in vars(args).items() if key in DEFAULTS and value is not None}
+    if args.single:
+        # Child process: one scenario, results as JSON on the last line of stdout
+        settings = dict(DEFAULTS, **json.loads(args.single))
+        result = run_scenario(settings.pop("name"), settings, verbose=args.verbose)
+        print(json.dumps(result, ensure_ascii=False))
+        return
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenario(s): {', '.join(unknown)}")
+
+    results = []
+    for name in names:
+        settings = dict(SCENARIOS[name], **overrides, name=name)
+        print(f"Running {name}...", flush=True)
+        command = [sys.executable, os.path.abspath(__file__), "--single", json.dumps(settings)]
+        if args.verbose:
+            command.append("--verbose")
+        completed = subprocess.run(command, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+        if args.verbose:
+            print(completed.stdout.rsplit("\n", 2)[0])
+        if completed.returncode != 0:
+            print(f"Scenario {name} failed (exit code {completed.returncode}).")
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    print()
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
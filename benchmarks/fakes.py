@@ -0,0 +1,486 @@
+"""
+In-process stand-ins for Gemini, Google Sheets and WordPress used by the offline benchmarks.
+None of them needs network access or credentials; each counts the calls made against it.
+"""
+import json
+import math
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import gspread
+from google.api_core import exceptions as google_exceptions
+from gspread.utils import a1_range_to_grid_range
+
+from ai_handler import SECTION_MARKERS
+
+
+class CallCounter:
+    """Thread-safe call counts per kind, with timestamps for per-minute quota checks."""
+
+    def __init__(self, quota_per_minute: Optional[Dict[str, int]] = None):
+        self.quota_per_minute = quota_per_minute or {}
+        self.counts: Dict[str, int] = {}
+        self._times: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def hit(self, kind: str):
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+            self._times.setdefault(kind, []).append(time.monotonic())
+
+    @property
+    def total(self) -> int:
+        with self._lock:
+            return sum(self.counts.values())
+
+    def peak_per_minute(self, kind: str) -> int:
+        """Most calls of kind inside any 60 second window."""
+        with self._lock:
+            times = list(self._times.get(kind, []))
+        window = deque()
+        peak = 0
+        for t in times:
+            window.append(t)
+            while t - window[0] >= 60:
+                window.popleft()
+            peak = max(peak, len(window))
+        return peak
+
+    def quota_report(self) -> Dict[str, Dict[str, Any]]:
+        """kind -> {"calls", "peak_per_min", "quota", "exceeded"} for every kind that has a quota."""
+        report = {}
+        for kind, quota in self.quota_per_minute.items():
+            peak = self.peak_per_minute(kind)
+            report[kind] = {"calls": self.counts.get(kind, 0), "peak_per_min": peak, "quota": quota, "exceeded": peak > quota}
+        return report
+
+
+# --- Gemini ---
+
+class LatencyModel:
+    """Log-normal response time (median seconds, sigma of the log), reproducible with seed."""
+
+    def __init__(self, median: float = 0.2, sigma: float = 0.4, seed: Optional[int] = None):
+        self.median = median
+        self.sigma = sigma
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        with self._lock:
+            return self._random.lognormvariate(math.log(self.median), self.sigma)
+
+
+def canned_response(prompt: str, size: int = 4000) -> str:
+    """A reply carrying every marker block the flow extracts, padded to about size chars."""
+    topic = " ".join(prompt.split())[:40]
+    title_start, title_end = SECTION_MARKERS["title"]
+    desc_start, desc_end = SECTION_MARKERS["description"]
+    image_start, image_end = SECTION_MARKERS["image_prompts"]
+    paragraph = "<h2>見出し</h2><p>ベンチマーク用のダミー本文です。{}</p>\n".format(topic)
+    body = paragraph * max(1, size // len(paragraph))
+    return (
+        f"{title_start}{topic} のタイトル{title_end}\n"
+        f"{desc_start}{topic} のディスクリプション{desc_end}\n"
+        f"```html\n{body}```\n"
+        f"{image_start}A photo about {topic}{image_end}\n"
+    )
+
+
+class _Part:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Content:
+    __slots__ = ("role", "parts")
+
+    def __init__(self, role: str, text: str):
+        self.role = role
+        self.parts = [_Part(text)]
+
+
+class _Usage:
+    __slots__ = ("prompt_token_count", "candidates_token_count", "total_token_count")
+
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeResponse:
+    """Resolved response; iterating it yields chunks (for stream=True) spread over the latency."""
+
+    def __init__(self, text: str, usage: _Usage, latency: float = 0.0, chunk_chars: int = 200):
+        self.text = text
+        self.usage_metadata = usage
+        self._latency = latency
+        self._chunk_chars = chunk_chars
+
+    def __iter__(self):
+        chunks = [self.text[i:i + self._chunk_chars] for i in range(0, len(self.text), self._chunk_chars)] or [""]
+        for chunk in chunks:
+            time.sleep(self._latency / len(chunks))
+            yield _Part(chunk)
+
+
+class FakeChat:
+    def __init__(self, model: "FakeGeminiModel", history=None):
+        self.model = model
+        self.history = [self._content(message) for message in history or []]
+        self._last_received = None
+
+    @staticmethod
+    def _content(message):
+        if isinstance(message, dict):
+            parts = message.get("parts", [])
+            return _Content(message.get("role", "user"), "".join(str(part) for part in parts))
+        return message
+
+    def send_message(self, content: str, stream: bool = False):
+        gemini = self.model.gemini
+        gemini.counter.hit("send_message")
+        latency = gemini.latency.sample()
+        if gemini.should_throttle():
+            gemini.counter.hit("429")
+            time.sleep(min(latency, 0.05))
+            raise google_exceptions.ResourceExhausted(
+                f"429 Resource has been exhausted (e.g. check quota). Please retry in {gemini.retry_after}s.")
+        text = canned_response(content, gemini.response_chars)
+        prompt_chars = len(self.model.system_instruction) + len(content) + sum(
+            len(part.text) for message in self.history for part in message.parts)
+        usage = _Usage(prompt_chars // 2, len(text) // 2)
+        self.history += [_Content("user", content), _Content("model", text)]
+        if stream:
+            return FakeResponse(text, usage, latency)
+        time.sleep(latency)
+        return FakeResponse(text, usage)
+
+    def rewind(self):
+        self.history = self.history[:-2]
+
+
+class FakeGeminiModel:
+    def __init__(self, gemini: "FakeGemini", model_name: str, system_instruction: str, safety_settings=None):
+        self.gemini = gemini
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history)
+
+
+class FakeGemini:
+    """
+    Gemini stand-in; pass it as AIHandler / AIHandlerPool model_factory.
+    - Every send_message sleeps for a LatencyModel sample and returns canned_response().
+    - With probability error_rate a call fails with ResourceExhausted (429) asking for a
+      retry after retry_after seconds, which the shared RateLimiter honours.
+    """
+
+    def __init__(self, latency: Optional[LatencyModel] = None, error_rate: float = 0.0, retry_after: float = 0.05,
+                 response_chars: int = 4000, seed: Optional[int] = None):
+        self.latency = latency or LatencyModel(seed=seed)
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.response_chars = response_chars
+        self.counter = CallCounter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def should_throttle(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def __call__(self, model_name: str, system_instruction: str = "", safety_settings=None) -> FakeGeminiModel:
+        return FakeGeminiModel(self, model_name, system_instruction, safety_settings)
+
+
+# --- Google Sheets ---
+
+class InMemoryWorksheet:
+    """
+    The subset of gspread.Worksheet used by SheetHandler, over a list of rows.
+    Each method counts as one read or write request, like the API call it replaces.
+    fail_writes: number of upcoming write requests that fail (quota / network errors).
+    """
+
+    def __init__(self, spreadsheet: "InMemorySpreadsheet", title: str, rows: List[List[Any]]):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows = [list(row) for row in rows]
+        self.fail_writes = 0
+        self._lock = threading.Lock()
+
+    def _write_request(self):
+        self.spreadsheet.counter.hit("write")
+        with self._lock:
+            if self.fail_writes:
+                self.fail_writes -= 1
+                raise google_exceptions.TooManyRequests("Quota exceeded for write requests")
+
+    def _cell(self, row: int, col: int) -> str:
+        if row <= len(self.rows) and col <= len(self.rows[row - 1]):
+            value = self.rows[row - 1][col - 1]
+            return "" if value is None else str(value)
+        return ""
+
+    def _set(self, row: int, col: int, value: Any):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = value
+
+    def _read(self, a1: str) -> List[List[str]]:
+        """Values of a range with trailing empty rows and cells trimmed (as the API returns them)."""
+        grid = a1_range_to_grid_range(a1)
+        first_row = grid.get("startRowIndex", 0) + 1
+        last_row = grid.get("endRowIndex", len(self.rows))
+        first_col = grid.get("startColumnIndex", 0) + 1
+        last_col = grid.get("endColumnIndex", max((len(row) for row in self.rows), default=0))
+        values = []
+        for row in range(first_row, last_row + 1):
+            cells = [self._cell(row, col) for col in range(first_col, last_col + 1)]
+            while cells and cells[-1] == "":
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def row_values(self, row: int) -> List[str]:
+        self.spreadsheet.counter.hit("read")
+        with self._lock:
+            values = self._read(f"{row}:{row}")
+        return values[0] if values else []
+
+    def batch_get(self, ranges: List[str], **kwargs) -> List[List[List[str]]]:
+        self.spreadsheet.counter.hit("read")
+        with self._lock:
+            return [self._read(a1) for a1 in ranges]
+
+    def get_all_records(self, **kwargs) -> List[Dict[str, Any]]:
+        self.spreadsheet.counter.hit("read")
+        with self._lock:
+            if not self.rows:
+                return []
+            headers = [str(h) for h in self.rows[0]]
+            return [dict(zip(headers, row + [""] * (len(headers) - len(row)))) for row in self.rows[1:]]
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs):
+        self._write_request()
+        with self._lock:
+            for entry in data:
+                grid = a1_range_to_grid_range(entry["range"])
+                for r_off, values in enumerate(entry["values"]):
+                    for c_off, value in enumerate(values):
+                        if value is not None:
+                            self._set(grid["startRowIndex"] + 1 + r_off, grid["startColumnIndex"] + 1 + c_off, value)
+
+    def update_cell(self, row: int, col: int, value: Any):
+        self._write_request()
+        with self._lock:
+            self._set(row, col, value)
+
+    def update_cells(self, cells: List[gspread.Cell], **kwargs):
+        self._write_request()
+        with self._lock:
+            for cell in cells:
+                self._set(cell.row, cell.col, cell.value)
+
+
+class InMemorySpreadsheet:
+    def __init__(self, counter: CallCounter, title: str = "benchmark", spreadsheet_id: str = "benchmark-sheet"):
+        self.counter = counter
+        self.title = title
+        self.id = spreadsheet_id
+        self.worksheets: Dict[str, InMemoryWorksheet] = {}
+
+    def add_worksheet_rows(self, title: str, rows: List[List[Any]]) -> InMemoryWorksheet:
+        self.worksheets[title] = InMemoryWorksheet(self, title, rows)
+        return self.worksheets[title]
+
+    @property
+    def sheet1(self) -> InMemoryWorksheet:
+        self.counter.hit("read")
+        return next(iter(self.worksheets.values()))
+
+    def worksheet(self, title: str) -> InMemoryWorksheet:
+        self.counter.hit("read")
+        if title not in self.worksheets:
+            raise gspread.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+
+class _DriveResponse:
+    def __init__(self, modified_time: str):
+        self.modified_time = modified_time
+
+    def json(self):
+        return {"modifiedTime": self.modified_time}
+
+
+class FakeSheetsClient:
+    """
+    gspread client stand-in for SheetHandler(client=...). Calls are counted against the
+    per-user Sheets quota (read and write requests per minute, default 60 each).
+    """
+
+    def __init__(self, quota_per_minute: Optional[Dict[str, int]] = None):
+        self.counter = CallCounter(quota_per_minute or {"read": 60, "write": 60})
+        self.spreadsheet = InMemorySpreadsheet(self.counter)
+        self.modified_time = "2000-01-01T00:00:00.000Z"  # Drive modifiedTime of the spreadsheet
+
+    def open_by_url(self, url: str) -> InMemorySpreadsheet:
+        self.counter.hit("read")
+        return self.spreadsheet
+
+    def request(self, method: str, url: str, **kwargs) -> _DriveResponse:
+        """Drive metadata lookups (SheetHandler.refresh_tab_cache)."""
+        self.counter.hit("drive")
+        return _DriveResponse(self.modified_time)
+
+
+def task_rows(count: int, site_name: str, article_type: str = "Default", start: int = 0) -> List[List[Any]]:
+    """Header row plus count pending rows (numbered from start) in the layout main.HEADERS describes."""
+    headers = ["Status", "MainKW", "SubKW1", "SubKW2", "Goal", "SiteName", "Slug", "DraftURL", "ImagePrompts",
+               "Title", "Description", "Content", "ArticleType"]
+    rows = [headers]
+    for i in range(start, start + count):
+        rows.append(["", f"ベンチ キーワード {i}", "サブ1", "サブ2", "", site_name, f"bench-{i}", "", "", "", "", "", article_type])
+    return rows
+
+
+# --- WordPress ---
+
+class _WPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "WPStubServer"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: Any):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> Dict[str, Any]:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        self.server.counter.hit("GET")
+        self.server.log_request_path("GET", self.path)
+        time.sleep(self.server.latency)
+        path = urlparse(self.path)
+        if self.server.take_lookup_failure():
+            return self._send(500, {"code": "internal_server_error"})
+        if path.path.endswith("/wp/v2/posts"):
+            wanted = set(",".join(parse_qs(path.query).get("slug", [""])).split(","))
+            return self._send(200, [post for post in self.server.posts_snapshot() if post["slug"] in wanted])
+        self._send(404, {"code": "rest_no_route"})
+
+    def do_POST(self):
+        self.server.counter.hit("POST")
+        self.server.log_request_path("POST", self.path)
+        path = urlparse(self.path).path
+        time.sleep(self.server.latency)
+        if path.endswith("/batch/v1"):
+            requests = self._body().get("requests", [])  # read even when refusing (keep-alive)
+            if self.server.batch_status:
+                return self._send(self.server.batch_status, {"code": "rest_no_route"})
+            responses = []
+            for request in requests:
+                body = request.get("body", {})
+                if body.get("slug") in self.server.fail_slugs:
+                    responses.append({"status": 400, "body": {"code": "rest_invalid_param", "message": "invalid"}})
+                    continue
+                responses.append({"status": 201, "body": self.server.save_post(body, request.get("path", ""))})
+            return self._send(207, {"responses": responses})
+        if "/wp/v2/posts" in path:
+            body = self._body()
+            if body.get("slug") in self.server.fail_slugs:
+                return self._send(400, {"code": "rest_invalid_param", "message": "invalid"})
+            return self._send(201, self.server.save_post(body, path))
+        self._send(404, {"code": "rest_no_route"})
+
+
+class WPStubServer(ThreadingHTTPServer):
+    """
+    Local WordPress REST stub (posts lookup by slug, create/update, /batch/v1) on a random port.
+    Use as a context manager; site_config() is a sites.json entry pointing at it.
+    - batch_status: answer /batch/v1 with this status (e.g. 404, a site without the endpoint).
+    - fail_slugs: posts with these slugs are rejected with 400 (single or batch sub-request).
+    - fail_lookups: number of upcoming GET requests answered with 500.
+    requests lists (method, path) of every request received.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency: float = 0.0, batch_status: Optional[int] = None, fail_slugs=(), fail_lookups: int = 0):
+        super().__init__(("127.0.0.1", 0), _WPRequestHandler)
+        self.latency = latency
+        self.batch_status = batch_status
+        self.fail_slugs = set(fail_slugs)
+        self.fail_lookups = fail_lookups
+        self.counter = CallCounter()
+        self.posts: Dict[int, Dict[str, Any]] = {}
+        self.requests: List[tuple] = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def site_config(self) -> Dict[str, str]:
+        return {"url": self.url, "user": "bench", "app_password": "bench"}
+
+    def save_post(self, body: Dict[str, Any], path: str) -> Dict[str, Any]:
+        with self._lock:
+            tail = path.rstrip("/").rsplit("/", 1)[-1]
+            post_id = int(tail) if tail.isdigit() else max(self.posts, default=0) + 1
+            post = self.posts.setdefault(post_id, {"id": post_id, "status": "draft"})
+            post.update({key: value for key, value in body.items() if key in ("title", "slug", "status")})
+            post["link"] = f"{self.url}/?p={post_id}"
+            return dict(post)
+
+    def take_lookup_failure(self) -> bool:
+        with self._lock:
+            if self.fail_lookups:
+                self.fail_lookups -= 1
+                return True
+            return False
+
+    def log_request_path(self, method: str, path: str):
+        with self._lock:
+            self.requests.append((method, urlparse(path).path))
+
+    def posts_snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(post) for post in self.posts.values()]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="wp-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,78 @@
+import json
+import re
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+STEP_REFERENCE = re.compile(r"STEP\s*(\d+(?:\.\d+)?)")
+
+
+def referenced_steps(prompt_dict: Dict[str, object]) -> Set[str]:
+    """Steps whose output a later prompt mentions by name (e.g. STEP 7 checking against "STEP 5")."""
+    steps = [key for key in prompt_dict if key.startswith("STEP ")]
+    referenced = set()
+    for index, step in enumerate(steps):
+        text = json.dumps(prompt_dict[step], ensure_ascii=False, default=dict)
+        for number in STEP_REFERENCE.findall(text):
+            name = f"STEP {number}"
+            if name in steps[:index]:
+                referenced.add(name)
+    return referenced
+
+
+class ChatHistoryManager:
+    """
+    Builds the chat history sent to Gemini from completed steps, within a token budget.
+    - A step whose refine turn exists is collapsed to one exchange: the draft prompt
+      answered by the refined output. The superseded draft is never re-sent.
+    - While the estimated history exceeds token_budget (0 = no limit), the oldest steps are dropped,
+      except Initial, the steps in keep_steps and the most recent step (which the
+      next prompt usually refers to as 直前の出力).
+    Token estimates use chars_per_token, calibrated from usage_metadata via observe().
+    """
+
+    def __init__(self, token_budget: int = 0, keep_steps: Iterable[str] = (), chars_per_token: float = 2.0):
+        self.token_budget = token_budget
+        self.keep_steps = {"Initial", *keep_steps}
+        self.chars_per_token = chars_per_token
+        self.steps: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        self.dropped_steps: List[str] = []
+
+    def add_step(self, step: str, turns: List[Tuple[str, str, str]]):
+        """Records a completed step from its turns [(phase, prompt, response), ...]."""
+        prompt = turns[0][1]
+        final_output = turns[-1][2]
+        self.steps[step] = (prompt, final_output)
+
+    def history(self, steps: Optional[Iterable[str]] = None) -> List[Dict[str, object]]:
+        """History for the given completed steps (default: all), pruned to the budget."""
+        selected = [step for step in (self.steps if steps is None else steps) if step in self.steps]
+        selected = self._within_budget(selected)
+        messages = []
+        for step in selected:
+            prompt, output = self.steps[step]
+            messages.append({"role": "user", "parts": [prompt]})
+            messages.append({"role": "model", "parts": [output]})
+        return messages
+
+    def estimate_tokens(self, steps: Optional[Iterable[str]] = None) -> int:
+        selected = self.steps if steps is None else steps
+        chars = sum(len(self.steps[step][0]) + len(self.steps[step][1]) for step in selected)
+        return int(chars / self.chars_per_token)
+
+    def observe(self, sent_chars: int, prompt_tokens: int):
+        """Calibrates the chars-per-token ratio from a real request (moving average)."""
+        if sent_chars > 0 and prompt_tokens > 0:
+            self.chars_per_token = 0.7 * self.chars_per_token + 0.3 * (sent_chars / prompt_tokens)
+
+    def _within_budget(self, selected: List[str]) -> List[str]:
+        if not self.token_budget:
+            return selected
+        selected = list(selected)
+        while self.estimate_tokens(selected) > self.token_budget:
+            droppable = [step for step in selected[:-1] if step not in self.keep_steps]
+            if not droppable:
+                break
+            selected.remove(droppable[0])
+            if droppable[0] not in self.dropped_steps:
+                self.dropped_steps.append(droppable[0])
+        return selected
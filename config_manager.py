@@ -1,57 +1,197 @@
-import json
-import os
-from typing import Dict, Any
-
-CONFIG_FILE = "config/sites.json"
-
-def load_sites_config() -> Dict[str, Any]:
-    """Loads the WordPress sites configuration from sites.json."""
-    # Try Streamlit Secrets first (for Cloud)
-    # Try Streamlit Secrets first (for Cloud)
-    try:
-        import streamlit as st
-        # Accessing st.secrets may raise FileNotFoundError or StreamlitSecretNotFoundError if no secrets.toml
-        if hasattr(st, "secrets") and "sites_config" in st.secrets:
-            return dict(st.secrets["sites_config"])
-    except (ImportError, Exception):
-        # Fallback to local file if streamlit is not installed or secrets are missing
-        pass
-
-    # Fallback to local file
-    if not os.path.exists(CONFIG_FILE):
-        return {}
-    
-    try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"Error loading {CONFIG_FILE}: {e}")
-        return {}
-
-def get_gemini_api_key() -> str:
-    """Retrieves the Gemini API key from environment variables."""
-    return os.getenv("GEMINI_API_KEY", "")
-
-def load_sheets_credentials() -> Any:
-    """
-    Retrieves Google Sheets credentials.
-    Returns:
-        - Dict: If found in Streamlit Secrets (for Cloud).
-        - Str: Path to service_account.json (for Local).
-        - None: If neither found.
-    """
-    # 1. Try Streamlit Secrets
-    try:
-        import streamlit as st
-        if hasattr(st, "secrets") and "gcp_service_account" in st.secrets:
-            # st.secrets returns a special AttrDict, convert to standard dict for gspread
-            return dict(st.secrets["gcp_service_account"])
-    except (ImportError, Exception):
-        pass
-
-    # 2. Try Local File
-    creds_path = os.getenv("GOOGLE_SHEETS_CREDENTIALS_PATH", "service_account.json")
-    if os.path.exists(creds_path):
-        return creds_path
-    
-    return None
+import json
+import os
+import re
+import hashlib
+import threading
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Dict, Any, Callable, List, NamedTuple, Tuple
+
+CONFIG_FILE = "config/sites.json"
+PROMPTS_FILE = "config/prompts.json"
+RULES_FILE = "config/common_rules.md"
+
+def freeze(value: Any) -> Any:
+    """Read-only deep copy: dicts become MappingProxyType, lists tuples (check with Mapping, not dict)."""
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+def thaw(value: Any) -> Any:
+    """Mutable deep copy of a frozen snapshot (for editors that modify and save it)."""
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+class FileSnapshot(NamedTuple):
+    mtime_ns: int
+    size: int
+    digest: str
+    value: Any
+
+class ConfigStore:
+    """
+    Process-wide cache of config files as immutable snapshots, shared by the CLI and the
+    Streamlit pages. A file is re-read only when its mtime or size changes, and re-parsed
+    only when its content hash changes too; every caller gets the same snapshot object.
+    """
+
+    def __init__(self):
+        self._snapshots: Dict[Tuple[str, str], FileSnapshot] = {}
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.parses = 0
+
+    def get(self, path: str, parse: Callable[[str], Any], default: Any = None, kind: str = "text") -> Any:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return default
+        key = (path, kind)
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot and (snapshot.mtime_ns, snapshot.size) == (stat.st_mtime_ns, stat.st_size):
+                return snapshot.value
+
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            self.reads += 1
+            digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            if snapshot and snapshot.digest == digest:
+                value = snapshot.value
+            else:
+                try:
+                    value = freeze(parse(text))
+                except Exception as e:
+                    print(f"Error loading {path}: {e}")
+                    return default
+                self.parses += 1
+            self._snapshots[key] = FileSnapshot(stat.st_mtime_ns, stat.st_size, digest, value)
+            return value
+
+    def stats(self) -> str:
+        return f"{len(self._snapshots)} files, {self.reads} reads, {self.parses} parses"
+
+CONFIG_STORE = ConfigStore()
+
+def load_text_file(path: str) -> str:
+    """Markdown/text config (common rules, parts lists, instructions/*.md); "" if missing."""
+    return CONFIG_STORE.get(path, lambda text: text, default="")
+
+def load_json_file(path: str) -> Mapping:
+    """JSON config as a frozen snapshot; empty mapping if missing or invalid."""
+    return CONFIG_STORE.get(path, json.loads, default=MappingProxyType({}), kind="json")
+
+def load_prompts() -> Mapping:
+    """Prompt sets per article type (config/prompts.json)."""
+    return load_json_file(PROMPTS_FILE)
+
+def load_common_rules() -> str:
+    """Common rules edited in Site Config (config/common_rules.md)."""
+    return load_text_file(RULES_FILE)
+
+def load_sites_config() -> Mapping:
+    """Loads the WordPress sites configuration from sites.json."""
+    # Try Streamlit Secrets first (for Cloud)
+    # Try Streamlit Secrets first (for Cloud)
+    try:
+        import streamlit as st
+        # Accessing st.secrets may raise FileNotFoundError or StreamlitSecretNotFoundError if no secrets.toml
+        if hasattr(st, "secrets") and "sites_config" in st.secrets:
+            return freeze(dict(st.secrets["sites_config"]))
+    except (ImportError, Exception):
+        # Fallback to local file if streamlit is not installed or secrets are missing
+        pass
+
+    # Fallback to local file
+    return load_json_file(CONFIG_FILE)
+
+# Settings a run manifest may give per sheet (they override the run's own; see main.process_batch)
+MANIFEST_SHEET_OPTIONS = ("dry_run", "resume", "regenerate", "history_budget", "validate_drafts", "use_context_cache")
+
+def load_manifest(path: str) -> List[Dict[str, Any]]:
+    """
+    Reads a multi-sheet run manifest (JSON) and returns one entry per worksheet:
+    {"sheet_url", "sheet_name", "label", **options}.
+        {"sheets": [
+            {"url": "https://docs.google.com/spreadsheets/d/...", "tabs": ["1月", "2月"], "label": "client-a"},
+            {"url": "https://docs.google.com/spreadsheets/d/...", "resume": true}
+        ]}
+    "tabs" may be omitted (first worksheet) and the file may hold just the list.
+    Raises ValueError for a malformed manifest.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    sheets = manifest.get("sheets") if isinstance(manifest, dict) else manifest
+    if not isinstance(sheets, list) or not sheets:
+        raise ValueError(f"{path}: expected a non-empty \"sheets\" list")
+
+    entries = []
+    seen = set()
+    for i, sheet in enumerate(sheets):
+        if isinstance(sheet, str):
+            sheet = {"url": sheet}
+        if not isinstance(sheet, dict) or not sheet.get("url"):
+            raise ValueError(f"{path}: sheet #{i + 1} has no \"url\"")
+        unknown = set(sheet) - {"url", "tabs", "label"} - set(MANIFEST_SHEET_OPTIONS)
+        if unknown:
+            raise ValueError(f"{path}: sheet #{i + 1} has unknown settings: {', '.join(sorted(unknown))}")
+        tabs = sheet.get("tabs") or [None]
+        if isinstance(tabs, str):
+            tabs = [tabs]
+        match = re.search(r"/d/([\w-]+)", sheet["url"])
+        base_label = sheet.get("label") or (match.group(1)[:8] if match else f"sheet{i + 1}")
+        for tab in tabs:
+            key = (sheet["url"], tab)
+            if key in seen:
+                raise ValueError(f"{path}: {sheet['url']} {tab or '(first tab)'} is listed twice")
+            seen.add(key)
+            entry = {"sheet_url": sheet["url"], "sheet_name": tab, "label": f"{base_label}/{tab}" if tab else base_label}
+            entry.update({name: sheet[name] for name in MANIFEST_SHEET_OPTIONS if name in sheet})
+            entries.append(entry)
+    return entries
+
+def get_gemini_api_key() -> str:
+    """Retrieves the Gemini API key from environment variables."""
+    return os.getenv("GEMINI_API_KEY", "")
+
+def get_gemini_rate_limits() -> Tuple[int, int]:
+    """
+    Retrieves the Gemini quota (requests/min, tokens/min) from environment variables.
+    0 means unlimited (only 429 backoff applies).
+    """
+    def read_int(name):
+        try:
+            return int(os.getenv(name, "0") or 0)
+        except ValueError:
+            print(f"Warning: {name} is not an integer; ignoring.")
+            return 0
+    return read_int("GEMINI_RPM"), read_int("GEMINI_TPM")
+
+def load_sheets_credentials() -> Any:
+    """
+    Retrieves Google Sheets credentials.
+    Returns:
+        - Dict: If found in Streamlit Secrets (for Cloud).
+        - Str: Path to service_account.json (for Local).
+        - None: If neither found.
+    """
+    # 1. Try Streamlit Secrets
+    try:
+        import streamlit as st
+        if hasattr(st, "secrets") and "gcp_service_account" in st.secrets:
+            # st.secrets returns a special AttrDict, convert to standard dict for gspread
+            return dict(st.secrets["gcp_service_account"])
+    except (ImportError, Exception):
+        pass
+
+    # 2. Try Local File
+    creds_path = os.getenv("GOOGLE_SHEETS_CREDENTIALS_PATH", "service_account.json")
+    if os.path.exists(creds_path):
+        return creds_path
+    
+    return None
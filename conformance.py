@@ -0,0 +1,109 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Pattern, Set, Tuple
+
+# Custom tags the model may emit; _post_process_html rewrites them to <div class="...">
+CUSTOM_TAG_CLASSES = {
+    "numlist": "numlist",
+    "normalBox": "normalBox",
+    "flow": "flow",
+    "qa-box01": "qa-box01",
+}
+
+# Structural tags that are always fine inside the parts (rows, list items, inline text)
+BASE_TAGS = {"p", "a", "br", "strong", "em", "b", "span", "li", "tr", "th", "td", "thead", "tbody", "img", "div"}
+
+TAG_PATTERN = re.compile(r"<([a-zA-Z][\w-]*)([^>]*)>")
+CLASS_PATTERN = re.compile(r'class\s*=\s*"([^"]*)"')
+P_CLASS_PATTERN = re.compile(r'<p\s+[^>]*class\s*=')
+PLACEHOLDER_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+# What a {{placeholder}} inside a parts-list class stands for (others: any class-name characters)
+PLACEHOLDER_VALUES = {
+    "num": r"\d+",
+}
+
+
+class ConformanceValidator:
+    """
+    Mechanical checks of a draft's HTML against the site's parts list (parts_*.md) and the
+    rules _post_process_html would otherwise patch up afterwards:
+    - only tags and classes that appear in the parts list (plus the custom tags it rewrites);
+      a class with a placeholder such as ranking-icon_{{num}} allows ranking-icon_1, ranking-icon_2, ...
+    - no <p class="..."> (classes on <p> are stripped on publish)
+    - no Markdown ** (bold must use the parts' decoration classes)
+    validate() returns human-readable violations; an empty list means the draft conforms.
+    """
+
+    def __init__(self, parts_text: str):
+        self.allowed_tags, self.allowed_classes, self.class_patterns = self._parse_parts(parts_text)
+
+    @staticmethod
+    def _parse_parts(parts_text: str) -> Tuple[Set[str], Set[str], List[Pattern]]:
+        tags = set(BASE_TAGS) | set(CUSTOM_TAG_CLASSES)
+        classes = set(CUSTOM_TAG_CLASSES.values())
+        templates = set()
+        for name, attributes in TAG_PATTERN.findall(parts_text):
+            tags.add(name)
+            for value in CLASS_PATTERN.findall(attributes):
+                for css_class in value.split():
+                    (templates if PLACEHOLDER_PATTERN.search(css_class) else classes).add(css_class)
+        patterns = [re.compile(ConformanceValidator._template_regex(template)) for template in sorted(templates)]
+        return tags, classes, patterns
+
+    @staticmethod
+    def _template_regex(template: str) -> str:
+        """ranking-icon_{{num}} -> ranking-icon_\\d+ (the literal parts escaped, anchored by fullmatch)."""
+        regex = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(template):
+            regex.append(re.escape(template[position:match.start()]))
+            regex.append(PLACEHOLDER_VALUES.get(match.group(1), r"[\w-]+"))
+            position = match.end()
+        regex.append(re.escape(template[position:]))
+        return "".join(regex)
+
+    def class_allowed(self, css_class: str) -> bool:
+        return css_class in self.allowed_classes or any(p.fullmatch(css_class) for p in self.class_patterns)
+
+    def validate(self, html: str) -> List[str]:
+        violations = []
+        bold_count = html.count("**") // 2
+        if bold_count:
+            violations.append(f"Markdown の ** が {bold_count} 箇所あります（文字装飾はパーツの span クラスを使用）")
+        p_class_count = len(P_CLASS_PATTERN.findall(html))
+        if p_class_count:
+            violations.append(f'<p class="..."> が {p_class_count} 箇所あります（p タグに class は付けない）')
+
+        unknown_tags = []
+        unknown_classes = []
+        for name, attributes in TAG_PATTERN.findall(html):
+            if name not in self.allowed_tags and name not in unknown_tags:
+                unknown_tags.append(name)
+            for value in CLASS_PATTERN.findall(attributes):
+                for css_class in value.split():
+                    if not self.class_allowed(css_class) and css_class not in unknown_classes:
+                        unknown_classes.append(css_class)
+        if unknown_tags:
+            violations.append("パーツリストにないタグ: " + ", ".join(f"<{name}>" for name in unknown_tags))
+        if unknown_classes:
+            violations.append("パーツリストにないクラス: " + ", ".join(unknown_classes))
+        return violations
+
+
+_validators: "OrderedDict[str, ConformanceValidator]" = OrderedDict()
+_validators_lock = threading.Lock()
+
+def get_validator(parts_text: str) -> ConformanceValidator:
+    """Validator for a parts list, built once per distinct content (parts come from config snapshots)."""
+    digest = hashlib.sha256(parts_text.encode("utf-8")).hexdigest()
+    with _validators_lock:
+        validator = _validators.get(digest)
+        if validator is None:
+            validator = ConformanceValidator(parts_text)
+            _validators[digest] = validator
+            if len(_validators) > 16:
+                _validators.popitem(last=False)
+        return validator
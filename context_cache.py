@@ -0,0 +1,164 @@
+import abc
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from events import run_log
+
+
+class ContextCacheBackend(abc.ABC):
+    """
+    Interface for registering the shared system-instruction prefix once and
+    reusing it from every chat.
+    get_model() returns a model (anything with start_chat) bound to the cached prefix,
+    or None when caching is unavailable; AIHandler then falls back to its plain model.
+    """
+
+    @abc.abstractmethod
+    def get_model(self, key: str, model_name: str, system_instruction: str, safety_settings: List[Dict[str, str]]) -> Optional[Any]:
+        ...
+
+
+class TTLContextCache(ContextCacheBackend):
+    """
+    One cache entry per instruction bundle key: a changed instruction hashes to a new key
+    and gets its own entry. Entries are extended before they expire; creation failures
+    (unsupported model, prefix below the minimum token count, quota) are remembered for
+    retry_after seconds so rows don't retry on every call.
+    Entries are created outside the lock; concurrent rows asking for a key being created
+    wait for that creation instead of uploading the prefix again.
+    Subclasses implement _create, _extend and _delete.
+    """
+
+    def __init__(self, ttl_seconds: int = 3600, refresh_margin: int = 300, retry_after: int = 600):
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._failures: Dict[str, float] = {}
+        self._creating: Dict[str, threading.Event] = {}  # key -> set when its creation/extension ends
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @abc.abstractmethod
+    def _create(self, key, model_name, system_instruction, safety_settings):
+        """Registers the prefix; returns (cached content handle, model bound to it)."""
+
+    @abc.abstractmethod
+    def _extend(self, cached):
+        """Extends a live entry by ttl_seconds."""
+
+    @abc.abstractmethod
+    def _delete(self, cached):
+        """Deletes an entry."""
+
+    def get_model(self, key, model_name, system_instruction, safety_settings):
+        while True:
+            with self._lock:
+                now = time.time()
+                failed_at = self._failures.get(key)
+                if failed_at and now - failed_at < self.retry_after:
+                    return None
+
+                entry = self._entries.get(key)
+                if entry and now < entry["expires_at"] - self.refresh_margin:
+                    self.hits += 1
+                    return entry["model"]
+
+                pending = self._creating.get(key)
+                if pending is None:
+                    # This thread creates (or extends) the entry
+                    live = entry if entry and now < entry["expires_at"] else None
+                    self._creating[key] = threading.Event()
+                    break
+            pending.wait()
+
+        try:
+            if live:
+                # Still alive: extend instead of uploading the prefix again
+                self._extend(live["cached"])
+                cached, model = live["cached"], live["model"]
+            else:
+                cached, model = self._create(key, model_name, system_instruction, safety_settings)
+            with self._lock:
+                self._entries[key] = {"cached": cached, "model": model, "expires_at": now + self.ttl_seconds}
+                self._failures.pop(key, None)
+                if live:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            return model
+        except Exception as e:
+            run_log(f"[Gemini] Context caching unavailable, sending the full system instruction instead: {e}")
+            with self._lock:
+                self._entries.pop(key, None)
+                self._failures[key] = now
+            return None
+        finally:
+            with self._lock:
+                self._creating.pop(key).set()
+
+    def clear(self):
+        """Deletes every cache entry created by this backend."""
+        with self._lock:
+            entries, self._entries, self._failures = self._entries, {}, {}
+        for entry in entries.values():
+            try:
+                self._delete(entry["cached"])
+            except Exception as e:
+                run_log(f"Error deleting context cache: {e}")
+
+    def stats(self) -> str:
+        return f"{self.hits} hits / {self.misses} misses ({len(self._entries)} cached)"
+
+
+class GeminiContextCache(TTLContextCache):
+    """Gemini explicit context caching (google.generativeai.caching.CachedContent)."""
+
+    def _create(self, key, model_name, system_instruction, safety_settings):
+        import google.generativeai as genai
+        from google.generativeai import caching
+
+        run_log(f"[Gemini] Creating context cache for system instruction ({len(system_instruction)} chars, TTL {self.ttl_seconds}s)...")
+        cached = caching.CachedContent.create(
+            model=model_name,
+            display_name=f"prompt-writer-{key[:12]}",
+            system_instruction=system_instruction,
+            ttl=self.ttl_seconds,
+        )
+        return cached, genai.GenerativeModel.from_cached_content(cached, safety_settings=safety_settings)
+
+    def _extend(self, cached):
+        cached.update(ttl=self.ttl_seconds)
+
+    def _delete(self, cached):
+        cached.delete()
+
+
+class LocalContextCache(TTLContextCache):
+    """
+    Offline stand-in for GeminiContextCache (tests, benchmarks): same entry, TTL and failure
+    handling, but an "entry" is just a model built by model_factory (see AIHandler).
+    created lists the keys registered, in order.
+    """
+
+    def __init__(self, model_factory, **kwargs):
+        super().__init__(**kwargs)
+        self.model_factory = model_factory
+        self.created: List[str] = []
+
+    def _create(self, key, model_name, system_instruction, safety_settings):
+        model = self.model_factory(model_name=model_name, system_instruction=system_instruction, safety_settings=safety_settings)
+        self.created.append(key)
+        return key, model
+
+    def _extend(self, cached):
+        pass
+
+    def _delete(self, cached):
+        pass
+
+
+# Shared backend: one cache entry per instruction bundle for the whole process
+GEMINI_CONTEXT_CACHE = GeminiContextCache()
@@ -0,0 +1,230 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, NamedTuple, Optional
+
+from metrics import current_scope
+
+# Event kinds
+LOG = "log"                      # free-form message
+ROW_STARTED = "row_started"      # a pending row was taken
+ROW_STATUS = "row_status"        # the row's sheet status changed (message = status text)
+STEP_STARTED = "step_started"    # a flow step was sent to Gemini
+STEP_FINISHED = "step_finished"  # data: duration, tokens, calls
+RETRY = "retry"                  # data: attempt, delay, error
+WRITE_FLUSHED = "write_flushed"  # data: cells (one sheet batchUpdate request)
+ROW_DONE = "row_done"            # the row was recorded as 完了
+
+
+class Event(NamedTuple):
+    kind: str
+    message: str = ""
+    row: Any = None
+    step: Optional[str] = None
+    data: Optional[Dict[str, Any]] = None
+    ts: float = 0.0
+
+    def format(self) -> str:
+        """The text line log_callback used to receive ("[Row 12] Status Update: ...")."""
+        message = f"Status Update: {self.message}" if self.kind == ROW_STATUS else self.message
+        if self.row is None:
+            return message
+        # Keep leading blank lines in front of the tag so the output layout doesn't change
+        stripped = message.lstrip("\n")
+        return f"{message[:len(message) - len(stripped)]}[Row {self.row}] {stripped}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        record = {"ts": self.ts, "kind": self.kind}
+        if self.row is not None:
+            record["row"] = self.row
+        if self.step is not None:
+            record["step"] = self.step
+        if self.message:
+            record["message"] = self.message
+        if self.data:
+            record["data"] = self.data
+        return record
+
+    @classmethod
+    def from_dict(cls, record: Dict[str, Any]) -> "Event":
+        return cls(record.get("kind", LOG), record.get("message", ""), record.get("row"), record.get("step"),
+                   record.get("data"), record.get("ts", 0.0))
+
+
+class EventBus:
+    """
+    Publishes events to every sink (objects with handle(event)). Dispatch is serialized by a
+    lock, so sinks may be fed from worker threads; a failing sink never breaks the run.
+    Every sink does O(1) work per event (append, counter update, throttled render).
+    """
+
+    def __init__(self, sinks: Iterable = ()):
+        self.sinks = list(sinks)
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def publish(self, event: Event):
+        if not event.ts:
+            event = event._replace(ts=time.time())
+        with self._lock:
+            for sink in self.sinks:
+                try:
+                    sink.handle(event)
+                except Exception as e:
+                    print(f"Event sink {type(sink).__name__} failed: {e}")
+
+    def emit(self, kind: str, message: str = "", row=None, step: Optional[str] = None, **data):
+        self.publish(Event(kind, message, row, step, data or None))
+
+    def log(self, message: str):
+        """Drop-in log_callback."""
+        self.publish(Event(LOG, message))
+
+    def for_row(self, row, publish: Optional[Callable[[Event], None]] = None) -> "RowEmitter":
+        return RowEmitter(publish or self.publish, row)
+
+
+class RowEmitter:
+    """
+    Row-scoped emitter handed to pipeline stages. Calling it logs a message (so it still works
+    wherever a log_callback is expected); emit() publishes a typed event for the row.
+    """
+
+    __slots__ = ("publish", "row")
+
+    def __init__(self, publish: Callable[[Event], None], row):
+        self.publish = publish
+        self.row = row
+
+    def __call__(self, message: str):
+        self.publish(Event(LOG, message, self.row, ts=time.time()))
+
+    def emit(self, kind: str, message: str = "", step: Optional[str] = None, **data):
+        self.publish(Event(kind, message, self.row, step, data or None, time.time()))
+
+
+# Bus of the run in progress, for code that has no log_callback (handlers, caches, the sheet
+# flusher thread); threads started through metrics.in_context inherit it
+_current_bus: contextvars.ContextVar = contextvars.ContextVar("event_bus", default=None)
+
+
+@contextmanager
+def publishing_to(bus: EventBus):
+    """run_log messages made inside the block (and in contexts copied from it) go to bus."""
+    token = _current_bus.set(bus)
+    try:
+        yield bus
+    finally:
+        _current_bus.reset(token)
+
+
+def run_log(message: str, step: Optional[str] = None, **data):
+    """LOG event on the current run's bus, tagged with the row in progress; printed outside a run."""
+    bus = _current_bus.get()
+    if bus is None:
+        print(message)
+        return
+    bus.emit(LOG, message, row=current_scope().get("row"), step=step, **data)
+
+
+class CallbackSink:
+    """Feeds the legacy text lines to a log_callback; events without a message are metrics only."""
+
+    def __init__(self, callback: Callable[[str], None]):
+        self.callback = callback
+
+    def handle(self, event: Event):
+        if event.message:
+            self.callback(event.format())
+
+
+class ConsoleSink(CallbackSink):
+    def __init__(self):
+        super().__init__(print)
+
+
+class JsonlSink:
+    """Appends one JSON object per event to path (kept open; flushed per line so tail -f works)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def handle(self, event: Event):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(event.to_dict(), ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class StreamlitSink:
+    """
+    Incremental Streamlit view: handle() only appends to a bounded window of lines and updates
+    the row's status; the placeholders are redrawn at most once per min_interval seconds and
+    only the last max_lines lines are drawn, so UI cost stays flat however long the run is.
+    Call render(force=True) once at the end. Must be driven from the script thread.
+    """
+
+    def __init__(self, log_placeholder, status_placeholder=None, preview_placeholder=None,
+                 min_interval: float = 0.5, max_lines: int = 300):
+        self.log_placeholder = log_placeholder
+        self.status_placeholder = status_placeholder
+        self.preview_placeholder = preview_placeholder
+        self.min_interval = min_interval
+        self.lines = deque(maxlen=max_lines)
+        self.rows: "OrderedDict[Any, str]" = OrderedDict()
+        self.latest_status = ""
+        self.preview = None
+        self._dirty = False
+        self._rendered_at = 0.0
+
+    def handle(self, event: Event):
+        if event.message:
+            self.lines.append(event.format())
+        if event.kind in (ROW_STARTED, ROW_STATUS, ROW_DONE) and event.row is not None:
+            self.rows[event.row] = "完了" if event.kind == ROW_DONE else event.message if event.kind == ROW_STATUS else "処理中"
+            self.latest_status = f"[Row {event.row}] {self.rows[event.row]}"
+        self._dirty = True
+        self.render()
+
+    def chunk(self, row_idx, label, text):
+        """Live partial output of the step currently streaming (same throttle)."""
+        if self.preview_placeholder is None:
+            return
+        if self.preview is None or self.preview[:2] != (row_idx, label):
+            self.preview = (row_idx, label, "")
+        self.preview = (row_idx, label, (self.preview[2] + text)[-3000:])
+        self._dirty = True
+        self.render()
+
+    def set_preview(self, preview):
+        """Replaces the preview with a (row, label, text) tuple kept elsewhere (e.g. by a Job)."""
+        if preview != self.preview:
+            self.preview = preview
+            self._dirty = True
+
+    def render(self, force: bool = False):
+        now = time.monotonic()
+        if not self._dirty or (not force and now - self._rendered_at < self.min_interval):
+            return
+        self._rendered_at = now
+        self._dirty = False
+        self.log_placeholder.code("\n".join(self.lines), language="text")
+        if self.status_placeholder is not None and self.latest_status:
+            self.status_placeholder.info(self.latest_status)
+        if self.preview_placeholder is not None and self.preview:
+            row_idx, label, text = self.preview
+            self.preview_placeholder.code(f"[Row {row_idx}] {label}\n\n{text}", language="html")
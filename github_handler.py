@@ -1,71 +1,155 @@
-import requests
-import base64
-import json
-
-class GitHubHandler:
-    def __init__(self, token, repo_name):
-        """
-        Args:
-            token: GitHub Personal Access Token (repo scope)
-            repo_name: "username/repo" string
-        """
-        self.token = token
-        self.repo_name = repo_name
-        self.base_url = f"https://api.github.com/repos/{repo_name}/contents"
-
-    def get_file_sha(self, file_path):
-        """Gets the SHA of a file to allow updates."""
-        try:
-            url = f"{self.base_url}/{file_path}"
-            headers = {
-                "Authorization": f"token {self.token}",
-                "Accept": "application/vnd.github.v3+json"
-            }
-            response = requests.get(url, headers=headers)
-            if response.status_code == 200:
-                return response.json().get("sha")
-            return None
-        except Exception as e:
-            print(f"Error getting SHA: {e}")
-            return None
-
-    def commit_file(self, file_path, content, message="Update config via Streamlit App"):
-        """
-        Commits a file to the repository.
-        Args:
-            file_path: Relative path in repo (e.g., "config/prompts.json")
-            content: String content to write
-            message: Commit message
-        """
-        try:
-            url = f"{self.base_url}/{file_path}"
-            headers = {
-                "Authorization": f"token {self.token}",
-                "Accept": "application/vnd.github.v3+json"
-            }
-            
-            # 1. Get current SHA (if exists)
-            sha = self.get_file_sha(file_path)
-            
-            # 2. Prepare payload
-            # Content must be base64 encoded
-            content_bytes = content.encode("utf-8")
-            base64_content = base64.b64encode(content_bytes).decode("utf-8")
-            
-            data = {
-                "message": message,
-                "content": base64_content
-            }
-            if sha:
-                data["sha"] = sha
-                
-            # 3. Send PUT request
-            response = requests.put(url, headers=headers, json=data)
-            
-            if response.status_code in [200, 201]:
-                return True, "Success"
-            else:
-                return False, f"GitHub API Error: {response.status_code} - {response.text}"
-                
-        except Exception as e:
-            return False, f"Exception: {e}"
+import requests
+import hashlib
+import threading
+from metrics import instrument_session
+
+# Branch head per (api root, repo, branch): {"commit", "tree", "blobs": {path: blob sha}}.
+# Shared by handler instances (pages create one per click); refreshed when a ref update is rejected.
+_heads = {}
+_default_branches = {}
+_heads_lock = threading.Lock()
+
+def git_blob_sha(content):
+    """SHA git assigns to a blob with this content (lets unchanged files be skipped locally)."""
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+class GitHubHandler:
+    def __init__(self, token, repo_name, branch=None, api_root="https://api.github.com"):
+        """
+        Args:
+            token: GitHub Personal Access Token (repo scope)
+            repo_name: "username/repo" string
+            branch: Branch to commit to (default: the repository's default branch)
+            api_root: API base URL (a local stub in tests)
+        """
+        self.token = token
+        self.repo_name = repo_name
+        self.branch = branch
+        self.api_root = api_root.rstrip("/")
+        self.repo_url = f"{self.api_root}/repos/{repo_name}"
+        self.base_url = f"{self.repo_url}/contents"
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"token {self.token}",
+            "Accept": "application/vnd.github.v3+json"
+        })
+        instrument_session(self.session, "github")
+
+    def get_file_sha(self, file_path):
+        """Gets the SHA of a file to allow updates."""
+        try:
+            url = f"{self.base_url}/{file_path}"
+            response = self.session.get(url, timeout=30)
+            if response.status_code == 200:
+                return response.json().get("sha")
+            return None
+        except Exception as e:
+            print(f"Error getting SHA: {e}")
+            return None
+
+    def commit_file(self, file_path, content, message="Update config via Streamlit App"):
+        """
+        Commits a file to the repository.
+        Args:
+            file_path: Relative path in repo (e.g., "config/prompts.json")
+            content: String content to write
+            message: Commit message
+        """
+        return self.commit_files({file_path: content}, message)
+
+    def commit_files(self, files, message="Update config via Streamlit App"):
+        """
+        Writes several files as one commit through the Git Data API:
+        branch head (cached) -> tree with inline contents -> commit -> fast-forward ref.
+        Files whose content matches the head's blob (compared by locally computed git SHA)
+        are left out; if nothing changed, no commit is made (a cached head is first checked
+        against the branch ref, so a change made elsewhere is not mistaken for "No changes").
+        Args:
+            files: {repo path: string content}
+            message: Commit message
+        Returns (success, message) like commit_file.
+        """
+        try:
+            for attempt in range(2):
+                head, cached = self._branch_head(refresh=attempt > 0)
+                changed = {path: content for path, content in files.items()
+                           if head["blobs"].get(path) != git_blob_sha(content)}
+                if not changed:
+                    if cached and self._ref_sha() != head["commit"]:
+                        # Branch moved since our cached head; compare against the new head
+                        continue
+                    return True, "No changes"
+
+                tree = self._post("git/trees", {
+                    "base_tree": head["tree"],
+                    "tree": [{"path": path, "mode": "100644", "type": "blob", "content": content}
+                             for path, content in changed.items()]
+                })
+                commit = self._post("git/commits", {
+                    "message": message,
+                    "tree": tree["sha"],
+                    "parents": [head["commit"]]
+                })
+                response = self.session.patch(f"{self.repo_url}/git/refs/heads/{self._branch_name()}",
+                                              json={"sha": commit["sha"]}, timeout=30)
+                if response.status_code == 422 and attempt == 0:
+                    # Branch moved since our cached head (another save); rebase onto the new head once
+                    continue
+                if response.status_code != 200:
+                    return False, f"GitHub API Error: {response.status_code} - {response.text}"
+
+                with _heads_lock:
+                    head["commit"] = commit["sha"]
+                    head["tree"] = tree["sha"]
+                    head["blobs"].update({path: git_blob_sha(content) for path, content in changed.items()})
+                return True, f"Success ({len(changed)} files, {len(files) - len(changed)} unchanged)"
+            return False, "GitHub API Error: branch head kept moving"
+        except Exception as e:
+            return False, f"Exception: {e}"
+
+    def _branch_name(self):
+        if not self.branch:
+            key = (self.api_root, self.repo_name)
+            if key not in _default_branches:
+                response = self.session.get(self.repo_url, timeout=30)
+                response.raise_for_status()
+                _default_branches[key] = response.json()["default_branch"]
+            self.branch = _default_branches[key]
+        return self.branch
+
+    def _ref_sha(self):
+        """Commit the branch ref points at now (1 request)."""
+        response = self.session.get(f"{self.repo_url}/git/ref/heads/{self._branch_name()}", timeout=30)
+        response.raise_for_status()
+        return response.json()["object"]["sha"]
+
+    def _branch_head(self, refresh=False):
+        """
+        (head, cached): head commit, root tree and blob SHAs of the branch (2 requests, then cached);
+        cached is True when the head came from the cache and may be stale.
+        """
+        key = (self.api_root, self.repo_name, self._branch_name())
+        with _heads_lock:
+            head = _heads.get(key)
+        if head is not None and not refresh:
+            return head, True
+
+        response = self.session.get(f"{self.repo_url}/branches/{self.branch}", timeout=30)
+        response.raise_for_status()
+        commit = response.json()["commit"]
+        tree_sha = commit["commit"]["tree"]["sha"]
+        response = self.session.get(f"{self.repo_url}/git/trees/{tree_sha}", params={"recursive": "1"}, timeout=30)
+        response.raise_for_status()
+        blobs = {entry["path"]: entry["sha"] for entry in response.json().get("tree", []) if entry.get("type") == "blob"}
+
+        head = {"commit": commit["sha"], "tree": tree_sha, "blobs": blobs}
+        with _heads_lock:
+            _heads[key] = head
+        return head, False
+
+    def _post(self, path, payload):
+        response = self.session.post(f"{self.repo_url}/{path}", json=payload, timeout=30)
+        if response.status_code not in (200, 201):
+            raise RuntimeError(f"GitHub API Error: {response.status_code} - {response.text}")
+        return response.json()
@@ -0,0 +1,252 @@
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from events import Event, EventBus, JsonlSink, LOG, ROW_STARTED, ROW_STATUS, ROW_DONE
+
+# Job states; "interrupted" = the process running the job went away before it finished
+ACTIVE_STATES = ("queued", "running", "cancelling")
+FINAL_STATES = ("completed", "failed", "cancelled", "interrupted")
+
+# Log events kept in memory per job (the full log is in events.jsonl)
+MEMORY_EVENTS = 2000
+
+# Row progress is persisted at most this often (state transitions are saved at once)
+STATE_SAVE_INTERVAL = 1.0
+
+
+class Job:
+    """
+    One background run, and the event sink of its EventBus. State is persisted to
+    <root>/<id>/state.json and every event is appended to <root>/<id>/events.jsonl, so a job
+    can be inspected after the page (or the whole app) reloads. Each event has a sequence
+    number (seq) so viewers can fetch only what is new. cancel() only sets cancel_event;
+    the run stops between steps.
+    """
+
+    def __init__(self, root: str, job_id: str, label: str = "", params: Optional[Dict[str, Any]] = None):
+        self.id = job_id
+        self.dir = os.path.join(root, job_id)
+        self.label = label
+        self.params = params or {}
+        self.status = "queued"
+        self.error = ""
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.rows: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # row index -> {"status", "updated_at"}
+        self.events = deque(maxlen=MEMORY_EVENTS)  # (seq, Event)
+        self.event_count = 0
+        self.events_file = JsonlSink(os.path.join(self.dir, "events.jsonl"))
+        self.preview = None  # (row, label, text) of the step currently streaming (memory only)
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self.status in ACTIVE_STATES
+
+    def handle(self, event: Event):
+        """Sink for the run's EventBus: records the event and the row's latest status."""
+        with self._lock:
+            self.events.append((self.event_count, event))
+            self.event_count += 1
+            self.events_file.handle(event)
+            if event.row is None or event.kind not in (ROW_STARTED, ROW_STATUS, ROW_DONE):
+                return
+            row = str(event.row)
+            status = "完了" if event.kind == ROW_DONE else event.message if event.kind == ROW_STATUS else "処理中"
+            self.rows[row] = {"status": status, "updated_at": event.ts}
+            self._save_state(force=False)
+
+    def log(self, message: str):
+        self.handle(Event(LOG, message, ts=time.time()))
+
+    def chunk(self, row_idx, label, text):
+        """chunk_callback for process_batch: keeps the tail of the step being streamed."""
+        with self._lock:
+            if self.preview is None or self.preview[:2] != (row_idx, label):
+                self.preview = (row_idx, label, "")
+            self.preview = (row_idx, label, (self.preview[2] + text)[-3000:])
+
+    def cancel(self):
+        with self._lock:
+            if self.status in ("queued", "running"):
+                self.status = "cancelling"
+                self.cancel_event.set()
+                self._save_state()
+
+    def tail(self, count: int = 500) -> List[Event]:
+        """Latest events (from memory, or from events.jsonl for a job loaded from disk)."""
+        with self._lock:
+            if self.events:
+                return [event for _seq, event in list(self.events)[-count:]]
+        try:
+            with open(os.path.join(self.dir, "events.jsonl"), "r", encoding="utf-8") as f:
+                lines = deque(f, maxlen=count)
+        except OSError:
+            return []
+        return [Event.from_dict(json.loads(line)) for line in lines if line.strip()]
+
+    def events_since(self, seq: int):
+        """(events numbered seq and later still in memory, next seq); only the new ones are copied."""
+        with self._lock:
+            new = min(self.event_count - seq, len(self.events))
+            events = [self.events[i][1] for i in range(len(self.events) - new, len(self.events))] if new > 0 else []
+            return events, self.event_count
+
+    def set_status(self, status: str, error: str = "") -> bool:
+        """True once the new state is in state.json."""
+        with self._lock:
+            self.status = status
+            self.error = error
+            now = time.time()
+            if status == "running":
+                self.started_at = now
+            elif status in FINAL_STATES:
+                self.finished_at = now
+                self.events_file.close()
+            return self._save_state()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "label": self.label,
+            "params": self.params,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "rows": self.rows,
+            "event_count": self.event_count,
+        }
+
+    @classmethod
+    def load(cls, root: str, job_id: str) -> Optional["Job"]:
+        try:
+            with open(os.path.join(root, job_id, "state.json"), "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        job = cls(root, job_id, state.get("label", ""), state.get("params"))
+        job.status = state.get("status", "interrupted")
+        job.error = state.get("error", "")
+        job.created_at = state.get("created_at", job.created_at)
+        job.started_at = state.get("started_at")
+        job.finished_at = state.get("finished_at")
+        job.rows = OrderedDict(state.get("rows", {}))
+        job.event_count = state.get("event_count", 0)
+        return job
+
+    def _save_state(self, force: bool = True) -> bool:
+        now = time.monotonic()
+        if not force and now - self._saved_at < STATE_SAVE_INTERVAL:
+            return False
+        self._saved_at = now
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            path = os.path.join(self.dir, "state.json")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+            os.replace(path + ".tmp", path)
+            return True
+        except OSError as e:
+            print(f"Job {self.id}: failed to persist state: {e}")
+            return False
+
+
+class JobRunner:
+    """
+    Runs batch jobs on background threads of the app process, so a run no longer lives in
+    (and dies with) a Streamlit script run or browser session. The module-level JOB_RUNNER
+    survives page reruns; pages keep only the job id and reattach with get().
+    Jobs left active on disk by a previous process are marked "interrupted" when listed.
+    Only queued and running jobs are held in memory: a finished job is dropped once its final
+    state is saved, and get() reads it back from disk.
+    """
+
+    def __init__(self, root: str = "data/jobs", max_jobs: int = 1):
+        self.root = root
+        self.max_jobs = max_jobs
+        self._jobs: Dict[str, Job] = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, target: Callable, label: str = "", params: Optional[Dict[str, Any]] = None, **kwargs) -> Job:
+        """
+        Queues target(**kwargs, events=<bus feeding the job>, cancel_event=job.cancel_event), with
+        chunk_callback=job.chunk when kwargs has stream=True (process_batch's signature).
+        Call metrics go to <job dir>/metrics.jsonl unless metrics_jsonl is given.
+        params is stored with the job for display; never put secrets in it.
+        """
+        job = Job(self.root, time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:6], label, params)
+        with self._lock:
+            # Registered before its state.json exists, so get() never loads it as a job of a dead process
+            self._jobs[job.id] = job
+        job.set_status("queued")
+        kwargs.update(events=EventBus([job]), cancel_event=job.cancel_event)
+        kwargs.setdefault("metrics_jsonl", os.path.join(job.dir, "metrics.jsonl"))
+        if kwargs.get("stream"):
+            kwargs["chunk_callback"] = job.chunk
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix="job")
+            self._executor.submit(self._run, job, target, kwargs)
+        return job
+
+    def _run(self, job: Job, target: Callable, kwargs: Dict[str, Any]):
+        if job.cancel_event.is_set():
+            self._finish(job, "cancelled")
+            return
+        job.set_status("running")
+        try:
+            target(**kwargs)
+        except Exception as e:
+            job.log(f"Job failed: {e}\n{traceback.format_exc()}")
+            self._finish(job, "failed", str(e))
+            return
+        self._finish(job, "cancelled" if job.cancel_event.is_set() else "completed")
+
+    def _finish(self, job: Job, status: str, error: str = ""):
+        """Final state; a job whose state.json could not be written stays in memory."""
+        if job.set_status(status, error):
+            with self._lock:
+                self._jobs.pop(job.id, None)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Live job of this process, or the persisted record of an older one."""
+        if not job_id:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        job = Job.load(self.root, job_id)
+        if job is None:
+            return None
+        if job.active:
+            # Its worker thread belonged to a process that is gone
+            job.set_status("interrupted", job.error or "プロセスが終了しました (再実行すると中断した行から再開します)")
+        # Finished: not kept in memory, the next get() reads state.json again
+        return job
+
+    def list_jobs(self, limit: int = 20) -> List[Job]:
+        """Most recent jobs first (live and persisted)."""
+        try:
+            ids = sorted((name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name))), reverse=True)
+        except OSError:
+            ids = []
+        with self._lock:
+            ids = sorted(set(ids[:limit]) | set(self._jobs), reverse=True)[:limit]
+        return [job for job in (self.get(job_id) for job_id in ids) if job is not None]
+
+
+JOB_RUNNER = JobRunner()
@@ -1,271 +1,631 @@
-import argparse
-import sys
-import time
-import os
-from dotenv import load_dotenv
-from config_manager import load_sites_config, get_gemini_api_key, load_sheets_credentials
-from sheet_handler import SheetHandler
-from wp_handler import WPHandler
-from ai_handler import AIHandler
-
-# Headers (Reference)
-HEADERS = ["Status", "MainKW", "SubKW1", "SubKW2", "Goal", "SiteName", "Slug", "DraftURL", "ImagePrompts"]
-
-def process_batch(api_key, sheet_url, sheet_name=None, dry_run=False, log_callback=print, creds_dict=None, manual_prompts=None, manual_common_rules=None):
-    """
-    Core processing logic, reusable by CLI and Web App.
-    log_callback: function to handle log messages (default: print)
-    manual_prompts: Dict of prompts (from local config) to override Sheet prompts.
-    manual_common_rules: String of common rules (from local config) to override.
-    """
-    
-    # 1. Config Loading (Sites)
-    # 1. Config Loading (Sites)
-    sites_config = load_sites_config()
-    # LOAD CREDS (Dict or Path)
-    creds_resource = load_sheets_credentials()
-    
-    if not sites_config:
-        log_callback("Warning: No config/sites.json found or empty. WordPress submission will be skipped.")
-        sites_config = {}
-    
-    if not creds_resource:
-        log_callback("Error: No Google Sheets credentials found (checked secrets and service_account.json).")
-        return
-
-    # 2. Handlers Init
-    log_callback("Initializing handlers...")
-    try:
-        # Check if creds is dict (from secrets) or path (from file)
-        if isinstance(creds_resource, dict):
-            sheet = SheetHandler(credentials_dict=creds_resource)
-        else:
-            sheet = SheetHandler(credentials_path=creds_resource)
-            
-        sheet.connect(sheet_url, sheet_name)
-    except Exception as e:
-        log_callback(f"Failed to connect to sheet: {e}")
-        return
-    
-    # Prompt Cache
-    prompt_cache = {}
-
-    # 3. Process Loop
-    log_callback("Fetching pending tasks...")
-    tasks = sheet.get_pending_tasks()
-    log_callback(f"Found {len(tasks)} pending tasks.")
-
-    for task in tasks:
-        row_idx = task.get("row_index")
-        main_kw = task.get("MainKW")
-        site_name = task.get("SiteName")
-        article_type = task.get("ArticleType", "Default") # Default to "Default" tab if empty
-        
-        if not main_kw:
-            log_callback(f"Skipping row {row_idx}: No MainKW.")
-            continue
-
-        if not article_type:
-            article_type = "Default"
-            
-        log_callback(f"\nProcessing Row {row_idx}: {main_kw} (Site: {site_name}, Type: {article_type})")
-        
-        # Load Prompt Definitions (Cached)
-        if article_type in prompt_cache:
-            prompt_dict = prompt_cache[article_type]
-        else:
-            # Check for Manual Prompts (Local Config)
-            if manual_prompts and article_type in manual_prompts:
-                 log_callback(f"Loading '{article_type}' prompts from Local Config...")
-                 prompt_dict = manual_prompts[article_type]
-            else:
-                 # Fallback to Sheet
-                 log_callback(f"Loading prompts for type '{article_type}' from Sheet...")
-                 prompt_dict = sheet.get_prompts_from_tab(article_type)
-
-            if not prompt_dict:
-                log_callback(f"Error: Prompt tab '{article_type}' not found or empty. Skipping.")
-                continue
-            prompt_cache[article_type] = prompt_dict
-
-        # Load Instructions (Base/Common Rules)
-        instruction_text = ""
-        
-        # 1a. Manual Common Rules (Local Config Override)
-        if manual_common_rules:
-            instruction_text += manual_common_rules + "\n\n"
-        else:
-            # 1b. Local common_rules.md
-            common_rules_path = "instructions/common_rules.md"
-            if os.path.exists(common_rules_path):
-                 with open(common_rules_path, 'r', encoding='utf-8') as f:
-                     instruction_text += f.read() + "\n\n"
-            
-            # 2. Sheet "Common Rules" Tab (共通ルール)
-            # Only load if NO manual common rules provided? Or append?
-            # Let's append to be safe, or skip if manual is intended to replace.
-            # Usually manual replaces file+sheet combo.
-            if not manual_common_rules:
-                sheet_rules = sheet.get_common_rules("共通ルール")
-                if sheet_rules:
-                    log_callback("Loaded additional rules from '共通ルール' tab.")
-                    instruction_text += "\n\n" + sheet_rules + "\n\n"
-
-        # Site Specific Parts
-        parts_file = ""
-        if site_name == "麻布十番":
-            parts_file = "instructions/parts_azabu.md"
-        
-        if parts_file and os.path.exists(parts_file):
-            log_callback(f"Loading parts list from {parts_file}...")
-            with open(parts_file, 'r', encoding='utf-8') as f:
-                instruction_text += f.read()
-        
-        # Re-initialize AI Handler with combined text
-        # Gemini Only Mode (Vertex removed per user request)
-        ai = AIHandler(api_key, instruction_text=instruction_text)
-
-        # 3a. AI Generation
-        sub_kws = f"{task.get('SubKW1', '')}, {task.get('SubKW2', '')}"
-        goal = task.get("Goal", "検索意図を満たし、成約につなげる")
-        slug = task.get("Slug", "article") # Get slug or default
-        
-        if dry_run:
-            log_callback("[DRY RUN] Would generate article via Gemini...")
-            generated = {
-                "title": f"Test Title for {main_kw}", 
-                "description": "Test Description",
-                "content": "Test <img src='test.jpg'> Content", 
-                "image_prompts": "Test Prompts"
-            }
-            time.sleep(1)
-        else:
-            # Load Mappings (if available)
-            mappings = prompt_dict.get("mappings", {})
-
-            # Status Update Callback
-            def status_updater(msg):
-                log_callback(f"Status Update: {msg}")
-                try:
-                    sheet.update_status(row_idx, msg)
-                except Exception as e:
-                    log_callback(f"Failed to update sheet status: {e}")
-
-            # Track mapped columns to avoid overwriting
-            mapped_cols_written = set()
-
-            # Step Completion Callback (Real-time Sheet Update)
-            def step_listener(step_name, response_text):
-                if step_name in mappings:
-                    mapping = mappings[step_name]
-                    target_col = mapping.get("col")
-                    if target_col:
-                        log_callback(f"Mapping: Writing {step_name} output to Column {target_col}...")
-                        try:
-                            if not dry_run:
-                                sheet.update_any_cell(row_idx, target_col, response_text)
-                                mapped_cols_written.add(target_col)
-                            else:
-                                log_callback(f"[DRY RUN] Would write to Col {target_col}")
-                        except Exception as e:
-                            log_callback(f"Failed to write mapped output: {e}")
-
-            status_updater("開始: AI生成中")
-            generated = ai.generate_article_flow(
-                main_kw, sub_kws, goal, slug, prompt_dict, 
-                progress_callback=status_updater,
-                step_callback=step_listener
-            )
-        
-        if not generated["content"] and 12 not in mapped_cols_written:
-             # Only error if content wasn't written via mapping AND wasn't parsed
-             # But if mapping wrote it, generated["content"] might be empty if parse failed, which is fine
-             pass
-             
-        # 3b. WP Submission
-        draft_url = ""
-        if site_name and site_name in sites_config:
-            try:
-                wp = WPHandler(sites_config[site_name])
-                if dry_run:
-                    log_callback(f"[DRY RUN] Would post to {site_name} with slug {task.get('Slug')}")
-                    draft_url = "http://example.com/draft-preview"
-                else:
-                    # Use parsed content for WP (OR should we read from sheet? sticking to parsed for now)
-                    # Note: If Mappings utilized, generated["content"] might be empty if regex failed.
-                    # Ideally we should trust the generated dict if available, but if empty, maybe user mapped it?
-                    # For WP submission, we might need to rely on what was generated.
-                    # For now, assuming regex works reasonably well for WP, or user accepts that WP uses parsed.
-                    
-                    draft_url = wp.post_draft(
-                        title=generated.get("title", ""),
-                        content=generated.get("content", ""),
-                        slug=task.get("Slug", "")
-                    )
-            except Exception as e:
-                log_callback(f"WP Upload failed (continuing to sheet save): {e}")
-        else:
-            log_callback(f"Site '{site_name}' not configured or empty. Skipping WP upload.")
-        
-        # 3c. Sheet Update (Final)
-        if dry_run:
-            log_callback(f"[DRY RUN] Final Update for Row {row_idx}.")
-        else:
-            # 1. Update Status (Always)
-            try:
-                sheet.update_status(row_idx, "完了")
-            except: pass
-            
-            # 2. Update Draft URL (Column 8 - H)
-            try:
-                sheet.update_any_cell(row_idx, 8, draft_url)
-            except: pass
-            
-            # 3. Update other columns ONLY IF not mapped
-            # Column 9 (I): Image Prompts
-            if 9 not in mapped_cols_written and generated.get("image_prompts"):
-                try: sheet.update_any_cell(row_idx, 9, generated["image_prompts"])
-                except: pass
-
-            # Column 10 (J): Title
-            if 10 not in mapped_cols_written and generated.get("title"):
-                try: sheet.update_any_cell(row_idx, 10, generated["title"])
-                except: pass
-
-            # Column 11 (K): Description
-            if 11 not in mapped_cols_written and generated.get("description"):
-                try: sheet.update_any_cell(row_idx, 11, generated["description"])
-                except: pass
-                
-            # Column 12 (L): Content
-            if 12 not in mapped_cols_written and generated.get("content"):
-                try: sheet.update_any_cell(row_idx, 12, generated["content"])
-                except: pass
-
-            log_callback(f"Updated Sheet Row {row_idx} (Status: 完了).")
-
-    log_callback("\nAll tasks processed.")
-
-def main():
-    load_dotenv()
-    parser = argparse.ArgumentParser(description="Article Automation Tool")
-    parser.add_argument("--dry-run", action="store_true", help="Run without sending to API or writing to Sheet")
-    parser.add_argument("--sheet-url", type=str, required=True, help="URL of the Google Sheet")
-    parser.add_argument("--sheet-name", type=str, help="Name of the worksheet (optional)")
-    args = parser.parse_args()
-
-    api_key = get_gemini_api_key()
-    if not api_key:
-        print("Error: GEMINI_API_KEY env var not set.")
-        return
-
-    process_batch(
-        api_key=api_key,
-        sheet_url=args.sheet_url,
-        sheet_name=args.sheet_name,
-        dry_run=args.dry_run,
-        log_callback=print
-    )
-
-if __name__ == "__main__":
-    main()
+import argparse
+import time
+import threading
+from dotenv import load_dotenv
+from config_manager import load_sites_config, get_gemini_api_key, load_sheets_credentials, load_text_file, load_manifest, MANIFEST_SHEET_OPTIONS
+from sheet_handler import SheetHandler, INTERRUPTED_STATUS_PREFIX
+from wp_handler import WPHandler, PostLookupError
+from ai_handler import AI_HANDLER_POOL
+from context_cache import GEMINI_CONTEXT_CACHE
+from rate_limiter import get_gemini_limiter
+from conformance import get_validator
+from pipeline import RowPipeline
+from metrics import METRICS, scope as metrics_scope
+from events import publishing_to, EventBus, CallbackSink, ConsoleSink, JsonlSink, ROW_STARTED, ROW_STATUS, ROW_DONE, WRITE_FLUSHED
+from prompt_plan import compile_prompts, PromptPlanError
+from step_journal import STEP_JOURNAL, STEP_OUTPUT_CACHE, StepJournal
+
+COMMON_RULES_PATH = "instructions/common_rules.md"
+
+# Site name -> parts list appended to its instructions (and used by the conformance validator)
+SITE_PARTS_FILES = {
+    "麻布十番": "instructions/parts_azabu.md",
+}
+
+# Headers (Reference)
+HEADERS = ["Status", "MainKW", "SubKW1", "SubKW2", "Goal", "SiteName", "Slug", "DraftURL", "ImagePrompts"]
+
+class SheetRun:
+    """One worksheet of a run: its handler, pending rows and pipeline stages (built by process_batch)."""
+
+    def __init__(self, label, sheet, tasks, generate_row, publish_row, record_row, dry_run=False):
+        self.label = label
+        self.sheet = sheet
+        self.tasks = tasks
+        self.generate_row = generate_row
+        self.publish_row = publish_row
+        self.record_row = record_row
+        self.dry_run = dry_run
+
+
+def interleave_tasks(runs):
+    """
+    (SheetRun, task) pairs taking one pending row from each sheet in turn. A sheet's rows are
+    still read lazily page by page; a sheet drops out once it has no more pending rows.
+    """
+    iterators = [(run, iter(run.tasks)) for run in runs]
+    while iterators:
+        for entry in list(iterators):
+            run, iterator = entry
+            task = next(iterator, None)
+            if task is None:
+                iterators.remove(entry)
+                continue
+            yield run, task
+
+def process_batch(api_key, sheet_url, sheet_name=None, dry_run=False, log_callback=print, creds_dict=None, manual_prompts=None, manual_common_rules=None, workers=1, use_context_cache=False, stream=False, chunk_callback=None, resume=False, regenerate=False, history_budget=0, validate_drafts=True, wp_bulk=False, cancel_event=None, events=None, metrics_jsonl=None, metrics_prom=None, sheet=None, sites_config=None, ai_pool=None, sheets=None):
+    """
+    Core processing logic, reusable by CLI and Web App.
+    log_callback: function to handle log messages (default: print)
+    manual_prompts: Dict of prompts (from local config) to override Sheet prompts.
+    manual_common_rules: String of common rules (from local config) to override.
+    workers: Number of rows generated concurrently. WP posting and sheet writes run in separate
+             pipeline stages either way (see RowPipeline).
+    use_context_cache: Register the system instruction as Gemini cached content instead of re-sending it.
+    stream: Stream Gemini responses. chunk_callback(row_index, label, text_delta) receives partial output.
+    resume: Also pick up rows left in an in-progress status by a run that died (see iter_pending_tasks).
+    regenerate: Re-run finished (完了) rows too, replaying unchanged steps from the step output cache
+                so only edited steps and the steps after them call Gemini.
+    history_budget: Token budget for the chat history sent with each step (0 = unlimited; superseded drafts are collapsed either way).
+    validate_drafts: Check HTML drafts against the site's parts list locally and skip the
+                self-check call when they conform (sites without a parts list always refine).
+    wp_bulk: Post drafts that finish together in one WordPress /batch/v1 request per site.
+    cancel_event: threading.Event for cooperative cancellation (job_runner.py). Once set, no new
+                row or step starts; rows in flight stop after their current step and are left
+                resumable, finished rows are still published and recorded.
+    events: EventBus (events.py) receiving typed events (rows, steps, retries, sheet flushes).
+            Without one, log_callback gets the usual text lines through a CallbackSink.
+    metrics_jsonl: Append one JSON line per external call (api, op, seconds, retries, tokens, bytes,
+            row, step) to this file. A p50/p95 summary per step and API is logged at the end either way.
+    metrics_prom: Write the process-wide call metrics in the Prometheus text format to this file.
+    sheet: A connected SheetHandler to use instead of authorizing and opening sheet_url.
+    sites_config: Site name -> WordPress config, instead of config/sites.json.
+    ai_pool: AIHandlerPool to take handlers from (default: the process-wide AI_HANDLER_POOL).
+    sheets: Worksheets to process in this one run instead of sheet_url / sheet_name, as returned by
+            config_manager.load_manifest: [{"sheet_url", "sheet_name", "label", per-sheet options}].
+            Credentials, WP handlers, the AI handler pool, caches and the Gemini rate limiter are
+            shared, and rows are taken from the sheets in turn so a slow sheet never idles the workers.
+    """
+    if events is None:
+        events = EventBus([CallbackSink(log_callback)])
+    log_callback = events.log
+    
+    if ai_pool is None:
+        ai_pool = AI_HANDLER_POOL
+    
+    # 1. Config Loading (Sites)
+    if sites_config is None:
+        sites_config = load_sites_config()
+    
+    if not sites_config:
+        log_callback("Warning: No config/sites.json found or empty. WordPress submission will be skipped.")
+        sites_config = {}
+    
+    if sheets is None:
+        sheets = [{"sheet_url": sheet_url, "sheet_name": sheet_name, "sheet": sheet}]
+    # With several worksheets, rows are labelled "<sheet label>:<row>" in events and logs
+    multi_sheet = len(sheets) > 1
+    run_options = {"dry_run": dry_run, "resume": resume, "regenerate": regenerate, "history_budget": history_budget,
+                   "validate_drafts": validate_drafts, "use_context_cache": use_context_cache}
+
+    # LOAD CREDS (Dict or Path), once for every sheet of the run
+    needs_creds = any(spec.get("sheet") is None for spec in sheets)
+    creds_resource = load_sheets_credentials() if needs_creds else None
+    if needs_creds and not creds_resource:
+        log_callback("Error: No Google Sheets credentials found (checked secrets and service_account.json).")
+        return
+
+    # WP Handlers (shared by all workers and sheets)
+    wp_handlers = {}
+    wp_lock = threading.Lock()
+
+    def get_wp_handler(site_name):
+        with wp_lock:
+            if site_name not in wp_handlers:
+                wp_handlers[site_name] = WPHandler(sites_config[site_name])
+            return wp_handlers[site_name]
+
+    # Site Specific Parts (parts text + conformance validator per site)
+    site_parts = {}
+    for parts_site, parts_file in SITE_PARTS_FILES.items():
+        parts_text = load_text_file(parts_file)
+        if parts_text:
+            site_parts[parts_site] = (parts_file, parts_text, get_validator(parts_text))
+
+    skipped_refines = 0
+    validated_rows = 0  # rows whose drafts went through the local validator (validate_drafts is per sheet)
+    stats_lock = threading.Lock()
+
+    def open_sheet(sheet, label, dry_run, resume, regenerate, history_budget, validate_drafts, use_context_cache):
+        """
+        Pending rows and pipeline stages of one worksheet. The sheet's own settings shadow the
+        run's (see config_manager.MANIFEST_SHEET_OPTIONS).
+        """
+        # Prompt Cache (shared by all workers of the sheet)
+        prompt_cache = {}
+        prompt_lock = threading.Lock()
+        if regenerate:
+            log_callback("Regeneration mode: finished rows are included; unchanged steps are replayed from cache.")
+
+        def expect_slugs(page):
+            """Registers a page's slugs per site so existing WP posts are looked up in one request per page."""
+            if dry_run:
+                return
+            slugs_by_site = {}
+            for task in page:
+                if task.get("Slug") and task.get("SiteName") in sites_config:
+                    slugs_by_site.setdefault(task["SiteName"], []).append(task["Slug"])
+            for site_name, slugs in slugs_by_site.items():
+                try:
+                    get_wp_handler(site_name).expect_slugs(slugs)
+                except Exception as e:
+                    # Lookup is an optimisation; publish_row reports a broken site config per row
+                    log_callback(f"Skipping WP slug prefetch for {site_name}: {e}")
+
+        tasks = sheet.iter_pending_tasks(include_in_progress=resume, include_completed=regenerate, on_page=expect_slugs)
+
+        # Load Instructions (Base/Common Rules) once per run and sheet; every row shares them
+        common_instructions = ""
+
+        # 1a. Manual Common Rules (Local Config Override)
+        if manual_common_rules:
+            common_instructions += manual_common_rules + "\n\n"
+        else:
+            # 1b. Local common_rules.md
+            common_rules = load_text_file(COMMON_RULES_PATH)
+            if common_rules:
+                common_instructions += common_rules + "\n\n"
+
+            # 2. Sheet "Common Rules" Tab (共通ルール)
+            # Usually manual replaces file+sheet combo, so it is only appended here.
+            sheet_rules = sheet.get_common_rules("共通ルール")
+            if sheet_rules:
+                log_callback("Loaded additional rules from '共通ルール' tab.")
+                common_instructions += "\n\n" + sheet_rules + "\n\n"
+
+        def generate_row(task, log_callback, chunk_callback=None):
+            """
+            Pipeline stage 1: prompts, instructions and the Gemini flow for one pending row.
+            Returns the payload for publish_row / record_row, or None if the row is skipped or
+            left interrupted. The callbacks are row-scoped (see RowPipeline).
+            """
+            row_idx = task.get("row_index")
+            main_kw = task.get("MainKW")
+            site_name = task.get("SiteName")
+            article_type = task.get("ArticleType", "Default") # Default to "Default" tab if empty
+        
+            if not main_kw:
+                log_callback(f"Skipping row {row_idx}: No MainKW.")
+                return
+
+            if not article_type:
+                article_type = "Default"
+            
+            log_callback.emit(ROW_STARTED, f"\nProcessing Row {row_idx}: {main_kw} (Site: {site_name}, Type: {article_type})")
+        
+            # Prompt plan for the article type: loaded and compiled once per run, shared between workers
+            with prompt_lock:
+                if article_type in prompt_cache:
+                    plan = prompt_cache[article_type]
+                else:
+                    # Check for Manual Prompts (Local Config)
+                    if manual_prompts and article_type in manual_prompts:
+                         log_callback(f"Loading '{article_type}' prompts from Local Config...")
+                         prompt_dict = manual_prompts[article_type]
+                    else:
+                         # Fallback to Sheet
+                         log_callback(f"Loading prompts for type '{article_type}' from Sheet...")
+                         prompt_dict = sheet.get_prompts_from_tab(article_type)
+                    plan = None
+                    if prompt_dict:
+                        try:
+                            plan = compile_prompts(prompt_dict, article_type)
+                        except PromptPlanError as e:
+                            log_callback(f"Error: Prompts for '{article_type}' cannot be used: {e}")
+                        else:
+                            for error in plan.errors:
+                                log_callback(f"Warning: Prompt format error in '{article_type}' {error}")
+                    prompt_cache[article_type] = plan
+
+            if not plan:
+                log_callback(f"Error: Prompt tab '{article_type}' not found, empty or invalid. Skipping.")
+                return
+
+            # Instructions: the run's common rules + this site's parts list (no file I/O per row)
+            instruction_text = common_instructions
+            validator = None
+            if site_name in site_parts:
+                parts_file, parts_text, validator = site_parts[site_name]
+                if not validate_drafts:
+                    validator = None
+                log_callback(f"Using parts list from {parts_file}.")
+                instruction_text += parts_text
+        
+            # Pooled AI Handler for this instruction bundle (each flow opens its own chat)
+            # Gemini Only Mode (Vertex removed per user request)
+            ai = ai_pool.get(api_key, instruction_text)
+
+            # 3a. AI Generation
+            sub_kws = f"{task.get('SubKW1', '')}, {task.get('SubKW2', '')}"
+            goal = task.get("Goal", "検索意図を満たし、成約につなげる")
+            slug = task.get("Slug", "article") # Get slug or default
+        
+            # Track mapped columns to avoid overwriting
+            mapped_cols_written = set()
+            journal = None
+
+            if dry_run:
+                log_callback("[DRY RUN] Would generate article via Gemini...")
+                generated = {
+                    "title": f"Test Title for {main_kw}", 
+                    "description": "Test Description",
+                    "content": "Test <img src='test.jpg'> Content", 
+                    "image_prompts": "Test Prompts"
+                }
+                time.sleep(1)
+            else:
+
+                # Status Update Callback
+                def status_updater(msg):
+                    log_callback.emit(ROW_STATUS, msg)
+                    try:
+                        sheet.update_status(row_idx, msg)
+                    except Exception as e:
+                        log_callback(f"Failed to update sheet status: {e}")
+
+                # Step Completion Callback (Real-time Sheet Update)
+                def step_listener(step_name, response_text):
+                    target_col = plan.step_columns.get(step_name)
+                    if target_col:
+                        log_callback(f"Mapping: Writing {step_name} output to Column {target_col}...")
+                        try:
+                            if not dry_run:
+                                sheet.update_any_cell(row_idx, target_col, response_text)
+                                mapped_cols_written.add(target_col)
+                            else:
+                                log_callback(f"[DRY RUN] Would write to Col {target_col}")
+                        except Exception as e:
+                            log_callback(f"Failed to write mapped output: {e}")
+
+                def section_listener(label, name, value):
+                    if name in ("title", "description", "image_prompts"):
+                        log_callback(f"{label}: {name} received ({len(value)} chars)")
+
+                # Durable per-row journal: an interrupted row resumes at its first incomplete step
+                journal = STEP_JOURNAL.open_row(StepJournal.row_key(
+                    sheet.get_spreadsheet_id(), row_idx, main_kw, slug, article_type,
+                    plan.version
+                ))
+
+                status_updater("開始: AI生成中")
+                generated = ai.generate_article_flow(
+                    main_kw, sub_kws, goal, slug, plan, 
+                    progress_callback=status_updater,
+                    step_callback=step_listener,
+                    stream=stream,
+                    chunk_callback=chunk_callback,
+                    section_callback=section_listener,
+                    journal=journal,
+                    step_cache=STEP_OUTPUT_CACHE,
+                    replay_cached=regenerate,
+                    history_budget=history_budget,
+                    validator=validator,
+                    cancel_event=cancel_event,
+                    event_callback=log_callback.emit,
+                    context_cache=GEMINI_CONTEXT_CACHE if use_context_cache else None
+                )
+                if generated.get("skipped_refines"):
+                    log_callback(f"Self-check skipped (draft conforms): {', '.join(generated['skipped_refines'])}")
+                if generated.get("replayed_steps"):
+                    log_callback(f"Replayed {generated['replayed_steps']} unchanged steps from cache.")
+                if generated.get("tokens_sent"):
+                    log_callback("Input tokens sent: " + ", ".join(f"{label} {tokens}" for label, tokens in generated["tokens_sent"].items())
+                                 + f" (total {sum(generated['tokens_sent'].values())})")
+                if generated.get("ttft"):
+                    log_callback("Time to first token: " + ", ".join(f"{label} {seconds:.1f}s" for label, seconds in generated["ttft"].items()))
+
+                if generated.get("incomplete_step"):
+                    # Leave the row resumable instead of publishing a partial article
+                    step = generated["incomplete_step"]
+                    log_callback(f"Row {row_idx} stopped at {step}; completed steps are journaled and the next run resumes there.")
+                    status_updater(f"{INTERRUPTED_STATUS_PREFIX}: {step} (再実行で再開)")
+                    return
+        
+            if not generated["content"] and 12 not in mapped_cols_written:
+                 # Only error if content wasn't written via mapping AND wasn't parsed
+                 # But if mapping wrote it, generated["content"] might be empty if parse failed, which is fine
+                 pass
+
+            return {"task": task, "generated": generated, "mapped_cols_written": mapped_cols_written, "journal": journal,
+                    "validated": validator is not None}
+
+        def publish_row(payload, log_callback):
+            """Pipeline stage 2: posts the generated article to the row's WordPress site."""
+            task = payload["task"]
+            generated = payload["generated"]
+            site_name = task.get("SiteName")
+
+            # 3b. WP Submission
+            draft_url = ""
+            if site_name and site_name in sites_config:
+                try:
+                    wp = get_wp_handler(site_name)
+                    if dry_run:
+                        log_callback(f"[DRY RUN] Would post to {site_name} with slug {task.get('Slug')}")
+                        draft_url = "http://example.com/draft-preview"
+                    else:
+                        # Use parsed content for WP (OR should we read from sheet? sticking to parsed for now)
+                        # Note: If Mappings utilized, generated["content"] might be empty if regex failed.
+                        # Ideally we should trust the generated dict if available, but if empty, maybe user mapped it?
+                        # For WP submission, we might need to rely on what was generated.
+                        # For now, assuming regex works reasonably well for WP, or user accepts that WP uses parsed.
+                    
+                        draft_url = wp.post_draft(
+                            title=generated.get("title", ""),
+                            content=generated.get("content", ""),
+                            slug=task.get("Slug", "")
+                        )
+                except PostLookupError as e:
+                    payload["publish_error"] = e
+                except Exception as e:
+                    log_callback(f"WP Upload failed (continuing to sheet save): {e}")
+            else:
+                log_callback(f"Site '{site_name}' not configured or empty. Skipping WP upload.")
+            payload["draft_url"] = draft_url
+            return payload
+
+        def record_row(payload, log_callback):
+            """Pipeline stage 3: final sheet columns and the 完了 status (last, so a crash never marks a row done early)."""
+            nonlocal skipped_refines, validated_rows
+            row_idx = payload["task"].get("row_index")
+            generated = payload["generated"]
+            if payload.get("validated"):
+                with stats_lock:
+                    validated_rows += 1
+                    skipped_refines += len(generated.get("skipped_refines") or [])
+            mapped_cols_written = payload["mapped_cols_written"]
+            draft_url = payload["draft_url"]
+
+            # 3c. Sheet Update (Final)
+            if payload.get("publish_error"):
+                # Not posted (existing WP posts unknown): the row stays resumable; the next run replays it from the journal
+                log_callback(f"{payload['publish_error']} Row {row_idx} is left for the next run.")
+                sheet.update_status(row_idx, f"{INTERRUPTED_STATUS_PREFIX}: WP投稿 (再実行で再開)")
+            elif dry_run:
+                log_callback.emit(ROW_DONE, f"[DRY RUN] Final Update for Row {row_idx}.")
+            else:
+                # 1. Update Draft URL (Column 8 - H)
+                try:
+                    sheet.update_any_cell(row_idx, 8, draft_url)
+                except: pass
+            
+                # 2. Update other columns ONLY IF not mapped
+                # Column 9 (I): Image Prompts
+                if 9 not in mapped_cols_written and generated.get("image_prompts"):
+                    try: sheet.update_any_cell(row_idx, 9, generated["image_prompts"])
+                    except: pass
+
+                # Column 10 (J): Title
+                if 10 not in mapped_cols_written and generated.get("title"):
+                    try: sheet.update_any_cell(row_idx, 10, generated["title"])
+                    except: pass
+
+                # Column 11 (K): Description
+                if 11 not in mapped_cols_written and generated.get("description"):
+                    try: sheet.update_any_cell(row_idx, 11, generated["description"])
+                    except: pass
+                
+                # Column 12 (L): Content
+                if 12 not in mapped_cols_written and generated.get("content"):
+                    try: sheet.update_any_cell(row_idx, 12, generated["content"])
+                    except: pass
+
+                # 3. Update Status (Always, last: flushes every queued write of the row with it)
+                # The journal is dropped only once 完了 is in the sheet; otherwise the next run resumes the row
+                try:
+                    sheet.mark_complete(row_idx)
+                except Exception as e:
+                    log_callback(f"Failed to mark row {row_idx} as 完了 (journal kept, the next run resumes it): {e}")
+                    return
+
+                payload["journal"].finish()
+                log_callback.emit(ROW_DONE, f"Updated Sheet Row {row_idx} (Status: 完了).")
+
+        return SheetRun(label, sheet, tasks, generate_row, publish_row, record_row, dry_run)
+
+    # 2. Handlers Init
+    log_callback("Initializing handlers...")
+    runs = []
+    authorized = None  # First handler authorized here; the other sheets share its client
+    refreshed = set()
+    for spec in sheets:
+        label = (spec.get("label") or spec.get("sheet_name") or spec.get("sheet_url")) if multi_sheet else None
+        try:
+            handler = spec.get("sheet")
+            if handler is None and authorized is not None:
+                handler = authorized.for_worksheet(spec["sheet_url"], spec.get("sheet_name"))
+            elif handler is None:
+                # Check if creds is dict (from secrets) or path (from file)
+                if isinstance(creds_resource, dict):
+                    handler = SheetHandler(credentials_dict=creds_resource)
+                else:
+                    handler = SheetHandler(credentials_path=creds_resource)
+                    
+                handler.connect(spec["sheet_url"], spec.get("sheet_name"))
+                authorized = handler
+            # Prompt tabs / 共通ルール are cached across runs; drop them if the sheet was edited
+            spreadsheet_id = handler.get_spreadsheet_id()
+            if spreadsheet_id not in refreshed:
+                refreshed.add(spreadsheet_id)
+                handler.refresh_tab_cache()
+        except Exception as e:
+            log_callback(f"Failed to connect to sheet {label}: {e}" if label else f"Failed to connect to sheet: {e}")
+            continue
+        options = dict(run_options, **{name: spec[name] for name in MANIFEST_SHEET_OPTIONS if name in spec})
+        runs.append(open_sheet(handler, label, **options))
+    if not runs:
+        return
+    if multi_sheet:
+        log_callback(f"Processing {len(runs)} sheets: {', '.join(run.label for run in runs)}")
+    tasks = interleave_tasks(runs)
+
+    # Pipeline stages: items are (SheetRun, task) pairs; payloads carry their SheetRun
+    def generate_item(item, log_callback, chunk_callback=None):
+        run, task = item
+        payload = run.generate_row(task, log_callback, chunk_callback)
+        if payload is not None:
+            payload["sheet_run"] = run
+        return payload
+
+    def publish_item(payload, log_callback):
+        return payload["sheet_run"].publish_row(payload, log_callback)
+
+    def record_item(payload, log_callback):
+        return payload["sheet_run"].record_row(payload, log_callback)
+
+    def row_label(item):
+        run, task = item
+        return f"{run.label}:{task.get('row_index')}" if run.label else task.get("row_index")
+
+    def publish_rows(payloads, log_callbacks):
+        """Bulk variant of publish_item (wp_bulk): one WP batch request per site for the queued rows of every sheet."""
+        by_site = {}
+        for payload, row_log in zip(payloads, log_callbacks):
+            site_name = payload["task"].get("SiteName")
+            if payload["sheet_run"].dry_run or not site_name or site_name not in sites_config:
+                publish_item(payload, row_log)
+            else:
+                by_site.setdefault(site_name, []).append((payload, row_log))
+
+        for site_name, entries in by_site.items():
+            if len(entries) == 1:
+                publish_item(*entries[0])
+                continue
+            entries[0][1](f"Posting {len(entries)} drafts to {site_name} in bulk (rows {', '.join(str(p['task'].get('row_index')) for p, _log in entries)})...")
+            drafts = [{
+                "title": payload["generated"].get("title", ""),
+                "content": payload["generated"].get("content", ""),
+                "slug": payload["task"].get("Slug", "")
+            } for payload, _row_log in entries]
+            try:
+                links = get_wp_handler(site_name).post_drafts(drafts)
+            except Exception as e:
+                links = [""] * len(entries)
+                for _payload, row_log in entries:
+                    row_log(f"WP Upload failed (continuing to sheet save): {e}")
+            for (payload, _row_log), link in zip(entries, links):
+                if isinstance(link, PostLookupError):
+                    payload["publish_error"], link = link, ""
+                payload["draft_url"] = link
+        return payloads
+
+    # 3. Process Loop
+    # Tasks are streamed page by page so the first rows start while the rest are still being scanned
+    log_callback("Fetching pending tasks...")
+    STEP_OUTPUT_CACHE.prune()
+
+    # Gemini / Sheets / WP calls of the run are timed per row and step (metrics.py)
+    run_metrics = METRICS.start_run(jsonl_path=metrics_jsonl)
+    try:
+        with metrics_scope(run=run_metrics.run_id), publishing_to(events):
+            # Batch all cell writes of the run (status, mapped outputs, final columns), one buffer per sheet
+            for run in runs:
+                if not run.dry_run:
+                    run.sheet.enable_write_buffer(on_flush=lambda cells, label=run.label: events.emit(
+                        WRITE_FLUSHED, cells=cells, **({"sheet": label} if label else {})))
+            if workers > 1:
+                log_callback(f"Running with {workers} workers.")
+            # Generation, WP posting and sheet writes overlap; the next row starts while the last one is published
+            pipeline = RowPipeline(generate_item, publish_item, record_item, workers=workers,
+                                   events=events, chunk_callback=chunk_callback, row_label=row_label,
+                                   publish_many=publish_rows if wp_bulk else None, stop_event=cancel_event)
+            processed = pipeline.run(tasks)
+    finally:
+        for run in runs:
+            buffer = run.sheet.write_buffer
+            prefix = f"{run.label}: " if run.label else ""
+            try:
+                with metrics_scope(run=run_metrics.run_id), publishing_to(events):
+                    run.sheet.close_write_buffer()
+            except Exception as e:
+                log_callback(f"{prefix}Failed to flush pending sheet writes: {e}")
+            if buffer:
+                log_callback(f"{prefix}Sheet writes: {buffer.cells_written} cells in {buffer.requests} requests ({buffer.cells_superseded} superseded).")
+        log_callback(f"AI handler pool: {ai_pool.stats()}")
+        log_callback(f"Gemini rate limiter: {get_gemini_limiter().stats()}")
+        if validated_rows:
+            log_callback(f"Self-check calls skipped by the local validator: {skipped_refines} ({validated_rows} rows validated)")
+        METRICS.finish_run(run_metrics.run_id)
+        if run_metrics.records:
+            log_callback("\nPerformance summary (per row and step):\n" + run_metrics.summary())
+        if metrics_prom:
+            try:
+                METRICS.write_prometheus(metrics_prom)
+            except OSError as e:
+                log_callback(f"Failed to write metrics to {metrics_prom}: {e}")
+
+    if cancel_event is not None and cancel_event.is_set():
+        log_callback(f"\nCancelled. ({processed} pending rows started; interrupted rows resume on the next run)")
+        return
+    log_callback(f"\nAll tasks processed. ({processed} pending rows{f' from {len(runs)} sheets' if multi_sheet else ''})")
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Article Automation Tool")
+    parser.add_argument("--dry-run", action="store_true", help="Run without sending to API or writing to Sheet")
+    parser.add_argument("--sheet-url", type=str, help="URL of the Google Sheet")
+    parser.add_argument("--sheet-name", type=str, help="Name of the worksheet (optional)")
+    parser.add_argument("--manifest", type=str, help="JSON file listing sheets, tabs and per-sheet options to process together in one run (instead of --sheet-url)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of rows to process concurrently (default: 1)")
+    parser.add_argument("--context-cache", action="store_true", help="Cache the system instruction on the Gemini side instead of re-sending it")
+    parser.add_argument("--stream", action="store_true", help="Stream Gemini responses (reports time to first token per step)")
+    parser.add_argument("--resume", action="store_true", help="Also resume rows left 'in progress' by a run that was killed")
+    parser.add_argument("--regenerate", action="store_true", help="Re-run finished rows; only steps whose prompts changed (and later steps) call Gemini")
+    parser.add_argument("--always-refine", action="store_true", help="Always send the self-check call, even when an HTML draft passes the local parts-list validator")
+    parser.add_argument("--wp-bulk", action="store_true", help="Post drafts that are ready together through the WordPress batch endpoint (falls back to single posts)")
+    parser.add_argument("--events-jsonl", type=str, help="Also write every run event (rows, steps, retries, sheet flushes) as JSON lines to this file")
+    parser.add_argument("--metrics-jsonl", type=str, help="Write one JSON line per Gemini/Sheets/WP call (wall time, retries, tokens, bytes) to this file")
+    parser.add_argument("--metrics-prom", type=str, help="Write call metrics in the Prometheus text format to this file at the end of the run")
+    parser.add_argument("--history-budget", type=int, default=0, help="Token budget for the chat history; the oldest steps are dropped beyond it (default: unlimited). Superseded drafts are always left out")
+    args = parser.parse_args()
+    if bool(args.sheet_url) == bool(args.manifest):
+        parser.error("give either --sheet-url or --manifest")
+
+    events = EventBus([ConsoleSink()])
+    sheets = None
+    if args.manifest:
+        try:
+            sheets = load_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            events.log(f"Error: Cannot read manifest: {e}")
+            return
+
+    api_key = get_gemini_api_key()
+    if not api_key:
+        events.log("Error: GEMINI_API_KEY env var not set.")
+        return
+
+    if args.events_jsonl:
+        events.add_sink(JsonlSink(args.events_jsonl))
+
+    process_batch(
+        api_key=api_key,
+        sheet_url=args.sheet_url,
+        sheet_name=args.sheet_name,
+        dry_run=args.dry_run,
+        events=events,
+        workers=max(1, args.workers),
+        use_context_cache=args.context_cache,
+        stream=args.stream,
+        resume=args.resume,
+        regenerate=args.regenerate,
+        history_budget=args.history_budget,
+        validate_drafts=not args.always_refine,
+        wp_bulk=args.wp_bulk,
+        metrics_jsonl=args.metrics_jsonl,
+        metrics_prom=args.metrics_prom,
+        sheets=sheets
+    )
+
+if __name__ == "__main__":
+    main()
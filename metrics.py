@@ -0,0 +1,280 @@
+import contextvars
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+# Upper bounds (seconds) of the latency histogram buckets in the Prometheus export
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Which run / row / step the calls of the current thread belong to (see scope())
+_scope: contextvars.ContextVar = contextvars.ContextVar("metrics_scope", default={})
+
+# Path segments that identify a resource rather than an operation (post IDs, SHAs, sheet IDs)
+_ID_SEGMENT = re.compile(r"^(\d+|[0-9a-f]{40}|[A-Za-z0-9_-]{30,})$")
+
+
+@contextmanager
+def scope(**fields):
+    """Attributes the calls made inside the block (and in contexts copied from it) to run/row/step."""
+    token = _scope.set({**_scope.get(), **fields})
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def current_scope() -> Dict[str, Any]:
+    return _scope.get()
+
+
+def in_context(fn, **fields):
+    """
+    fn bound to a copy of the current context (plus scope fields), for executor threads, which
+    don't inherit it. Each call of in_context makes a fresh copy; use the result for one call.
+    """
+    context = contextvars.copy_context()
+    if fields:
+        context.run(_scope.set, {**_scope.get(), **fields})
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+class CallRecord(NamedTuple):
+    api: str
+    op: str
+    seconds: float
+    ok: bool = True
+    retries: int = 0
+    backoff: float = 0.0
+    tokens_in: int = 0
+    tokens_out: int = 0
+    bytes_out: int = 0
+    bytes_in: int = 0
+    run: Optional[str] = None
+    row: Any = None
+    step: Optional[str] = None
+    ts: float = 0.0
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list (0 for an empty one)."""
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values), math.ceil(q / 100.0 * len(values))) - 1)]
+
+
+class RunMetrics:
+    """External calls of one process_batch run, optionally streamed to a JSONL file as they happen."""
+
+    def __init__(self, run_id: str, jsonl_path: Optional[str] = None):
+        self.run_id = run_id
+        self.jsonl_path = jsonl_path
+        self.records: List[CallRecord] = []
+        self.started = time.time()
+        self._file = None
+        self._lock = threading.Lock()
+
+    def add(self, record: CallRecord):
+        with self._lock:
+            self.records.append(record)
+            if self.jsonl_path:
+                if self._file is None:
+                    os.makedirs(os.path.dirname(self.jsonl_path) or ".", exist_ok=True)
+                    self._file = open(self.jsonl_path, "a", encoding="utf-8")
+                self._file.write(json.dumps(record._asdict(), ensure_ascii=False, default=str) + "\n")
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def summary(self) -> str:
+        """Per-step p50/p95 (per row: all calls of the step incl. refine and backoff) and per-API totals."""
+        with self._lock:
+            records = list(self.records)
+        rows = {record.row for record in records if record.row is not None}
+        lines = []
+
+        step_times: "OrderedDict[str, Dict[Any, List[CallRecord]]]" = OrderedDict()
+        for record in records:
+            if record.api == "gemini" and record.step:
+                step_times.setdefault(record.step, {}).setdefault(record.row, []).append(record)
+        if step_times:
+            lines.append(f"{'Step':<12} {'rows':>5} {'p50 s':>8} {'p95 s':>8} {'tok in':>9} {'tok out':>8} {'retries':>7}")
+            for step, per_row in step_times.items():
+                seconds = sorted(sum(r.seconds for r in calls) for calls in per_row.values())
+                calls = [r for rs in per_row.values() for r in rs]
+                lines.append(f"{step:<12} {len(per_row):>5} {percentile(seconds, 50):>8.1f} {percentile(seconds, 95):>8.1f} "
+                             f"{sum(r.tokens_in for r in calls) // len(per_row):>9} {sum(r.tokens_out for r in calls) // len(per_row):>8} "
+                             f"{sum(r.retries for r in calls):>7}")
+
+        by_api: "OrderedDict[str, List[CallRecord]]" = OrderedDict()
+        for record in records:
+            by_api.setdefault(record.api, []).append(record)
+        if by_api:
+            lines.append(f"{'API':<12} {'calls':>5} {'/row':>6} {'p50 s':>8} {'p95 s':>8} {'errors':>6} {'retries':>7} {'backoff s':>9} {'KB':>8}")
+            for api, calls in by_api.items():
+                seconds = sorted(r.seconds for r in calls)
+                per_row = f"{len(calls) / len(rows):.1f}" if rows else "-"
+                kilobytes = sum(r.bytes_in + r.bytes_out for r in calls) / 1024
+                lines.append(f"{api:<12} {len(calls):>5} {per_row:>6} {percentile(seconds, 50):>8.2f} {percentile(seconds, 95):>8.2f} "
+                             f"{sum(not r.ok for r in calls):>6} {sum(r.retries for r in calls):>7} "
+                             f"{sum(r.backoff for r in calls):>9.1f} {kilobytes:>8.0f}")
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """
+    Process-wide sink for external call measurements.
+    - record() attributes a call to the run/row/step of the current scope and appends it to
+      that run's RunMetrics (if the run was started), for the end-of-run summary and JSONL.
+    - Per (api, op) aggregates (counts, latency histogram, retries, tokens, bytes) cover every
+      call of the process and are exported in the Prometheus text format; their size depends
+      only on the number of distinct operations, not on how many calls were made.
+    """
+
+    def __init__(self):
+        self._runs: Dict[str, RunMetrics] = {}
+        self._totals: Dict[tuple, Dict[str, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start_run(self, run_id: Optional[str] = None, jsonl_path: Optional[str] = None) -> RunMetrics:
+        run = RunMetrics(run_id or uuid.uuid4().hex[:12], jsonl_path)
+        with self._lock:
+            self._runs[run.run_id] = run
+        return run
+
+    def finish_run(self, run_id: str) -> Optional[RunMetrics]:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run:
+            run.close()
+        return run
+
+    def record(self, api: str, op: str, seconds: float, **fields):
+        context = current_scope()
+        for name in ("run", "row", "step"):
+            if fields.get(name) is None and name in context:
+                fields[name] = context[name]
+        record = CallRecord(api, op, seconds, ts=time.time(), **fields)
+        with self._lock:
+            totals = self._totals.get((api, op))
+            if totals is None:
+                totals = self._totals[(api, op)] = {
+                    "calls": 0, "errors": 0, "seconds": 0.0, "buckets": [0] * len(LATENCY_BUCKETS),
+                    "retries": 0, "backoff": 0.0, "tokens_in": 0, "tokens_out": 0, "bytes_out": 0, "bytes_in": 0,
+                }
+            totals["calls"] += 1
+            totals["errors"] += 0 if record.ok else 1
+            totals["seconds"] += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    totals["buckets"][index] += 1
+            for name in ("retries", "backoff", "tokens_in", "tokens_out", "bytes_out", "bytes_in"):
+                totals[name] += getattr(record, name)
+            run = self._runs.get(record.run) if record.run else None
+        if run:
+            run.add(record)
+
+    @contextmanager
+    def timed(self, api: str, op: str, **fields):
+        """Records the wall time of the block (ok=False if it raises)."""
+        started = time.monotonic()
+        ok = True
+        try:
+            yield
+        except Exception:
+            ok = False
+            raise
+        finally:
+            self.record(api, op, time.monotonic() - started, ok=ok, **fields)
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            totals = [(key, dict(value, buckets=list(value["buckets"]))) for key, value in self._totals.items()]
+        lines = []
+
+        def family(name, kind, help_text, samples: Iterable):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        def labels(api, op, **extra):
+            pairs = {"api": api, "op": op, **extra}
+            return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs.items()) + "}"
+
+        family("prompt_writer_api_calls_total", "counter", "External API calls.",
+               (f"prompt_writer_api_calls_total{labels(api, op)} {t['calls']}" for (api, op), t in totals))
+        family("prompt_writer_api_errors_total", "counter", "External API calls that failed.",
+               (f"prompt_writer_api_errors_total{labels(api, op)} {t['errors']}" for (api, op), t in totals))
+        histogram = []
+        for (api, op), t in totals:
+            for bound, count in zip(LATENCY_BUCKETS, t["buckets"]):
+                histogram.append(f"prompt_writer_api_seconds_bucket{labels(api, op, le=bound)} {count}")
+            histogram.append(f"prompt_writer_api_seconds_bucket{labels(api, op, le='+Inf')} {t['calls']}")
+            histogram.append(f"prompt_writer_api_seconds_sum{labels(api, op)} {t['seconds']:.6f}")
+            histogram.append(f"prompt_writer_api_seconds_count{labels(api, op)} {t['calls']}")
+        family("prompt_writer_api_seconds", "histogram", "Wall time of external API calls (incl. retries and backoff).", histogram)
+        family("prompt_writer_api_retries_total", "counter", "Retries of external API calls.",
+               (f"prompt_writer_api_retries_total{labels(api, op)} {t['retries']}" for (api, op), t in totals))
+        family("prompt_writer_api_backoff_seconds_total", "counter", "Time spent backing off before retries.",
+               (f"prompt_writer_api_backoff_seconds_total{labels(api, op)} {t['backoff']:.6f}" for (api, op), t in totals))
+        family("prompt_writer_tokens_total", "counter", "Gemini tokens by direction.",
+               (f"prompt_writer_tokens_total{labels(api, op, direction=direction)} {t['tokens_' + direction]}"
+                for (api, op), t in totals if t["tokens_in"] or t["tokens_out"] for direction in ("in", "out")))
+        family("prompt_writer_bytes_total", "counter", "HTTP payload bytes by direction.",
+               (f"prompt_writer_bytes_total{labels(api, op, direction=direction)} {t['bytes_' + direction]}"
+                for (api, op), t in totals if t["bytes_in"] or t["bytes_out"] for direction in ("in", "out")))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(path + ".tmp", path)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def http_operation(method: str, url: str) -> str:
+    """Low-cardinality operation name for a request: "POST posts/{id}", "GET values:batchGet"."""
+    path = url.split("?", 1)[0].split("://", 1)[-1]
+    segments = [segment for segment in path.split("/")[1:] if segment]
+    segments = ["{id}" if _ID_SEGMENT.match(segment) else segment for segment in segments]
+    return f"{method} {'/'.join(segments[-2:])}"
+
+
+def instrument_session(session, api: str):
+    """Records every response of a requests.Session (wall time to response, bytes) under api."""
+    if session is None or getattr(session, "_metrics_api", None):
+        return session
+    session._metrics_api = api
+
+    def on_response(response, *args, **kwargs):
+        request = response.request
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        METRICS.record(
+            api, http_operation(request.method, request.url), response.elapsed.total_seconds(),
+            ok=response.status_code < 400,
+            bytes_out=len(body) if isinstance(body, bytes) else 0,
+            bytes_in=int(response.headers.get("Content-Length") or 0),
+        )
+        return response
+
+    session.hooks.setdefault("response", []).append(on_response)
+    return session
+
+
+METRICS = MetricsRegistry()
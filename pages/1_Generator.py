@@ -1,87 +1,130 @@
-import streamlit as st
-import json
-import os
-from main import process_batch
-
-st.set_page_config(page_title="Generator - Auto Writer", page_icon="🚀", layout="wide")
-
-st.title("🚀 記事作成 (Generator)")
-
-# 1. Load Local Configs
-PROMPTS_FILE = "config/prompts.json"
-RULES_FILE = "config/common_rules.md"
-
-def load_local_config():
-    prompts = {}
-    if os.path.exists(PROMPTS_FILE):
-        with open(PROMPTS_FILE, 'r', encoding='utf-8') as f:
-            prompts = json.load(f)
-            
-    rules = ""
-    if os.path.exists(RULES_FILE):
-        with open(RULES_FILE, 'r', encoding='utf-8') as f:
-            rules = f.read()
-    return prompts, rules
-
-manual_prompts, manual_rules = load_local_config()
-
-# 2. UI Inputs
-if "api_key" not in st.session_state or not st.session_state["api_key"]:
-    st.warning("⚠️ API Keyが設定されていません。Homeに戻って設定してください。")
-    st.stop()
-
-col1, col2 = st.columns([2, 1])
-
-with col1:
-    sheet_url = st.text_input("Google Sheet URL", placeholder="https://docs.google.com/spreadsheets/d/...")
-    dry_run = st.checkbox("ドライラン (API消費なし)", value=False)
-    
-    st.info(f"現在の設定: プロンプト設定数={len(manual_prompts)}種, 共通ルール文字数={len(manual_rules)}文字")
-    
-    # Custom Logger
-    class StreamlitLogger:
-        def __init__(self, log_container, status_placeholder):
-            self.log_container = log_container
-            self.status_placeholder = status_placeholder
-            self.logs = []
-            
-        def log(self, message):
-            self.logs.append(message)
-            self.log_container.code("\n".join(self.logs), language="text")
-            if "Status Update:" in message:
-                status_text = message.replace("Status Update:", "").strip()
-                self.status_placeholder.info(status_text)
-
-    if st.button("実行開始", type="primary"):
-        if not sheet_url:
-            st.error("URLを入力してください")
-        else:
-            log_container = st.empty()
-            with col2:
-                st.subheader("ステータス")
-                status_ph = st.empty()
-                status_ph.info("開始...")
-            
-            logger = StreamlitLogger(log_container, status_ph)
-            
-            try:
-                # Call Main Process with Manual Configs
-                process_batch(
-                    api_key=st.session_state["api_key"],
-                    sheet_url=sheet_url,
-                    dry_run=dry_run,
-                    log_callback=logger.log,
-                    manual_prompts=manual_prompts,       # Inject Local Prompts
-                    manual_common_rules=manual_rules    # Inject Local Rules
-                )
-                st.balloons()
-                st.success("完了しました")
-                status_ph.success("完了")
-            except Exception as e:
-                st.error(f"エラー: {e}")
-                status_ph.error("停止")
-
-with col2:
-    if "status_ph" not in locals():
-        st.subheader("ステータス")
-        st.write("待機中...")
+import streamlit as st
+import time
+from main import process_batch
+from job_runner import JOB_RUNNER
+from events import StreamlitSink
+from config_manager import load_prompts, load_common_rules
+
+st.set_page_config(page_title="Generator - Auto Writer", page_icon="🚀", layout="wide")
+
+st.title("🚀 記事作成 (Generator)")
+
+# 1. Load Local Configs (shared snapshots; re-read only when the files change)
+manual_prompts, manual_rules = load_prompts(), load_common_rules()
+
+# 2. UI Inputs
+if "api_key" not in st.session_state or not st.session_state["api_key"]:
+    st.warning("⚠️ API Keyが設定されていません。Homeに戻って設定してください。")
+    st.stop()
+
+col1, col2 = st.columns([2, 1])
+
+with col1:
+    sheet_url = st.text_input("Google Sheet URL", placeholder="https://docs.google.com/spreadsheets/d/...")
+    dry_run = st.checkbox("ドライラン (API消費なし)", value=False)
+    stream = st.checkbox("ストリーミング (生成中の出力を表示)", value=False)
+    use_context_cache = st.checkbox("コンテキストキャッシュを使う (システム指示の再送信を省略)", value=False)
+    workers = st.slider("並列処理数 (Workers)", min_value=1, max_value=8, value=1, help="同時に処理する行数です。Gemini APIのクォータに応じて調整してください。")
+    
+    st.info(f"現在の設定: プロンプト設定数={len(manual_prompts)}種, 共通ルール文字数={len(manual_rules)}文字")
+    
+    if st.button("実行開始", type="primary"):
+        running = JOB_RUNNER.get(st.session_state.get("job_id"))
+        if not sheet_url:
+            st.error("URLを入力してください")
+        elif running and running.active:
+            st.warning("実行中のジョブがあります。完了または停止してから開始してください。")
+        else:
+            # Runs on a background thread: the batch keeps going if this tab reloads or closes
+            job = JOB_RUNNER.submit(
+                process_batch,
+                label=sheet_url,
+                params={"sheet_url": sheet_url, "dry_run": dry_run, "stream": stream, "workers": workers},
+                api_key=st.session_state["api_key"],
+                sheet_url=sheet_url,
+                dry_run=dry_run,
+                manual_prompts=manual_prompts,       # Inject Local Prompts
+                manual_common_rules=manual_rules,   # Inject Local Rules
+                workers=workers,
+                use_context_cache=use_context_cache,
+                stream=stream
+            )
+            st.session_state["job_id"] = job.id
+            st.query_params["job"] = job.id
+            st.rerun()
+
+# 3. Job View (reattaches after a rerun / reload via session_state or ?job=<id>)
+STATUS_LABELS = {
+    "queued": "待機中",
+    "running": "実行中",
+    "cancelling": "停止中 (実行中のステップの完了待ち)",
+    "completed": "完了",
+    "failed": "エラー",
+    "cancelled": "停止しました",
+    "interrupted": "中断 (アプリが再起動しました)",
+}
+
+recent_jobs = JOB_RUNNER.list_jobs()
+if recent_jobs:
+    jobs_by_id = {job.id: job for job in recent_jobs}
+    job_ids = list(jobs_by_id)
+    current_id = st.session_state.get("job_id") or st.query_params.get("job")
+    selected_id = st.sidebar.selectbox(
+        "ジョブ履歴", job_ids,
+        index=job_ids.index(current_id) if current_id in job_ids else 0,
+        format_func=lambda job_id: f"{job_id} ({STATUS_LABELS.get(jobs_by_id[job_id].status, '')})"
+    )
+    if selected_id != current_id:
+        st.session_state["job_id"] = selected_id
+        st.query_params["job"] = selected_id
+
+job = JOB_RUNNER.get(st.session_state.get("job_id") or st.query_params.get("job"))
+
+with col2:
+    st.subheader("ステータス")
+    if job is None:
+        st.write("待機中...")
+    else:
+        st.caption(f"ジョブ {job.id}: {job.label}")
+        status_text = STATUS_LABELS.get(job.status, job.status)
+        if job.status == "completed":
+            st.success(status_text)
+        elif job.status in ("failed", "interrupted"):
+            st.error(f"{status_text}: {job.error}" if job.error else status_text)
+        elif job.status == "cancelled":
+            st.warning(status_text)
+        else:
+            st.info(status_text)
+        if job.status in ("queued", "running"):
+            if st.button("停止", help="実行中のステップが終わった時点で停止します。途中の行は次回の実行で再開されます。"):
+                job.cancel()
+                st.rerun()
+        if job.rows:
+            st.dataframe(
+                [{"行": row, "状態": info["status"]} for row, info in job.rows.items()],
+                hide_index=True, use_container_width=True
+            )
+
+if job is not None:
+    preview_ph = None
+    if job.params.get("stream"):
+        st.subheader("ライブ出力")
+        preview_ph = st.empty()
+    view = StreamlitSink(st.empty(), preview_placeholder=preview_ph)
+    seen = job.event_count
+    for event in job.tail(300):
+        view.handle(event)
+    view.render(force=True)
+    if job.active:
+        # Follow the background job: only new events are fed to the view (redrawn at most twice a second).
+        # The run does not depend on this page; clicking 停止 or reloading just restarts the script.
+        while job.active:
+            time.sleep(0.5)
+            events, seen = job.events_since(seen)
+            for event in events:
+                view.handle(event)
+            if job.preview:
+                view.set_preview(job.preview)
+            view.render()
+        # Refresh the status panel with the final state
+        st.rerun()
@@ -0,0 +1,159 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+from events import CallbackSink, EventBus
+from metrics import in_context
+
+_DONE = object()
+
+
+class RowPipeline:
+    """
+    Three-stage asyncio pipeline over pending rows: generate -> publish -> record.
+    While row N is posted to WordPress and written back to the sheet, the generation
+    workers are already on the next rows; bounded queues between the stages keep at
+    most queue_size finished rows waiting, so a slow WP or sheet backs up generation
+    instead of buffering the whole batch.
+
+    Items are opaque to the pipeline (process_batch passes (sheet, task) pairs); row_label(item)
+    names the row in events, chunks and metrics.
+
+    The Gemini, WordPress and gspread clients are blocking, so each stage function runs
+    in an executor thread:
+    - generate(item, log, chunk) -> payload, or None when the row is skipped/interrupted
+    - publish(payload, log) -> payload
+    - record(payload, log)
+    With publish_many(payloads, logs) -> payloads, a publisher takes every row already
+    waiting in the queue (up to publish_batch_size) in one call; it never waits for more
+    rows, so batching only kicks in when rows finish faster than they are published.
+    Stage functions never publish to the event bus / chunk_callback directly: their
+    row-scoped log (an events.RowEmitter: call it to log, .emit() for typed events) and
+    chunk functions are marshalled onto the event loop, i.e. the thread that called run()
+    (Streamlit loggers only work there). Without events, log_callback gets the text lines.
+    Stage calls run in a copy of the caller's context with the row in the metrics scope, so
+    external calls are attributed to the run (metrics.scope set around run()) and the row.
+
+    The first exception stops the intake of new rows; rows already generated still go
+    through publish/record, then the exception is re-raised from run(). Setting stop_event
+    (a threading.Event) stops the intake the same way, without an error.
+    """
+
+    def __init__(self, generate: Callable, publish: Callable, record: Callable, workers: int = 1,
+                 publishers: int = 2, queue_size: Optional[int] = None, log_callback=print,
+                 chunk_callback=None, row_label: Callable = lambda item: item.get("row_index"),
+                 publish_many: Optional[Callable] = None, publish_batch_size: int = 25, stop_event=None,
+                 events: Optional[EventBus] = None):
+        self.generate = generate
+        self.publish = publish
+        self.record = record
+        self.workers = max(1, workers)
+        self.publishers = max(1, publishers)
+        self.queue_size = queue_size or self.workers * 2
+        self.events = events or EventBus([CallbackSink(log_callback)])
+        self.chunk_callback = chunk_callback
+        self.row_label = row_label
+        self.publish_many = publish_many
+        self.publish_batch_size = publish_batch_size
+        self.stop_event = stop_event
+
+    def run(self, items: Iterable) -> int:
+        """Synchronous entry point; returns the number of rows taken from items."""
+        return asyncio.run(self.run_async(items))
+
+    async def run_async(self, items: Iterable) -> int:
+        loop = asyncio.get_running_loop()
+        iterator = iter(items)
+        to_publish = asyncio.Queue(self.queue_size)
+        to_record = asyncio.Queue(self.queue_size)
+        intake_lock = asyncio.Lock()
+        errors = []
+        started = 0
+
+        generate_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="row-generate")
+        # Publishers + the recorder + the task iterator (its pages are read lazily from the sheet)
+        io_pool = ThreadPoolExecutor(max_workers=self.publishers + 2, thread_name_prefix="row-io")
+
+        def row_log(item):
+            return self.events.for_row(self.row_label(item), lambda event: loop.call_soon_threadsafe(self.events.publish, event))
+
+        def row_chunk(item):
+            if not self.chunk_callback:
+                return None
+            label = self.row_label(item)
+            return lambda step, text: loop.call_soon_threadsafe(self.chunk_callback, label, step, text)
+
+        async def generator():
+            nonlocal started
+            while not errors and not (self.stop_event and self.stop_event.is_set()):
+                async with intake_lock:
+                    item = await loop.run_in_executor(io_pool, in_context(next), iterator, _DONE)
+                    if item is _DONE:
+                        return
+                    started += 1
+                try:
+                    payload = await loop.run_in_executor(generate_pool, in_context(self.generate, row=self.row_label(item)), item, row_log(item), row_chunk(item))
+                except Exception as e:
+                    errors.append(e)
+                    return
+                if payload is not None:
+                    await to_publish.put((item, payload))
+
+        async def publisher():
+            while True:
+                entry = await to_publish.get()
+                if entry is _DONE:
+                    return
+                entries = [entry]
+                finished = False
+                # Greedy batch: whatever is already queued, without waiting for more rows
+                while self.publish_many and len(entries) < self.publish_batch_size and not to_publish.empty():
+                    entry = to_publish.get_nowait()
+                    if entry is _DONE:
+                        finished = True
+                        break
+                    entries.append(entry)
+                items = [item for item, _payload in entries]
+                try:
+                    if len(entries) > 1:
+                        payloads = await loop.run_in_executor(
+                            io_pool, in_context(self.publish_many), [payload for _item, payload in entries], [row_log(item) for item in items])
+                    else:
+                        payloads = [await loop.run_in_executor(io_pool, in_context(self.publish, row=self.row_label(items[0])), entries[0][1], row_log(items[0]))]
+                except Exception as e:
+                    errors.append(e)
+                    payloads = []
+                for item, payload in zip(items, payloads):
+                    await to_record.put((item, payload))
+                if finished:
+                    return
+
+        async def recorder():
+            while True:
+                entry = await to_record.get()
+                if entry is _DONE:
+                    return
+                item, payload = entry
+                try:
+                    await loop.run_in_executor(io_pool, in_context(self.record, row=self.row_label(item)), payload, row_log(item))
+                except Exception as e:
+                    errors.append(e)
+
+        try:
+            recording = asyncio.create_task(recorder())
+            publishing = [asyncio.create_task(publisher()) for _ in range(self.publishers)]
+            await asyncio.gather(*(generator() for _ in range(self.workers)))
+            for _ in publishing:
+                await to_publish.put(_DONE)
+            await asyncio.gather(*publishing)
+            await to_record.put(_DONE)
+            await recording
+        finally:
+            generate_pool.shutdown(wait=True)
+            io_pool.shutdown(wait=True)
+            # Flush log lines scheduled by the last stage calls
+            await asyncio.sleep(0)
+
+        if errors:
+            raise errors[0]
+        return started
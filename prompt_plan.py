@@ -0,0 +1,222 @@
+import json
+import string
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, List, Tuple
+
+from chat_history import referenced_steps
+from step_journal import StepJournal
+
+# Legacy single-string steps: "**【実行内容】** ... **【自己チェック】** ..."
+EXEC_MARKER = "**【実行内容】**"
+CHECK_MARKER = "**【自己チェック】**"
+
+# Placeholders each kind of prompt is filled with per row
+INITIAL_FIELDS = ("main_kw", "sub_kws", "goal", "slug")
+STEP_FIELDS = ("slug", "main_kw")
+
+_FORMATTER = string.Formatter()
+
+
+def split_step_prompt(value) -> Tuple[str, str]:
+    """(exec, check) texts of a step, from the editor's dict or a legacy string."""
+    if isinstance(value, Mapping):
+        return str(value.get("exec", "") or ""), str(value.get("check", "") or "")
+    value = "" if value is None else str(value)
+    if CHECK_MARKER in value:
+        parts = value.split(CHECK_MARKER)
+        return parts[0].replace(EXEC_MARKER, "").strip(), parts[1].strip()
+    return value, ""
+
+
+def step_dependencies(prompt_dict: Dict[str, object]) -> "OrderedDict[str, List[str]]":
+    """
+    Direct dependencies of every STEP key, from the optional "depends_on" list of a step.
+    A step without depends_on depends on the step before it (the original sequential flow);
+    an empty list means it only needs Initial. Only Initial or earlier steps may be named,
+    so the graph is acyclic by construction.
+    """
+    dependencies = OrderedDict()
+    previous = "Initial"
+    for step in [k for k in prompt_dict.keys() if k.startswith("STEP")]:
+        prompt_data = prompt_dict[step]
+        declared = prompt_data.get("depends_on") if isinstance(prompt_data, Mapping) else None
+        if declared is None:
+            dependencies[step] = [previous]
+        else:
+            if isinstance(declared, str):
+                declared = [declared]
+            unknown = [name for name in declared if name != "Initial" and name not in dependencies]
+            if unknown:
+                raise ValueError(f"{step}: depends_on must name Initial or earlier steps (got {', '.join(unknown)})")
+            dependencies[step] = list(declared) or ["Initial"]
+        previous = step
+    return dependencies
+
+
+def step_lineage(dependencies: "OrderedDict[str, List[str]]") -> Dict[str, List[str]]:
+    """All upstream steps of each step (transitively, Initial first, in flow order)."""
+    order = ["Initial"] + list(dependencies)
+    lineage = {"Initial": []}
+    for step, direct in dependencies.items():
+        upstream = set()
+        for name in direct:
+            upstream.add(name)
+            upstream.update(lineage[name])
+        lineage[step] = sorted(upstream, key=order.index)
+    return lineage
+
+
+def critical_path_length(dependencies: "OrderedDict[str, List[str]]") -> int:
+    """Number of steps on the longest dependency chain (Initial excluded)."""
+    depth = {"Initial": 0}
+    for step, direct in dependencies.items():
+        depth[step] = 1 + max(depth[name] for name in direct)
+    return max(depth.values())
+
+
+class PromptPlanError(ValueError):
+    """A prompt definition that cannot be run at all (no Initial prompt, broken depends_on)."""
+
+
+class PromptTemplate:
+    """
+    A prompt text parsed once into literal chunks and placeholder names.
+    render() only joins strings. A text str.format would reject (unknown placeholder,
+    stray brace, format spec) is kept verbatim and reported in error, which is what the
+    per-row formatting used to fall back to.
+    """
+
+    __slots__ = ("text", "fields", "error", "_chunks")
+
+    def __init__(self, text: str, allowed: Tuple[str, ...]):
+        self.text = text
+        self.error = None
+        chunks = []
+        try:
+            for literal, field, spec, conversion in _FORMATTER.parse(text):
+                if field is None:
+                    chunks.append((literal, None))
+                elif field not in allowed:
+                    raise KeyError(field)
+                elif spec or conversion:
+                    raise ValueError(f"format spec on {{{field}}}")
+                else:
+                    chunks.append((literal, field))
+        except (KeyError, ValueError) as e:
+            self.error = f"{type(e).__name__}: {e}"
+            chunks = [(text, None)]
+        self._chunks = tuple(chunks)
+        self.fields = tuple(sorted({field for _literal, field in self._chunks if field}))
+
+    def render(self, values: Dict[str, str]) -> str:
+        return "".join(literal + str(values[field]) if field else literal for literal, field in self._chunks)
+
+    def __bool__(self):
+        return bool(self.text)
+
+
+class PromptStep:
+    __slots__ = ("name", "exec_template", "check_template", "depends_on", "lineage")
+
+    def __init__(self, name, exec_template, check_template, depends_on, lineage):
+        self.name = name
+        self.exec_template = exec_template
+        self.check_template = check_template
+        self.depends_on = depends_on
+        self.lineage = lineage
+
+    def render(self, slug: str, main_kw: str) -> Tuple[str, str]:
+        """(exec, check) texts for one row; check is "" when the step has no self-check."""
+        values = {"slug": slug, "main_kw": main_kw}
+        return self.exec_template.render(values), self.check_template.render(values)
+
+
+class PromptPlan:
+    """
+    One article type's prompt definition (prompts.json entry or sheet tab), compiled once:
+    the Initial template, the STEP templates in flow order with their dependencies and
+    lineage, the step -> sheet column mappings, the steps later prompts mention by name
+    and the content version used by the step journal. Per row only the slots are filled.
+    errors lists the prompts that were kept verbatim because they cannot be formatted.
+    """
+
+    __slots__ = ("name", "source", "version", "initial", "steps", "dependencies", "step_columns",
+                 "referenced_steps", "errors")
+
+    def __init__(self, prompt_dict: Dict[str, object], name: str = ""):
+        self.name = name
+        self.source = prompt_dict
+        self.version = StepJournal.prompt_version(prompt_dict)
+        self.errors = []
+
+        initial_text, _check = split_step_prompt(prompt_dict.get("Initial", ""))
+        if not initial_text:
+            raise PromptPlanError("No 'Initial' prompt found.")
+        self.initial = self._template("Initial", initial_text, INITIAL_FIELDS)
+
+        try:
+            self.dependencies = step_dependencies(prompt_dict)
+        except ValueError as e:
+            raise PromptPlanError(str(e)) from e
+        lineage = step_lineage(self.dependencies)
+        self.steps = OrderedDict()
+        for step, depends_on in self.dependencies.items():
+            exec_text, check_text = split_step_prompt(prompt_dict[step])
+            self.steps[step] = PromptStep(
+                step,
+                self._template(step, exec_text, STEP_FIELDS),
+                self._template(f"{step} (check)", check_text, STEP_FIELDS),
+                tuple(depends_on),
+                tuple(lineage[step]),
+            )
+
+        self.step_columns = self._resolve_mappings(prompt_dict.get("mappings") or {})
+        self.referenced_steps = frozenset(referenced_steps(prompt_dict))
+
+    def _template(self, label: str, text: str, allowed: Tuple[str, ...]) -> PromptTemplate:
+        template = PromptTemplate(text, allowed)
+        if template.error:
+            self.errors.append(f"{label}: {template.error} (used without formatting)")
+        return template
+
+    def _resolve_mappings(self, mappings) -> Dict[str, int]:
+        """{step: column} for mappings entries with a "col" (sheet tabs hold them as JSON text)."""
+        if isinstance(mappings, str):
+            try:
+                mappings = json.loads(mappings)
+            except ValueError as e:
+                self.errors.append(f"mappings: {e}")
+                return {}
+        if not isinstance(mappings, Mapping):
+            self.errors.append("mappings: expected an object")
+            return {}
+        columns = {}
+        for step, mapping in mappings.items():
+            col = mapping.get("col") if isinstance(mapping, Mapping) else None
+            if col:
+                try:
+                    columns[step] = int(col)
+                except (TypeError, ValueError):
+                    self.errors.append(f"mappings: {step}: invalid column {col!r}")
+        return columns
+
+    @property
+    def step_order(self) -> List[str]:
+        return ["Initial"] + list(self.steps)
+
+    @property
+    def lineage(self) -> Dict[str, Tuple[str, ...]]:
+        lineage = {"Initial": ()}
+        lineage.update((step, plan_step.lineage) for step, plan_step in self.steps.items())
+        return lineage
+
+    def render_initial(self, main_kw: str, sub_kws: str, goal: str, slug: str) -> str:
+        return self.initial.render({"main_kw": main_kw, "sub_kws": sub_kws, "goal": goal, "slug": slug})
+
+
+def compile_prompts(prompt_dict, name: str = "") -> PromptPlan:
+    """PromptPlan for a prompt definition (a plan is returned as is). Raises PromptPlanError."""
+    if isinstance(prompt_dict, PromptPlan):
+        return prompt_dict
+    return PromptPlan(prompt_dict, name)
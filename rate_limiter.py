@@ -0,0 +1,171 @@
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from events import run_log
+
+
+class TokenBucket:
+    """Classic token bucket: `capacity` tokens, refilled continuously at `rate` tokens/second."""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Takes `amount` tokens (possibly going into debt) and returns how long the caller must wait."""
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def adjust(self, amount: float):
+        """Corrects an earlier reservation (positive = refund, negative = extra debit)."""
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """
+    Process-wide limiter for Gemini calls, safe to share between threads.
+    - Requests are paced by token buckets built from RPM / TPM limits (0 = unlimited).
+    - Retryable errors (429, 5xx, timeouts) back off exponentially with full jitter,
+      or for exactly as long as the server asks when it sends a retry delay.
+    - Other errors are raised immediately.
+    Counters separate time spent throttled (bucket waits + backoff) from time spent in the API.
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, max_retries: int = 8, base_delay: float = 2.0, max_delay: float = 120.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = TokenBucket(rpm, rpm / 60.0) if rpm else None
+        self._tokens = TokenBucket(tpm, tpm / 60.0) if tpm else None
+        self._lock = threading.Lock()
+
+        # Counters
+        self.calls = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+        self.api_seconds = 0.0
+
+    def acquire(self, estimated_tokens: int = 0):
+        """Blocks until the request fits the RPM/TPM budget."""
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            if self._requests:
+                wait = max(wait, self._requests.reserve(1, now))
+            if self._tokens and estimated_tokens:
+                wait = max(wait, self._tokens.reserve(estimated_tokens, now))
+        if wait > 0:
+            self._sleep(wait)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """Settles a TPM reservation once the real token count is known."""
+        if self._tokens and actual_tokens:
+            with self._lock:
+                self._tokens.adjust(estimated_tokens - actual_tokens)
+
+    def call(self, fn: Callable[[], Any], estimated_tokens: int = 0, label: str = "Gemini", on_retry: Optional[Callable[[int, float, Exception], None]] = None) -> Any:
+        """Runs fn() under the limiter, retrying transient failures."""
+        attempt = 0
+        while True:
+            self.acquire(estimated_tokens)
+            started = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                self._record_call(started)
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt, e)
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                if on_retry:
+                    # The caller reports the retry (RETRY event)
+                    on_retry(attempt, delay, e)
+                else:
+                    run_log(f"[{label}] {type(e).__name__}: retrying in {delay:.1f}s (Attempt {attempt}/{self.max_retries})")
+                self._sleep(delay)
+                continue
+            self._record_call(started)
+            return result
+
+    def backoff_delay(self, attempt: int, error: Exception) -> float:
+        server_delay = retry_delay_from_error(error)
+        if server_delay is not None:
+            # Small jitter so workers told the same delay don't retry in lockstep
+            return min(self.max_delay, server_delay) + random.uniform(0, 1)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def stats(self) -> str:
+        return (f"{self.calls} calls, {self.retries} retries, "
+                f"{self.api_seconds:.1f}s in API, {self.throttled_seconds:.1f}s throttled")
+
+    def _record_call(self, started: float):
+        with self._lock:
+            self.calls += 1
+            self.api_seconds += time.monotonic() - started
+
+    def _sleep(self, seconds: float):
+        with self._lock:
+            self.throttled_seconds += seconds
+        time.sleep(seconds)
+
+
+def is_retryable(error: Exception) -> bool:
+    """429, 5xx and timeouts are worth retrying; everything else (400, 403, 404...) is not."""
+    try:
+        from google.api_core import exceptions
+        retryable = tuple(getattr(exceptions, name) for name in (
+            "ResourceExhausted", "TooManyRequests", "InternalServerError", "BadGateway",
+            "ServiceUnavailable", "GatewayTimeout", "DeadlineExceeded",
+        ) if hasattr(exceptions, name))
+        if isinstance(error, retryable):
+            return True
+    except ImportError:
+        pass
+    return isinstance(error, (TimeoutError, ConnectionError))
+
+
+_RETRY_IN_PATTERN = re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE)
+_RETRY_DELAY_PATTERN = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE)
+
+
+def retry_delay_from_error(error: Exception) -> Optional[float]:
+    """Extracts the server-provided retry delay (google.rpc.RetryInfo or the message text)."""
+    for detail in getattr(error, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "seconds"):
+            return delay.seconds + getattr(delay, "nanos", 0) / 1e9
+    message = str(error)
+    for pattern in (_RETRY_IN_PATTERN, _RETRY_DELAY_PATTERN):
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+_gemini_limiter = None
+_gemini_limiter_lock = threading.Lock()
+
+
+def get_gemini_limiter() -> RateLimiter:
+    """The limiter shared by every AIHandler in this process (limits from GEMINI_RPM / GEMINI_TPM)."""
+    global _gemini_limiter
+    with _gemini_limiter_lock:
+        if _gemini_limiter is None:
+            from config_manager import get_gemini_rate_limits
+            rpm, tpm = get_gemini_rate_limits()
+            _gemini_limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        return _gemini_limiter
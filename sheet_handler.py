@@ -1,132 +1,535 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from typing import List, Dict, Any
-
-class SheetHandler:
-    def __init__(self, credentials_path: str = None, credentials_dict: Dict[str, Any] = None):
-        self.scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        if credentials_dict:
-            self.creds = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, self.scope)
-        else:
-            self.creds = ServiceAccountCredentials.from_json_keyfile_name(credentials_path, self.scope)
-        self.client = gspread.authorize(self.creds)
-        self.sheet = None
-
-    def connect(self, sheet_url: str, worksheet_name: str = None):
-        """Connects to a specific spreadsheet and worksheet."""
-        try:
-            spreadsheet = self.client.open_by_url(sheet_url)
-            if worksheet_name:
-                self.sheet = spreadsheet.worksheet(worksheet_name)
-            else:
-                self.sheet = spreadsheet.sheet1
-            print(f"Connected to sheet: {spreadsheet.title}")
-        except Exception as e:
-            print(f"Error connecting to sheet: {e}")
-            raise
-
-    def get_pending_tasks(self) -> List[Dict[str, Any]]:
-        """
-        Retrieves rows where Status (Col A) is empty or specific value.
-        Assumes headers are in the first row.
-        """
-        all_records = self.sheet.get_all_records()
-        pending = []
-        # Enumerate to keep track of row index (1-based for gspread update)
-        # get_all_records returns a list of dictionaries. 
-        # The row index in sheet is i + 2 (1 for header, 1 for 0-index offset)
-        for i, record in enumerate(all_records):
-            # Check if 'Status' is empty or 'Ready' (adjust based on user pref)
-            # User request: A=Status, B=MainKW.
-            # We assume header names: Status, MainKW, SubKW1, SubKW2, Goal, SiteName, Slug, DraftURL, ImagePrompts
-            status = str(record.get('Status', '')).strip()
-            # Allow various "pending" statuses
-            allowed_statuses = ['', '未着手', ',', '待機中', '指示待ち']
-            if status in allowed_statuses:
-                task = record.copy()
-                task['row_index'] = i + 2
-                pending.append(task)
-        return pending
-
-    def update_task_complete(self, row_index: int, draft_url: str, image_prompts: str, title: str = "", description: str = "", html_content: str = ""):
-        """Updates the row with completion status and details."""
-        # Col A(1)=Status, H(8)=DraftURL, I(9)=ImagePrompts
-        # New: J(10)=Title, K(11)=Description, L(12)=Content
-        try:
-            # Preparing a batch update could be more efficient, but checking types first
-            cells = [
-                gspread.Cell(row_index, 1, "完了"),
-                gspread.Cell(row_index, 8, draft_url),
-                gspread.Cell(row_index, 9, image_prompts),
-                gspread.Cell(row_index, 10, title),
-                gspread.Cell(row_index, 11, description),
-                gspread.Cell(row_index, 12, html_content) # Content is usually large
-            ]
-            # Use update_cells if possible, but standard gspread usage:
-            self.sheet.update_cell(row_index, 1, "完了")
-            self.sheet.update_cell(row_index, 8, draft_url)
-            self.sheet.update_cell(row_index, 9, image_prompts)
-            self.sheet.update_cell(row_index, 10, title)
-            self.sheet.update_cell(row_index, 11, description)
-            if len(html_content) > 49000:
-                print(f"Warning: Content length {len(html_content)} may exceed cell limit.")
-            self.sheet.update_cell(row_index, 12, html_content)
-
-            print(f"Updated row {row_index} as Complete.")
-        except Exception as e:
-            print(f"Error updating row {row_index}: {e}")
-
-    def update_status(self, row_index: int, status: str):
-        """Updates just the status column."""
-        try:
-            self.sheet.update_cell(row_index, 1, status)
-        except Exception as e:
-            print(f"Error updating status for row {row_index}: {e}")
-
-    def update_any_cell(self, row_index: int, col_index: int, value: str):
-        """Updates any specific cell."""
-        try:
-            self.sheet.update_cell(row_index, col_index, value)
-        except Exception as e:
-            print(f"Error updating cell ({row_index}, {col_index}): {e}")
-
-    def get_prompts_from_tab(self, tab_name: str) -> Dict[str, str]:
-        """
-        Reads Key-Value pairs from a specific tab.
-        """
-        try:
-            # Access parent spreadsheet from current worksheet
-            spreadsheet = self.sheet.spreadsheet 
-            ws = spreadsheet.worksheet(tab_name)
-            records = ws.get_all_records() # Expects headers: Key, Value
-            prompts = {r['Key']: r['Value'] for r in records if r.get('Key')}
-            return prompts
-        except gspread.WorksheetNotFound:
-            print(f"Tab '{tab_name}' not found.")
-            return {}
-        except AttributeError:
-             # Fallback if self.sheet is actually spreadsheet (though connect() sets it to worksheet)
-             try:
-                 ws = self.sheet.worksheet(tab_name)
-                 records = ws.get_all_records()
-                 prompts = {r['Key']: r['Value'] for r in records if r.get('Key')}
-                 return prompts
-             except:
-                 print(f"Error accessing tab '{tab_name}' (AttributeError).")
-                 return {}
-        except Exception as e:
-            print(f"Error reading tab '{tab_name}': {e}")
-            return {}
-
-    def get_common_rules(self, tab_name: str = "共通ルール") -> str:
-        """
-        Reads all values from the 'Value' column of the specified tab and joins them.
-        Assumes the tab has 'Key' and 'Value' headers like other prompt tabs.
-        """
-        prompts = self.get_prompts_from_tab(tab_name)
-        if not prompts:
-            return ""
-        
-        # Sort by Key if possible, or just join values
-        # We'll just join all values with newlines
-        return "\n\n".join(prompts.values())
+import json
+import os
+import threading
+import time
+import gspread
+from gspread.urls import DRIVE_FILES_API_V3_URL
+from gspread.utils import ValueInputOption, rowcol_to_a1
+from oauth2client.service_account import ServiceAccountCredentials
+from typing import List, Dict, Any, Tuple, Iterator
+from metrics import in_context, instrument_session
+from events import run_log
+
+# Status values that mark a row as waiting to be processed
+PENDING_STATUSES = ['', '未着手', ',', '待機中', '指示待ち']
+
+# Rows whose flow failed mid-way ("中断: STEP 5 ...") are picked up again and resume from the journal
+INTERRUPTED_STATUS_PREFIX = "中断"
+
+# Final status of a processed row
+COMPLETED_STATUS = "完了"
+
+# Status prefixes written while a row is being processed; a killed run leaves rows in one of these
+IN_PROGRESS_STATUS_PREFIXES = ("開始", "STEP", "Initial")
+
+# Columns read for each pending row (outputs J..Q are never downloaded by the scan)
+INPUT_COLUMNS = ["MainKW", "SubKW1", "SubKW2", "Goal", "SiteName", "Slug", "ArticleType"]
+
+
+class TabCache:
+    """
+    Process-wide cache of Key/Value tabs (prompt tabs, 共通ルール), shared by every SheetHandler.
+    Entries live for ttl seconds and are persisted to path so consecutive CLI runs reuse them too.
+    SheetHandler.refresh_tab_cache() drops a spreadsheet's entries early when its Drive
+    modifiedTime changed (Drive can't tell which tab changed, so any edit counts, ours included).
+    """
+
+    def __init__(self, ttl: float = 600, path: str = "data/tab_cache.json"):
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded = False
+        # spreadsheet_id -> {"revision": str, "tabs": {tab_name: {"fetched_at": float, "value": dict}}}
+        self._sheets: Dict[str, Dict[str, Any]] = {}
+
+    def get(self, spreadsheet_id: str, tab_name: str):
+        """Returns the cached tab dict, or None if missing or expired."""
+        with self._lock:
+            self._load()
+            entry = self._sheets.get(spreadsheet_id, {}).get("tabs", {}).get(tab_name)
+            if entry and time.time() - entry["fetched_at"] < self.ttl:
+                return entry["value"]
+            return None
+
+    def put(self, spreadsheet_id: str, tab_name: str, value: Dict[str, Any]):
+        with self._lock:
+            self._load()
+            sheet = self._sheets.setdefault(spreadsheet_id, {"revision": "", "tabs": {}})
+            sheet["tabs"][tab_name] = {"fetched_at": time.time(), "value": value}
+            self._save()
+
+    def check_revision(self, spreadsheet_id: str, revision: str) -> bool:
+        """Records the spreadsheet revision. Returns True if cached tabs were invalidated."""
+        with self._lock:
+            self._load()
+            sheet = self._sheets.setdefault(spreadsheet_id, {"revision": "", "tabs": {}})
+            changed = bool(sheet["revision"]) and sheet["revision"] != revision
+            if changed:
+                sheet["tabs"] = {}
+            sheet["revision"] = revision
+            self._save()
+            return changed
+
+    def clear(self):
+        with self._lock:
+            self._sheets = {}
+            self._loaded = True
+            self._save()
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._sheets = json.load(f)
+            except Exception as e:
+                print(f"Ignoring unreadable tab cache {self.path}: {e}")
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._sheets, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Error saving tab cache: {e}")
+
+
+TAB_CACHE = TabCache()
+
+
+class SheetWriteBuffer:
+    """
+    Write-behind buffer for worksheet cells.
+    Writes are queued per (row, col) and sent as one values.batchUpdate request when
+    max_cells are pending or the oldest write is max_delay seconds old.
+    A newer value for a queued cell replaces the older one, so a burst of
+    status changes costs a single write. on_flush(cells) is called after every request sent.
+    """
+
+    def __init__(self, worksheet, api_lock, max_cells: int = 50, max_delay: float = 5.0, on_flush=None):
+        self.worksheet = worksheet
+        self.max_cells = max_cells
+        self.max_delay = max_delay
+        self.on_flush = on_flush
+        # api_lock is shared with SheetHandler: it serializes gspread calls and keeps flushes in order
+        self._api_lock = api_lock
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[int, int], Any] = {}
+        self._oldest = None
+        self._closed = threading.Event()
+
+        # Stats
+        self.requests = 0
+        self.cells_written = 0
+        self.cells_superseded = 0
+
+        # Background flushes count towards the run that enabled the buffer
+        self._flusher = threading.Thread(target=in_context(self._flush_loop), name="sheet-write-buffer", daemon=True)
+        self._flusher.start()
+
+    def put(self, row: int, col: int, value: Any):
+        """Queues a cell write, replacing any unsent value for the same cell."""
+        with self._lock:
+            key = (row, col)
+            if key in self._pending:
+                self.cells_superseded += 1
+                # Re-insert so the cell keeps the position of its latest write
+                del self._pending[key]
+            self._pending[key] = value
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = len(self._pending) >= self.max_cells
+        if full:
+            self.flush()
+
+    def complete_row(self, row: int, status: str = COMPLETED_STATUS):
+        """
+        Queues the final status and flushes.
+        The status is sent in the same request as every other pending cell of the row,
+        so a row can never be visible as 完了 with its content still unwritten.
+        Raises if the request fails; the status is then withdrawn (the row stays pending)
+        while its other cells stay queued.
+        """
+        self.put(row, 1, status)
+        try:
+            self.flush()
+        except Exception:
+            with self._lock:
+                if self._pending.get((row, 1)) == status:
+                    del self._pending[(row, 1)]
+            raise
+
+    def flush(self):
+        """Sends every pending cell in one request. Failed cells are re-queued unless superseded."""
+        with self._api_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._oldest = None
+            if not batch:
+                return
+            try:
+                self.worksheet.batch_update(self._to_ranges(batch), value_input_option=ValueInputOption.user_entered)
+                self.requests += 1
+                self.cells_written += len(batch)
+                if self.on_flush:
+                    self.on_flush(len(batch))
+            except Exception:
+                with self._lock:
+                    for key, value in batch.items():
+                        self._pending.setdefault(key, value)
+                    if self._pending and self._oldest is None:
+                        self._oldest = time.monotonic()
+                raise
+
+    def close(self):
+        """Stops the background flusher and sends whatever is still queued."""
+        self._closed.set()
+        self._flusher.join(timeout=self.max_delay + 1)
+        self.flush()
+
+    def _flush_loop(self):
+        interval = min(1.0, self.max_delay)
+        while not self._closed.wait(interval):
+            with self._lock:
+                due = self._oldest is not None and time.monotonic() - self._oldest >= self.max_delay
+            if due:
+                try:
+                    self.flush()
+                except Exception as e:
+                    # Cells stay queued for the next attempt
+                    run_log(f"Error flushing buffered sheet writes (kept queued): {e}")
+
+    @staticmethod
+    def _to_ranges(batch: Dict[Tuple[int, int], Any]) -> List[Dict[str, Any]]:
+        """One range per row covering its pending columns. Gaps are sent as None, which the API skips."""
+        rows: Dict[int, Dict[int, Any]] = {}
+        for (row, col), value in batch.items():
+            rows.setdefault(row, {})[col] = value
+        data = []
+        for row, cols in rows.items():
+            first, last = min(cols), max(cols)
+            values = [cols.get(col) for col in range(first, last + 1)]
+            data.append({
+                "range": f"{rowcol_to_a1(row, first)}:{rowcol_to_a1(row, last)}",
+                "values": [values],
+            })
+        return data
+
+
+class SheetHandler:
+    def __init__(self, credentials_path: str = None, credentials_dict: Dict[str, Any] = None, tab_cache: "TabCache" = None, client=None):
+        """client: an authorized gspread client (or a stand-in, see benchmarks/fakes.py); skips the credentials."""
+        if tab_cache is None:
+            tab_cache = TAB_CACHE
+        self.scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+        self.creds = None
+        if client is None:
+            if credentials_dict:
+                self.creds = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, self.scope)
+            else:
+                self.creds = ServiceAccountCredentials.from_json_keyfile_name(credentials_path, self.scope)
+            client = gspread.authorize(self.creds)
+        self.client = client
+        # Every Sheets API request is timed (gspread 6 keeps its session on http_client, 5 on the client)
+        instrument_session(getattr(getattr(self.client, "http_client", self.client), "session", None), "sheets")
+        self.sheet = None
+        # gspread's HTTP session is not thread-safe; serialize API calls from row workers
+        self._lock = threading.RLock()
+        self.write_buffer = None
+        self.tab_cache = tab_cache
+
+    def connect(self, sheet_url: str, worksheet_name: str = None):
+        """Connects to a specific spreadsheet and worksheet."""
+        try:
+            spreadsheet = self.client.open_by_url(sheet_url)
+            if worksheet_name:
+                self.sheet = spreadsheet.worksheet(worksheet_name)
+            else:
+                self.sheet = spreadsheet.sheet1
+            print(f"Connected to sheet: {spreadsheet.title}")
+        except Exception as e:
+            print(f"Error connecting to sheet: {e}")
+            raise
+
+    def for_worksheet(self, sheet_url: str, worksheet_name: str = None) -> "SheetHandler":
+        """
+        A handler for another worksheet on the same client: credentials, HTTP session, tab cache
+        and the API lock are shared, so handlers of one run never use the session concurrently.
+        """
+        handler = SheetHandler(client=self.client, tab_cache=self.tab_cache)
+        handler.creds = self.creds
+        handler._lock = self._lock
+        handler.connect(sheet_url, worksheet_name)
+        return handler
+
+    def get_pending_tasks(self) -> List[Dict[str, Any]]:
+        """
+        Retrieves rows where Status (Col A) is empty or specific value.
+        Assumes headers are in the first row.
+        """
+        return list(self.iter_pending_tasks())
+
+    def iter_pending_tasks(self, page_size: int = 100, include_in_progress: bool = False, include_completed: bool = False, on_page=None) -> Iterator[Dict[str, Any]]:
+        """
+        Yields pending rows page by page without downloading the whole sheet.
+        Interrupted rows (中断) count as pending; rows still showing an in-progress status
+        only with include_in_progress (use it when no other run is working on the sheet).
+        include_completed also yields finished (完了) rows, for regeneration runs.
+        1. Reads the header row plus the Status and MainKW columns (one request) to find candidate rows.
+        2. Fetches only the input columns (MainKW..Slug, ArticleType) of up to page_size
+           candidates per request; the large output columns (J..Q) are never read.
+        on_page(tasks) is called with each page before its rows are yielded (e.g. to look up
+        the page's slugs in WordPress in one request).
+        """
+        with self._lock:
+            headers = self.sheet.row_values(1)
+        col_of = {str(h).strip(): i + 1 for i, h in enumerate(headers) if str(h).strip()}
+        status_col = col_of.get("Status", 1)
+        kw_col = col_of.get("MainKW", 2)
+
+        # Status + MainKW bound the data area (a row without either is not part of the table)
+        with self._lock:
+            status_values, kw_values = self.sheet.batch_get([
+                self._column_range(status_col, 2),
+                self._column_range(kw_col, 2),
+            ])
+        last_row = max(len(status_values), len(kw_values)) + 1
+
+        candidates = []
+        for row in range(2, last_row + 1):
+            status = self._range_value(status_values, row - 2, 0).strip()
+            if self.is_pending_status(status, include_in_progress) or (include_completed and status == COMPLETED_STATUS):
+                candidates.append((row, status))
+
+        input_cols = sorted(col_of[name] for name in INPUT_COLUMNS if name in col_of)
+        col_spans = self._spans(input_cols)
+        names_by_col = {col: name for name, col in col_of.items()}
+
+        for start in range(0, len(candidates), page_size):
+            page = candidates[start:start + page_size]
+            row_spans = self._spans([row for row, _ in page])
+            ranges = []
+            for first_row, end_row in row_spans:
+                for first_col, end_col in col_spans:
+                    ranges.append((first_row, first_col,
+                                   f"{rowcol_to_a1(first_row, first_col)}:{rowcol_to_a1(end_row, end_col)}"))
+            with self._lock:
+                results = self.sheet.batch_get([r[2] for r in ranges]) if ranges else []
+
+            # (row, col) -> value for this page
+            values = {}
+            for (first_row, first_col, _a1), value_range in zip(ranges, results):
+                for r_off, row_values in enumerate(value_range):
+                    for c_off, value in enumerate(row_values):
+                        values[(first_row + r_off, first_col + c_off)] = value
+
+            tasks = []
+            for row, status in page:
+                task = {"Status": status}
+                for col in input_cols:
+                    task[names_by_col[col]] = values.get((row, col), "")
+                task['row_index'] = row
+                tasks.append(task)
+            if on_page:
+                on_page(tasks)
+            yield from tasks
+
+    @staticmethod
+    def is_pending_status(status: str, include_in_progress: bool = False) -> bool:
+        if status in PENDING_STATUSES or status.startswith(INTERRUPTED_STATUS_PREFIX):
+            return True
+        return include_in_progress and status.startswith(IN_PROGRESS_STATUS_PREFIXES)
+
+    @staticmethod
+    def _column_range(col: int, first_row: int) -> str:
+        """Open-ended single column range, e.g. 'A2:A'."""
+        letter = rowcol_to_a1(1, col).rstrip("0123456789")
+        return f"{letter}{first_row}:{letter}"
+
+    @staticmethod
+    def _range_value(value_range, r: int, c: int) -> str:
+        # The API trims trailing empty rows/cells, so missing means empty
+        if r < len(value_range) and c < len(value_range[r]):
+            return str(value_range[r][c])
+        return ""
+
+    @staticmethod
+    def _spans(indices: List[int]) -> List[Tuple[int, int]]:
+        """Groups sorted indices into contiguous (first, last) spans."""
+        spans = []
+        for i in indices:
+            if spans and i == spans[-1][1] + 1:
+                spans[-1] = (spans[-1][0], i)
+            else:
+                spans.append((i, i))
+        return spans
+
+    def update_task_complete(self, row_index: int, draft_url: str, image_prompts: str, title: str = "", description: str = "", html_content: str = ""):
+        """Updates the row with completion status and details."""
+        # Col A(1)=Status, H(8)=DraftURL, I(9)=ImagePrompts
+        # New: J(10)=Title, K(11)=Description, L(12)=Content
+        try:
+            if len(html_content) > 49000:
+                print(f"Warning: Content length {len(html_content)} may exceed cell limit.")
+            if self.write_buffer:
+                # Queue the details; the status goes out in the same request as the rest of the row
+                for col, value in [(8, draft_url), (9, image_prompts), (10, title), (11, description), (12, html_content)]:
+                    self.write_buffer.put(row_index, col, value)
+                self.write_buffer.complete_row(row_index)
+            else:
+                cells = [
+                    gspread.Cell(row_index, 1, COMPLETED_STATUS),
+                    gspread.Cell(row_index, 8, draft_url),
+                    gspread.Cell(row_index, 9, image_prompts),
+                    gspread.Cell(row_index, 10, title),
+                    gspread.Cell(row_index, 11, description),
+                    gspread.Cell(row_index, 12, html_content) # Content is usually large
+                ]
+                # One request for the whole row (columns in between are left untouched)
+                with self._lock:
+                    self.sheet.update_cells(cells, value_input_option=ValueInputOption.user_entered)
+
+            print(f"Updated row {row_index} as Complete.")
+        except Exception as e:
+            print(f"Error updating row {row_index}: {e}")
+
+    def enable_write_buffer(self, max_cells: int = 50, max_delay: float = 5.0, on_flush=None) -> "SheetWriteBuffer":
+        """Routes all following cell writes through a write-behind buffer."""
+        if not self.write_buffer:
+            self.write_buffer = SheetWriteBuffer(self.sheet, self._lock, max_cells=max_cells, max_delay=max_delay, on_flush=on_flush)
+        return self.write_buffer
+
+    def close_write_buffer(self):
+        """Flushes and stops the write buffer (no-op if buffering is disabled)."""
+        if self.write_buffer:
+            self.write_buffer.close()
+            self.write_buffer = None
+
+    def update_status(self, row_index: int, status: str):
+        """Updates just the status column."""
+        try:
+            if self.write_buffer:
+                self.write_buffer.put(row_index, 1, status)
+                return
+            with self._lock:
+                self.sheet.update_cell(row_index, 1, status)
+        except Exception as e:
+            print(f"Error updating status for row {row_index}: {e}")
+
+    def mark_complete(self, row_index: int):
+        """
+        Sets the status to 完了 only after every pending write of the row has been sent.
+        Raises if the status could not be written (the row stays pending).
+        """
+        if self.write_buffer:
+            self.write_buffer.complete_row(row_index)
+            return
+        with self._lock:
+            self.sheet.update_cell(row_index, 1, COMPLETED_STATUS)
+
+    def update_any_cell(self, row_index: int, col_index: int, value: str):
+        """Updates any specific cell."""
+        try:
+            if self.write_buffer:
+                self.write_buffer.put(row_index, col_index, value)
+                return
+            with self._lock:
+                self.sheet.update_cell(row_index, col_index, value)
+        except Exception as e:
+            print(f"Error updating cell ({row_index}, {col_index}): {e}")
+
+    def get_prompts_from_tab(self, tab_name: str) -> Dict[str, str]:
+        """
+        Reads Key-Value pairs from a specific tab.
+        Results are served from the shared TabCache while fresh.
+        """
+        spreadsheet_id = self.get_spreadsheet_id()
+        if self.tab_cache and spreadsheet_id:
+            cached = self.tab_cache.get(spreadsheet_id, tab_name)
+            if cached is not None:
+                return cached
+
+        prompts = self._read_prompts_tab(tab_name)
+        if prompts is None:
+            # Read errors are not cached so the next call retries
+            return {}
+        if self.tab_cache and spreadsheet_id:
+            self.tab_cache.put(spreadsheet_id, tab_name, prompts)
+        return prompts
+
+    def _read_prompts_tab(self, tab_name: str):
+        """Reads a Key/Value tab from the sheet. Returns None on read errors."""
+        try:
+            # Access parent spreadsheet from current worksheet
+            spreadsheet = self.sheet.spreadsheet 
+            with self._lock:
+                ws = spreadsheet.worksheet(tab_name)
+                records = ws.get_all_records() # Expects headers: Key, Value
+            prompts = {r['Key']: r['Value'] for r in records if r.get('Key')}
+            return prompts
+        except gspread.WorksheetNotFound:
+            print(f"Tab '{tab_name}' not found.")
+            return {}
+        except AttributeError:
+             # Fallback if self.sheet is actually spreadsheet (though connect() sets it to worksheet)
+             try:
+                 with self._lock:
+                     ws = self.sheet.worksheet(tab_name)
+                     records = ws.get_all_records()
+                 prompts = {r['Key']: r['Value'] for r in records if r.get('Key')}
+                 return prompts
+             except:
+                 print(f"Error accessing tab '{tab_name}' (AttributeError).")
+                 return None
+        except Exception as e:
+            print(f"Error reading tab '{tab_name}': {e}")
+            return None
+
+    def refresh_tab_cache(self):
+        """
+        Drops cached tabs if the spreadsheet was modified since they were read.
+        Call once per run: this run's own status/content writes then cost one re-read of the
+        prompt tabs at the start of the next run, never a stale prompt.
+        """
+        spreadsheet_id = self.get_spreadsheet_id()
+        if not self.tab_cache or not spreadsheet_id:
+            return
+        try:
+            http = getattr(self.client, "http_client", self.client)
+            with self._lock:
+                res = http.request("get", f"{DRIVE_FILES_API_V3_URL}/{spreadsheet_id}", params={
+                    "supportsAllDrives": True,
+                    "fields": "modifiedTime",
+                })
+            metadata = res.json()
+        except Exception as e:
+            # Without revision info the TTL alone decides
+            print(f"Could not read spreadsheet revision: {e}")
+            return
+        if self.tab_cache.check_revision(spreadsheet_id, metadata.get("modifiedTime", "")):
+            print("Spreadsheet was modified; cached prompt tabs invalidated.")
+
+    def get_spreadsheet_id(self):
+        try:
+            return self.sheet.spreadsheet.id
+        except AttributeError:
+            return getattr(self.sheet, "id", None)
+
+    def get_common_rules(self, tab_name: str = "共通ルール") -> str:
+        """
+        Reads all values from the 'Value' column of the specified tab and joins them.
+        Assumes the tab has 'Key' and 'Value' headers like other prompt tabs.
+        """
+        prompts = self.get_prompts_from_tab(tab_name)
+        if not prompts:
+            return ""
+        
+        # Sort by Key if possible, or just join values
+        # We'll just join all values with newlines
+        return "\n\n".join(prompts.values())
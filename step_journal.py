@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
+
+
+class StepJournal:
+    """
+    Durable journal of completed chat turns, one SQLite file shared by all rows and workers.
+    A row's turns are keyed by sheet ID, row identity, article type and prompt version,
+    so an interrupted row can rebuild its chat history and continue from the first
+    incomplete STEP. A finished row's entries are deleted.
+    """
+
+    def __init__(self, path: str = "data/journal.sqlite3"):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS turns (
+                    row_key TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    step TEXT NOT NULL,
+                    phase TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (row_key, seq)
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS completed_steps (
+                    row_key TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    PRIMARY KEY (row_key, step)
+                )""")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def row_key(sheet_id: str, row_index: int, main_kw: str, slug: str, article_type: str, prompt_version: str) -> str:
+        payload = json.dumps([sheet_id, row_index, main_kw, slug, article_type, prompt_version], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def prompt_version(prompt_dict: Dict[str, Any]) -> str:
+        """Content hash of a prompt definition; editing any step starts a fresh journal."""
+        payload = json.dumps(prompt_dict, ensure_ascii=False, sort_keys=True, default=dict)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    def open_row(self, row_key: str) -> "RowJournal":
+        return RowJournal(self, row_key)
+
+    def _execute(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(sql, params).fetchall()
+            conn.commit()
+            return rows
+
+
+class RowJournal:
+    """Journal handle for one row (see StepJournal)."""
+
+    def __init__(self, journal: StepJournal, row_key: str):
+        self.journal = journal
+        self.row_key = row_key
+
+    def load(self) -> "OrderedDict[str, List[Tuple[str, str, str]]]":
+        """
+        Returns the turns of completed steps in order: step -> [(phase, prompt, response), ...].
+        Turns of a step that never completed are discarded; that step is run again.
+        """
+        completed = {row[0] for row in self.journal._execute(
+            "SELECT step FROM completed_steps WHERE row_key = ?", (self.row_key,))}
+        rows = self.journal._execute(
+            "SELECT step, phase, prompt, response FROM turns WHERE row_key = ? ORDER BY seq", (self.row_key,))
+        steps = OrderedDict()
+        for step, phase, prompt, response in rows:
+            if step in completed:
+                steps.setdefault(step, []).append((phase, prompt, response))
+        if len(rows) != sum(len(turns) for turns in steps.values()):
+            placeholders = ",".join("?" * len(completed)) or "''"
+            self.journal._execute(
+                f"DELETE FROM turns WHERE row_key = ? AND step NOT IN ({placeholders})",
+                (self.row_key, *completed))
+        return steps
+
+    def record_turn(self, step: str, phase: str, prompt: str, response: str):
+        self.journal._execute(
+            "INSERT INTO turns (row_key, seq, step, phase, prompt, response, created_at) "
+            "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM turns WHERE row_key = ?), ?, ?, ?, ?, ?)",
+            (self.row_key, self.row_key, step, phase, prompt, response, time.time()))
+
+    def complete_step(self, step: str):
+        self.journal._execute(
+            "INSERT OR IGNORE INTO completed_steps (row_key, step) VALUES (?, ?)", (self.row_key, step))
+
+    def finish(self):
+        """Drops the row's journal once its results are safely in the sheet."""
+        self.journal._execute("DELETE FROM turns WHERE row_key = ?", (self.row_key,))
+        self.journal._execute("DELETE FROM completed_steps WHERE row_key = ?", (self.row_key,))
+
+
+class StepOutputCache:
+    """
+    Content-addressed store of step outputs (the turns of a completed step), in the journal's
+    SQLite file. A step's key hashes the previous step's key, the previous step's output and
+    the step's own formatted exec/check text; the chain starts from the model name and the
+    system instruction. Editing STEP 7 therefore changes only the keys of STEP 7 onwards, and
+    a regeneration replays everything before it from the cache.
+    """
+
+    def __init__(self, journal: StepJournal):
+        self.journal = journal
+        self._ready = False
+        self.hits = 0
+        self.misses = 0
+
+    def _ensure_table(self):
+        if not self._ready:
+            self.journal._execute("""
+                CREATE TABLE IF NOT EXISTS step_outputs (
+                    key TEXT PRIMARY KEY,
+                    turns TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )""")
+            self._ready = True
+
+    @staticmethod
+    def _hash(*parts: str) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            data = part.encode("utf-8")
+            # Length-prefixed so ("ab", "c") and ("a", "bc") differ
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return digest.hexdigest()
+
+    def base_key(self, model_name: str, system_instruction: str) -> str:
+        return self._hash("base", model_name, self._hash(system_instruction))
+
+    def step_key(self, previous_key: str, previous_output: str, step: str, *prompts: str) -> str:
+        return self._hash(previous_key, previous_output, step, *prompts)
+
+    def get(self, key: str):
+        """Returns the cached turns [(phase, prompt, response), ...] or None."""
+        self._ensure_table()
+        rows = self.journal._execute("SELECT turns FROM step_outputs WHERE key = ?", (key,))
+        if not rows:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [tuple(turn) for turn in json.loads(rows[0][0])]
+
+    def put(self, key: str, turns: List[Tuple[str, str, str]]):
+        self._ensure_table()
+        self.journal._execute(
+            "INSERT OR REPLACE INTO step_outputs (key, turns, created_at) VALUES (?, ?, ?)",
+            (key, json.dumps(turns, ensure_ascii=False), time.time()))
+
+    def prune(self, max_age_days: float = 30):
+        """Drops outputs older than max_age_days so the file doesn't grow forever."""
+        self._ensure_table()
+        self.journal._execute("DELETE FROM step_outputs WHERE created_at < ?", (time.time() - max_age_days * 86400,))
+
+
+# Shared by every process_batch call in this process
+STEP_JOURNAL = StepJournal()
+STEP_OUTPUT_CACHE = StepOutputCache(STEP_JOURNAL)
@@ -0,0 +1,83 @@
+from ai_handler import AIHandlerPool, SectionScanner, StepResultStore
+from fakes import FakeGemini, LatencyModel
+
+
+class StubCache:
+    def __init__(self):
+        self.model = object()
+
+    def get_model(self, bundle_key, model_name, system_instruction, safety_settings):
+        return self.model
+
+
+def test_pooled_handler_takes_context_cache_per_call():
+    pool = AIHandlerPool(model_factory=FakeGemini(LatencyModel(0.0)))
+    cache = StubCache()
+    cached = pool.get("key", "instruction")
+    plain = pool.get("key", "instruction")
+    assert cached is plain
+    assert cached._chat_model(cache) is cache.model
+    # Another sheet without a cache on the same pooled handler still gets the plain model
+    assert plain._chat_model() is plain.model
+    assert not hasattr(plain, "context_cache")
+
+
+def test_pool_is_reset_when_the_api_key_changes():
+    pool = AIHandlerPool(model_factory=FakeGemini(LatencyModel(0.0)))
+    first = pool.get("key-1", "instruction")
+    assert pool.get("key-1", "instruction") is first
+    second = pool.get("key-2", "instruction")
+    assert second is not first
+    assert pool.stats() == "1 hits / 2 misses (1 pooled)"
+
+
+RESPONSE = (
+    "前置き\n---TITLE_START--- 記事タイトル ---TITLE_END---\n"
+    "---DESC_START---説明文---DESC_END---\n"
+    "```html\n<h2>見出し</h2>\n```\n"
+    "```\nplain code\n```\n"
+)
+
+
+def scan_in_chunks(text, size):
+    seen = []
+    scanner = SectionScanner(on_section=lambda name, value: seen.append((name, value)))
+    for start in range(0, len(text), size):
+        scanner.feed(text[start:start + size])
+    return scanner, seen
+
+
+def test_section_scanner_finds_markers_split_across_chunks():
+    whole, whole_seen = scan_in_chunks(RESPONSE, len(RESPONSE))
+    for size in (1, 2, 3, 7):
+        scanner, seen = scan_in_chunks(RESPONSE, size)
+        assert seen == whole_seen
+        assert scanner.sections == whole.sections
+    assert whole.sections == {"title": "記事タイトル", "description": "説明文"}
+    assert whole_seen == [("title", "記事タイトル"), ("description", "説明文"),
+                          ("html", "\n<h2>見出し</h2>\n"), ("code", "\nplain code\n")]
+
+
+def test_section_scanner_reports_a_block_once_its_end_marker_arrives():
+    seen = []
+    scanner = SectionScanner(on_section=lambda name, value: seen.append(name))
+    scanner.feed("---TITLE_START---タイトル---TITLE_E")
+    assert seen == []
+    scanner.feed("ND---")
+    scanner.feed(" ---TITLE_START---second---TITLE_END---")
+    assert seen == ["title"]
+    assert scanner.sections["title"] == "タイトル"
+
+
+def test_step_result_store_merges_steps():
+    store = StepResultStore()
+    store.add("STEP 1", "---TITLE_START---仮タイトル---TITLE_END---")
+    store.add("STEP 3", "```html\n<p>draft</p>\n```")
+    store.add("STEP 3", "```html\n<p>refined and longer</p>\n```")  # the refine replaces the draft
+    store.add("STEP 5", "---TITLE_START---最終タイトル---TITLE_END---\n```html\n<p>short</p>\n```")
+    store.add("STEP 6", "a photo of tea\n**【作業完了】** これで終わりです")
+    result = store.result()
+    assert result["title"] == "最終タイトル"
+    assert result["description"] == "ディスクリプション取得失敗"
+    assert result["content"] == "<p>refined and longer</p>"
+    assert result["image_prompts"] == "a photo of tea"
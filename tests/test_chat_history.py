@@ -0,0 +1,28 @@
+from chat_history import ChatHistoryManager
+
+
+def turns(step):
+    return [("draft", f"{step} prompt", f"{step} draft"), ("refine", f"{step} check", f"{step} refined")]
+
+
+def test_superseded_drafts_are_collapsed_without_a_budget():
+    manager = ChatHistoryManager()
+    manager.add_step("Initial", [("draft", "plan prompt", "plan")])
+    manager.add_step("STEP 1", turns("STEP 1"))
+    assert manager.history() == [
+        {"role": "user", "parts": ["plan prompt"]},
+        {"role": "model", "parts": ["plan"]},
+        {"role": "user", "parts": ["STEP 1 prompt"]},
+        {"role": "model", "parts": ["STEP 1 refined"]},
+    ]
+    assert manager.dropped_steps == []
+
+
+def test_budget_drops_oldest_steps_but_keeps_initial_and_latest():
+    manager = ChatHistoryManager(token_budget=20, chars_per_token=1.0)
+    manager.add_step("Initial", [("draft", "plan prompt", "plan")])
+    for step in ("STEP 1", "STEP 2", "STEP 3"):
+        manager.add_step(step, turns(step))
+    history = manager.history()
+    assert [message["parts"][0] for message in history] == ["plan prompt", "plan", "STEP 3 prompt", "STEP 3 refined"]
+    assert manager.dropped_steps == ["STEP 1", "STEP 2"]
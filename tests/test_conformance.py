@@ -0,0 +1,19 @@
+from conformance import ConformanceValidator
+
+PARTS = """
+<span class="ranking-icon ranking-icon_{{num}}">{{num}}</span>
+<div class="box-ttl"><span class="num-c">{{num}}</span>{{title}}</div>
+"""
+
+
+def test_placeholder_class_matches_numbers():
+    validator = ConformanceValidator(PARTS)
+    html = '<span class="ranking-icon ranking-icon_1">1</span><span class="ranking-icon ranking-icon_12">12</span>'
+    assert validator.validate(html) == []
+    assert "ranking-icon_{{num}}" not in validator.allowed_classes
+
+
+def test_placeholder_class_rejects_other_values():
+    validator = ConformanceValidator(PARTS)
+    violations = validator.validate('<span class="ranking-icon_top ranking-icon_{{num}}">1</span><span class="num-x">2</span>')
+    assert violations == ["パーツリストにないクラス: ranking-icon_top, ranking-icon_{{num}}, num-x"]
@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from context_cache import ContextCacheBackend, LocalContextCache
+
+
+class SlowFactory:
+    """Model factory taking a while, so concurrent misses overlap."""
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def __call__(self, model_name, system_instruction, safety_settings):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("prefix below the minimum token count")
+        return {"model": model_name, "instruction": system_instruction}
+
+
+def get(cache, key="k1", instruction="rules"):
+    return cache.get_model(key, "gemini-test", instruction, [])
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        ContextCacheBackend()
+
+
+def test_hits_and_misses_per_bundle_key():
+    cache = LocalContextCache(SlowFactory())
+    first = get(cache)
+    assert get(cache) is first
+    other = get(cache, "k2", "other rules")
+    assert other is not first
+    assert cache.created == ["k1", "k2"]
+    assert cache.stats() == "1 hits / 2 misses (2 cached)"
+
+
+def test_expired_entry_is_created_again():
+    cache = LocalContextCache(SlowFactory(), ttl_seconds=0, refresh_margin=0)
+    get(cache)
+    get(cache)
+    assert cache.created == ["k1", "k1"]
+
+
+def test_failure_is_remembered_until_retry_after():
+    factory = SlowFactory(fail=True)
+    cache = LocalContextCache(factory, retry_after=600)
+    assert get(cache) is None
+    assert get(cache) is None
+    assert factory.calls == 1
+
+
+def test_concurrent_misses_create_once_outside_the_lock():
+    cache = LocalContextCache(SlowFactory(delay=0.3))
+    get(cache, "k2", "other rules")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get(cache))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    # Hits on other keys are not blocked while k1 is being created
+    time.sleep(0.05)
+    started = time.monotonic()
+    get(cache, "k2", "other rules")
+    assert time.monotonic() - started < 0.1
+    for thread in threads:
+        thread.join()
+    assert cache.created.count("k1") == 1
+    assert len(results) == 4 and all(model is results[0] for model in results)
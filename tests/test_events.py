@@ -0,0 +1,39 @@
+import threading
+import time
+
+from events import LOG, EventBus, publishing_to, run_log
+from fakes import FakeSheetsClient, task_rows
+from metrics import scope
+from sheet_handler import SheetWriteBuffer
+
+
+class ListSink:
+    def __init__(self):
+        self.events = []
+
+    def handle(self, event):
+        self.events.append(event)
+
+
+def test_run_log_goes_to_the_current_bus_with_the_row(capsys):
+    sink = ListSink()
+    with publishing_to(EventBus([sink])), scope(row=7):
+        run_log("inside", step="STEP 1", detail=1)
+    run_log("outside")
+    assert [(e.kind, e.message, e.row, e.step, e.data) for e in sink.events] == [(LOG, "inside", 7, "STEP 1", {"detail": 1})]
+    assert capsys.readouterr().out == "outside\n"
+
+
+def test_flusher_thread_errors_reach_the_bus():
+    sink = ListSink()
+    worksheet = FakeSheetsClient().spreadsheet.add_worksheet_rows("Sheet1", task_rows(1, "site"))
+    worksheet.fail_writes = 1
+    with publishing_to(EventBus([sink])):
+        buffer = SheetWriteBuffer(worksheet, threading.RLock(), max_delay=0.05)
+    buffer.put(2, 1, "開始")
+    deadline = time.monotonic() + 3
+    while not sink.events and time.monotonic() < deadline:
+        time.sleep(0.02)
+    buffer.close()
+    assert "Error flushing buffered sheet writes" in sink.events[0].message
+    assert worksheet.rows[1][0] == "開始"
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+
+import github_handler
+from github_handler import GitHubHandler, git_blob_sha
+
+REPO = "owner/repo"
+
+
+def sha_of(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class _GitHubRequestHandler(BaseHTTPRequestHandler):
+    """Just enough of the Git Data API for GitHubHandler.commit_files."""
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+
+    def do_GET(self):
+        repo = self.server
+        path = urlparse(self.path).path
+        repo.requests.append(("GET", path))
+        if path == f"/repos/{REPO}":
+            return self._send(200, {"default_branch": "main"})
+        if path == f"/repos/{REPO}/branches/main":
+            tree = repo.commits[repo.head]["tree"]
+            return self._send(200, {"commit": {"sha": repo.head, "commit": {"tree": {"sha": tree}}}})
+        if path == f"/repos/{REPO}/git/ref/heads/main":
+            return self._send(200, {"object": {"sha": repo.head}})
+        if path.startswith(f"/repos/{REPO}/git/trees/"):
+            blobs = repo.trees[path.rsplit("/", 1)[-1]]
+            return self._send(200, {"tree": [{"path": p, "type": "blob", "sha": s} for p, s in blobs.items()]})
+        self._send(404, {"message": "Not Found"})
+
+    def do_POST(self):
+        repo = self.server
+        path = urlparse(self.path).path
+        repo.requests.append(("POST", path))
+        body = self._body()
+        if path.endswith("/git/trees"):
+            blobs = dict(repo.trees[body["base_tree"]])
+            blobs.update({entry["path"]: git_blob_sha(entry["content"]) for entry in body["tree"]})
+            return self._send(201, {"sha": repo.add_tree(blobs)})
+        if path.endswith("/git/commits"):
+            sha = sha_of([body["tree"], body["parents"], body["message"]])
+            repo.commits[sha] = {"tree": body["tree"], "parents": body["parents"], "message": body["message"]}
+            return self._send(201, {"sha": sha})
+        self._send(404, {"message": "Not Found"})
+
+    def do_PATCH(self):
+        repo = self.server
+        path = urlparse(self.path).path
+        repo.requests.append(("PATCH", path))
+        sha = self._body()["sha"]
+        if repo.head not in repo.commits[sha]["parents"]:
+            return self._send(422, {"message": "Update is not a fast forward"})
+        repo.head = sha
+        self._send(200, {"object": {"sha": sha}})
+
+
+class GitHubStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files):
+        super().__init__(("127.0.0.1", 0), _GitHubRequestHandler)
+        self.api_root = f"http://127.0.0.1:{self.server_address[1]}"
+        self.requests = []
+        self.trees = {}
+        self.commits = {}
+        self.head = self.commit({path: git_blob_sha(content) for path, content in files.items()}, None, "initial")
+
+    def add_tree(self, blobs):
+        sha = sha_of(blobs)
+        self.trees[sha] = blobs
+        return sha
+
+    def commit(self, blobs, parent, message):
+        """Commits directly to main (a save from elsewhere)."""
+        sha = sha_of([blobs, parent, message])
+        self.commits[sha] = {"tree": self.add_tree(blobs), "parents": [parent] if parent else [], "message": message}
+        self.head = sha
+        return sha
+
+    def files(self):
+        return self.trees[self.commits[self.head]["tree"]]
+
+    def count(self, method, suffix):
+        return sum(1 for m, p in self.requests if m == method and p.endswith(suffix))
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+@pytest.fixture(autouse=True)
+def reset_heads():
+    github_handler._heads.clear()
+    github_handler._default_branches.clear()
+
+
+def handler(stub):
+    return GitHubHandler("token", REPO, api_root=stub.api_root)
+
+
+def test_commit_files_writes_one_commit_for_changed_files():
+    with GitHubStub({"config/a.json": "a", "config/b.json": "b"}) as stub:
+        initial = stub.head
+        ok, message = handler(stub).commit_files({"config/a.json": "a2", "config/b.json": "b"}, "Update a")
+        assert ok, message
+        assert message == "Success (1 files, 1 unchanged)"
+        assert stub.files()["config/a.json"] == git_blob_sha("a2")
+        assert stub.commits[stub.head]["parents"] == [initial]
+        assert stub.count("POST", "/git/trees") == 1
+        assert stub.count("POST", "/git/commits") == 1
+        assert stub.count("PATCH", "/git/refs/heads/main") == 1
+
+
+def test_rejected_ref_update_is_retried_on_the_new_head():
+    with GitHubStub({"config/a.json": "a", "config/b.json": "b"}) as stub:
+        handler(stub).commit_files({"config/a.json": "a2"})
+        # Another save moves the branch; our cached head is now stale
+        moved = stub.commit(dict(stub.files(), **{"config/b.json": git_blob_sha("b2")}), stub.head, "elsewhere")
+        ok, message = handler(stub).commit_files({"config/a.json": "a3"})
+        assert ok, message
+        assert stub.count("PATCH", "/git/refs/heads/main") == 3  # first save, rejected, retried
+        assert stub.commits[stub.head]["parents"] == [moved]
+        assert stub.files()["config/b.json"] == git_blob_sha("b2")
+        assert stub.files()["config/a.json"] == git_blob_sha("a3")
+
+
+def test_no_changes_is_checked_against_the_current_ref():
+    with GitHubStub({"config/a.json": "a"}) as stub:
+        handler(stub).commit_files({"config/a.json": "a2"})
+        assert handler(stub).commit_files({"config/a.json": "a2"}) == (True, "No changes")
+        assert stub.count("GET", "/git/ref/heads/main") == 1
+        # Someone reverted the file elsewhere: the cached head still has "a2", the branch does not
+        stub.commit({"config/a.json": git_blob_sha("a")}, stub.head, "revert")
+        ok, message = handler(stub).commit_files({"config/a.json": "a2"})
+        assert ok, message
+        assert message.startswith("Success (1 files")
+        assert stub.files()["config/a.json"] == git_blob_sha("a2")
@@ -0,0 +1,59 @@
+import threading
+
+from events import LOG
+from job_runner import JobRunner
+
+
+def run_to_end(runner, target, **kwargs):
+    job = runner.submit(target, label="sheet", **kwargs)
+    runner._executor.shutdown(wait=True)
+    runner._executor = None
+    return job
+
+
+def test_finished_jobs_are_dropped_and_reloaded_from_disk(tmp_path):
+    runner = JobRunner(str(tmp_path))
+
+    def target(events, cancel_event, metrics_jsonl):
+        events.emit(LOG, "row 2 done", row=2)
+
+    job = run_to_end(runner, target)
+    assert job.status == "completed"
+    assert runner._jobs == {}
+    reloaded = runner.get(job.id)
+    assert reloaded is not job
+    assert reloaded.status == "completed"
+    assert reloaded.event_count == job.event_count
+    assert [event.message for event in reloaded.tail()] == ["row 2 done"]
+    assert runner._jobs == {}
+    assert [listed.id for listed in runner.list_jobs()] == [job.id]
+
+
+def test_failed_job_keeps_its_error_after_eviction(tmp_path):
+    runner = JobRunner(str(tmp_path))
+
+    def target(events, cancel_event, metrics_jsonl):
+        raise RuntimeError("sheet not found")
+
+    job = run_to_end(runner, target)
+    assert runner._jobs == {}
+    reloaded = runner.get(job.id)
+    assert (reloaded.status, reloaded.error) == ("failed", "sheet not found")
+    assert reloaded.tail()[-1].message.startswith("Job failed: sheet not found")
+
+
+def test_running_job_is_the_live_object(tmp_path):
+    runner = JobRunner(str(tmp_path))
+    release = threading.Event()
+
+    def target(events, cancel_event, metrics_jsonl):
+        release.wait(5)
+
+    job = runner.submit(target)
+    assert runner.get(job.id) is job
+    # Listing the jobs dir while it runs must not load it as a job of a dead process
+    assert runner.list_jobs()[0] is job
+    assert job.active
+    release.set()
+    runner._executor.shutdown(wait=True)
+    assert runner.get(job.id).status == "completed"
@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+
+from pipeline import RowPipeline
+
+
+class StubStages:
+    """Stage functions over {"row_index": n} items that record what ran and when."""
+
+    def __init__(self, publish_delay=0.0, fail_generate=None, fail_publish=None, stop_after=None):
+        self.publish_delay = publish_delay
+        self.fail_generate = fail_generate
+        self.fail_publish = fail_publish
+        self.stop_after = stop_after
+        self.stop_event = threading.Event()
+        self.generated = []
+        self.published = []
+        self.recorded = []
+        self.batches = []
+        self.max_backlog = 0
+        self._lock = threading.Lock()
+
+    def generate(self, item, log, chunk):
+        row = item["row_index"]
+        if row == self.fail_generate:
+            raise RuntimeError(f"generate failed on row {row}")
+        with self._lock:
+            self.generated.append(row)
+            # Rows finished by generation that no publisher has started on yet
+            self.max_backlog = max(self.max_backlog, len(self.generated) - len(self.published))
+        if self.stop_after and len(self.generated) >= self.stop_after:
+            self.stop_event.set()
+        return {"row": row}
+
+    def _publish(self, payloads):
+        with self._lock:
+            self.published.extend(payload["row"] for payload in payloads)
+            self.batches.append(len(payloads))
+        time.sleep(self.publish_delay)
+        for payload in payloads:
+            if payload["row"] == self.fail_publish:
+                raise RuntimeError(f"publish failed on row {payload['row']}")
+        return payloads
+
+    def publish(self, payload, log):
+        return self._publish([payload])[0]
+
+    def publish_many(self, payloads, logs):
+        assert len(logs) == len(payloads)
+        return self._publish(payloads)
+
+    def record(self, payload, log):
+        log(f"recorded {payload['row']}")
+        with self._lock:
+            self.recorded.append(payload["row"])
+
+
+def rows(count):
+    return [{"row_index": i} for i in range(1, count + 1)]
+
+
+def pipeline(stages, **kwargs):
+    kwargs.setdefault("log_callback", lambda message: None)
+    return RowPipeline(stages.generate, stages.publish, stages.record, stop_event=stages.stop_event, **kwargs)
+
+
+def test_slow_publisher_backs_up_generation_and_publishes_greedily():
+    stages = StubStages(publish_delay=0.05)
+    lines = []
+    started = pipeline(stages, workers=1, publishers=1, queue_size=3, publish_many=stages.publish_many,
+                       publish_batch_size=4, log_callback=lines.append).run(rows(20))
+    assert started == 20
+    assert sorted(stages.recorded) == list(range(1, 21))
+    # Bounded queue: at most queue_size rows wait, plus one held by the worker and one batch being taken
+    assert stages.max_backlog <= 3 + 1 + 4
+    # Rows that piled up while a batch was posted go out together, never more than publish_batch_size
+    assert max(stages.batches) > 1
+    assert max(stages.batches) <= 4
+    assert sum(stages.batches) == 20
+    assert any("recorded 20" in line for line in lines)
+
+
+def test_stop_event_stops_intake_and_drains_generated_rows():
+    stages = StubStages(stop_after=3)
+    started = pipeline(stages, workers=1).run(rows(10))
+    assert started == 3
+    assert sorted(stages.recorded) == [1, 2, 3]
+
+
+def test_generate_error_stops_intake_and_is_reraised_after_draining():
+    stages = StubStages(fail_generate=3)
+    with pytest.raises(RuntimeError, match="generate failed on row 3"):
+        pipeline(stages, workers=1).run(rows(10))
+    # Rows generated before the error are still published and recorded
+    assert sorted(stages.recorded) == [1, 2]
+    assert 4 not in stages.generated
+
+
+def test_publish_error_skips_the_record_of_that_row():
+    stages = StubStages(fail_publish=2)
+    with pytest.raises(RuntimeError, match="publish failed on row 2"):
+        pipeline(stages, workers=1, publishers=1).run(rows(10))
+    assert 1 in stages.recorded
+    assert 2 not in stages.recorded
+    assert len(stages.generated) < 10
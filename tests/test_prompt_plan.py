@@ -0,0 +1,114 @@
+import re
+import threading
+import time
+
+import pytest
+
+from ai_handler import AIHandlerPool
+from events import STEP_STARTED
+from fakes import FakeChat, FakeGemini, FakeGeminiModel, LatencyModel
+from prompt_plan import PromptPlan, PromptPlanError, critical_path_length, step_dependencies, step_lineage
+from rate_limiter import RateLimiter
+
+
+def test_depends_on_defaults_to_the_previous_step():
+    dependencies = step_dependencies({
+        "Initial": "init",
+        "STEP 1": "legacy string step",
+        "STEP 2": {"exec": "a"},
+        "STEP 3": {"exec": "b", "depends_on": "STEP 1"},
+        "STEP 4": {"exec": "c", "depends_on": []},
+        "STEP 5": {"exec": "d", "depends_on": ["STEP 2", "STEP 3"]},
+        "mappings": {},
+    })
+    assert dependencies == {
+        "STEP 1": ["Initial"],
+        "STEP 2": ["STEP 1"],
+        "STEP 3": ["STEP 1"],
+        "STEP 4": ["Initial"],
+        "STEP 5": ["STEP 2", "STEP 3"],
+    }
+    lineage = step_lineage(dependencies)
+    assert lineage["STEP 4"] == ["Initial"]
+    assert lineage["STEP 5"] == ["Initial", "STEP 1", "STEP 2", "STEP 3"]
+    assert critical_path_length(dependencies) == 3
+
+
+@pytest.mark.parametrize("depends_on", [["STEP 9"], ["STEP 2"], "STEP 2"])
+def test_unknown_or_later_steps_are_rejected(depends_on):
+    # Naming a later step (or the step itself) is how a cycle would be written
+    prompts = {
+        "Initial": "init",
+        "STEP 1": {"exec": "a"},
+        "STEP 2": {"exec": "b", "depends_on": ["STEP 1"]},
+    }
+    prompts["STEP 1"]["depends_on"] = depends_on
+    with pytest.raises(ValueError, match="STEP 1: depends_on"):
+        step_dependencies(prompts)
+    with pytest.raises(PromptPlanError, match="STEP 1: depends_on"):
+        PromptPlan(prompts)
+
+
+def test_plan_requires_an_initial_prompt():
+    with pytest.raises(PromptPlanError, match="Initial"):
+        PromptPlan({"STEP 1": {"exec": "a"}})
+
+
+class TimedChat(FakeChat):
+    """Records when each step's call ran and which steps its forked history held."""
+
+    def send_message(self, content, stream=False):
+        gemini = self.model.gemini
+        match = re.search(r"次の (STEP \d+) を実行", content)
+        step = match.group(1) if match else "Initial"
+        seen = re.findall(r"次の (STEP \d+) を実行", " ".join(
+            part.text for message in self.history if message.role == "user" for part in message.parts))
+        started = time.monotonic()
+        response = super().send_message(content, stream)
+        with gemini.calls_lock:
+            gemini.calls[step] = (started, time.monotonic(), seen)
+        return response
+
+
+class TimedModel(FakeGeminiModel):
+    def start_chat(self, history=None):
+        return TimedChat(self, history)
+
+
+class TimedGemini(FakeGemini):
+    def __init__(self, latency):
+        super().__init__(LatencyModel(latency, 0.0))
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+
+    def __call__(self, model_name, system_instruction="", safety_settings=None):
+        return TimedModel(self, model_name, system_instruction, safety_settings)
+
+
+def test_dependent_steps_wait_for_their_inputs():
+    gemini = TimedGemini(0.1)
+    handler = AIHandlerPool(model_factory=gemini).get("key", "instruction")
+    handler.rate_limiter = RateLimiter()
+    prompts = {
+        "Initial": "{main_kw}",
+        "STEP 1": {"exec": "outline", "depends_on": []},
+        "STEP 2": {"exec": "faq", "depends_on": []},
+        "STEP 3": {"exec": "body", "depends_on": ["STEP 1", "STEP 2"]},
+        "STEP 4": {"exec": "summary"},
+    }
+    started_steps = []
+    result = handler.generate_article_flow(
+        "kw", "", "", "slug", prompts, parallel_steps=4,
+        event_callback=lambda kind, message="", step=None, **data: started_steps.append((kind, step)))
+    assert "incomplete_step" not in result
+
+    calls = gemini.calls
+    # Independent branches overlap; the join starts only after both have returned
+    assert calls["STEP 2"][0] < calls["STEP 1"][1]
+    assert calls["STEP 3"][0] >= max(calls["STEP 1"][1], calls["STEP 2"][1])
+    assert calls["STEP 4"][0] >= calls["STEP 3"][1]
+    # Each step's chat holds only its upstream steps
+    assert calls["STEP 1"][2] == [] and calls["STEP 2"][2] == []
+    assert calls["STEP 3"][2] == ["STEP 1", "STEP 2"]
+    assert calls["STEP 4"][2] == ["STEP 1", "STEP 2", "STEP 3"]
+    assert [step for kind, step in started_steps if kind == STEP_STARTED] == ["Initial", "STEP 1", "STEP 2", "STEP 3", "STEP 4"]
@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from rate_limiter import RateLimiter, TokenBucket, is_retryable, retry_delay_from_error
+
+
+class RecordingLimiter(RateLimiter):
+    """Records waits instead of sleeping."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sleeps = []
+
+    def _sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+def failing(errors, result="ok"):
+    """fn raising the given errors in turn, then returning result."""
+    errors = list(errors)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+    fn.calls = calls
+    return fn
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(capacity=2, rate=1.0)
+    now = bucket.updated
+    assert bucket.reserve(1, now) == 0.0
+    assert bucket.reserve(1, now) == 0.0
+    assert bucket.reserve(1, now) == pytest.approx(1.0)
+    # Two seconds later the debt is repaid and one token has refilled
+    assert bucket.reserve(1, now + 2) == 0.0
+
+
+def test_token_bucket_refund():
+    bucket = TokenBucket(capacity=10, rate=1.0)
+    now = bucket.updated
+    bucket.reserve(8, now)
+    bucket.adjust(5)  # used 3 tokens instead of 8
+    assert bucket.reserve(7, now) == 0.0
+
+
+def test_rpm_paces_requests():
+    limiter = RecordingLimiter(rpm=60)
+    for _ in range(61):
+        limiter.acquire()
+    assert len(limiter.sleeps) == 1 and limiter.sleeps[0] == pytest.approx(1.0, abs=0.05)
+
+
+def test_retry_delay_from_error():
+    assert retry_delay_from_error(RuntimeError("Quota exceeded. Please retry in 12.5s.")) == 12.5
+    assert retry_delay_from_error(RuntimeError("429 ... retry_delay {\n seconds: 31\n}")) == 31
+    info = SimpleNamespace(retry_delay=SimpleNamespace(seconds=4, nanos=500_000_000))
+    error = google_exceptions.TooManyRequests("quota", details=[info])
+    assert retry_delay_from_error(error) == 4.5
+    assert retry_delay_from_error(RuntimeError("boom")) is None
+
+
+def test_is_retryable():
+    assert is_retryable(google_exceptions.TooManyRequests("429"))
+    assert is_retryable(google_exceptions.ServiceUnavailable("503"))
+    assert is_retryable(TimeoutError())
+    assert not is_retryable(google_exceptions.BadRequest("400"))
+    assert not is_retryable(google_exceptions.NotFound("404"))
+
+
+def test_call_waits_as_long_as_the_server_asks():
+    limiter = RecordingLimiter()
+    retries = []
+    fn = failing([google_exceptions.TooManyRequests("Please retry in 7s")])
+    assert limiter.call(fn, on_retry=lambda attempt, delay, e: retries.append((attempt, delay))) == "ok"
+    assert len(fn.calls) == 2
+    assert 7 <= limiter.sleeps[0] <= 8
+    assert retries == [(1, limiter.sleeps[0])]
+    assert (limiter.calls, limiter.retries) == (2, 1)
+
+
+def test_call_gives_up_after_max_retries():
+    limiter = RecordingLimiter(max_retries=3, base_delay=0.5, max_delay=1.0)
+    fn = failing([google_exceptions.ServiceUnavailable("503")] * 10)
+    with pytest.raises(google_exceptions.ServiceUnavailable):
+        limiter.call(fn, on_retry=lambda *args: None)
+    assert len(fn.calls) == 4
+    assert len(limiter.sleeps) == 3
+    assert all(0 <= delay <= 1.0 for delay in limiter.sleeps)
+
+
+def test_call_raises_non_retryable_errors_at_once():
+    limiter = RecordingLimiter()
+    fn = failing([google_exceptions.BadRequest("400")])
+    with pytest.raises(google_exceptions.BadRequest):
+        limiter.call(fn)
+    assert len(fn.calls) == 1 and limiter.sleeps == []
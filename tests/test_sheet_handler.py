@@ -0,0 +1,151 @@
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from fakes import FakeSheetsClient, task_rows
+from sheet_handler import COMPLETED_STATUS, SheetHandler, SheetWriteBuffer, TabCache
+
+
+def sheet_handler(tmp_path, rows):
+    client = FakeSheetsClient()
+    worksheet = client.spreadsheet.add_worksheet_rows("Sheet1", rows)
+    handler = SheetHandler(client=client, tab_cache=TabCache(path=str(tmp_path / "tab_cache.json")))
+    handler.connect("https://docs.google.com/spreadsheets/d/test")
+    return handler, worksheet, client
+
+
+def test_failed_status_write_raises_and_row_stays_pending(tmp_path):
+    handler, worksheet, _client = sheet_handler(tmp_path, task_rows(1, "site"))
+    worksheet.fail_writes = 1
+    with pytest.raises(google_exceptions.TooManyRequests):
+        handler.mark_complete(2)
+    assert worksheet.rows[1][0] == ""
+    handler.mark_complete(2)
+    assert worksheet.rows[1][0] == COMPLETED_STATUS
+
+
+def test_failed_buffered_completion_withdraws_the_status(tmp_path):
+    handler, worksheet, _client = sheet_handler(tmp_path, task_rows(1, "site"))
+    handler.enable_write_buffer(max_delay=60)
+    handler.update_any_cell(2, 12, "<p>content</p>")
+    worksheet.fail_writes = 1
+    with pytest.raises(google_exceptions.TooManyRequests):
+        handler.mark_complete(2)
+    # The content is still queued; the status is not, so a later flush can't mark the row done
+    handler.close_write_buffer()
+    assert worksheet.rows[1][11] == "<p>content</p>"
+    assert worksheet.rows[1][0] == ""
+
+
+def test_any_spreadsheet_modification_invalidates_cached_tabs(tmp_path):
+    handler, _worksheet, client = sheet_handler(tmp_path, task_rows(1, "site"))
+    spreadsheet_id = handler.get_spreadsheet_id()
+    handler.refresh_tab_cache()
+    handler.tab_cache.put(spreadsheet_id, "Default", {"STEP 1": "old prompt"})
+    handler.refresh_tab_cache()
+    assert handler.tab_cache.get(spreadsheet_id, "Default") == {"STEP 1": "old prompt"}
+    # Drive does not say which tab changed: a later write (ours or an editor's) drops the cache
+    client.modified_time = "2000-01-01T00:05:00.000Z"
+    handler.refresh_tab_cache()
+    assert handler.tab_cache.get(spreadsheet_id, "Default") is None
+
+
+class RecordingWorksheet:
+    """Wraps an InMemoryWorksheet and keeps the ranges of every batch_update request."""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.requests = []
+
+    def batch_update(self, data, **kwargs):
+        self.worksheet.batch_update(data, **kwargs)
+        self.requests.append(data)
+
+
+def write_buffer(**kwargs):
+    client = FakeSheetsClient()
+    worksheet = client.spreadsheet.add_worksheet_rows("Sheet1", task_rows(3, "site"))
+    recording = RecordingWorksheet(worksheet)
+    return SheetWriteBuffer(recording, threading.RLock(), **kwargs), recording, worksheet
+
+
+def test_buffer_coalesces_a_row_into_one_range_with_gaps():
+    buffer, recording, worksheet = write_buffer(max_delay=60)
+    worksheet.rows[1][9] = "existing title"
+    buffer.put(2, 8, "https://example.com/?p=1")
+    buffer.put(2, 12, "<p>old</p>")
+    buffer.put(2, 12, "<p>new</p>")
+    buffer.flush()
+    assert recording.requests == [[{"range": "H2:L2", "values": [["https://example.com/?p=1", None, None, None, "<p>new</p>"]]}]]
+    # None cells are skipped: the title between the written columns is untouched
+    assert worksheet.rows[1][7:12] == ["https://example.com/?p=1", "", "existing title", "", "<p>new</p>"]
+    assert (buffer.requests, buffer.cells_written, buffer.cells_superseded) == (1, 2, 1)
+    buffer.close()
+
+
+def test_buffer_flushes_when_full():
+    buffer, recording, _worksheet = write_buffer(max_cells=3, max_delay=60)
+    buffer.put(2, 1, "開始")
+    buffer.put(3, 1, "開始")
+    assert recording.requests == []
+    buffer.put(4, 1, "開始")
+    assert len(recording.requests) == 1
+    buffer.close()
+
+
+def test_buffer_flushes_after_max_delay():
+    flushed = []
+    buffer, recording, worksheet = write_buffer(max_delay=0.1, on_flush=flushed.append)
+    buffer.put(2, 1, "開始")
+    deadline = time.monotonic() + 3
+    while not flushed and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert flushed == [1]
+    assert worksheet.rows[1][0] == "開始"
+    buffer.close()
+
+
+def test_complete_row_sends_the_status_with_the_row_content():
+    buffer, recording, worksheet = write_buffer(max_delay=60)
+    buffer.put(2, 1, "STEP 3")
+    buffer.put(2, 12, "<p>content</p>")
+    buffer.complete_row(2)
+    # One request: the status can't become 完了 before the content is written
+    assert recording.requests == [[{"range": "A2:L2", "values": [[COMPLETED_STATUS] + [None] * 10 + ["<p>content</p>"]]}]]
+    assert list(buffer._pending) == []
+    buffer.close()
+
+
+def test_failed_flush_raises_and_keeps_cells_queued():
+    buffer, recording, worksheet = write_buffer(max_delay=60)
+    buffer.put(2, 12, "<p>content</p>")
+    worksheet.fail_writes = 1
+    with pytest.raises(google_exceptions.TooManyRequests):
+        buffer.flush()
+    buffer.put(3, 12, "<p>other</p>")
+    buffer.close()
+    assert worksheet.rows[1][11] == "<p>content</p>"
+    assert worksheet.rows[2][11] == "<p>other</p>"
+
+
+
+def test_iter_pending_tasks_pages_and_reads(tmp_path):
+    rows = task_rows(5, "site")
+    rows[2][0] = COMPLETED_STATUS             # row 3: done
+    rows[3] = [""] * len(rows[0])             # row 4: blank gap inside the table
+    rows[5][0] = "中断: STEP 5 (再実行で再開)"  # row 6: interrupted, resumes
+    handler, _worksheet, client = sheet_handler(tmp_path, rows)
+    reads = client.counter.counts.get("read", 0)
+    pages = []
+    tasks = list(handler.iter_pending_tasks(page_size=2, on_page=lambda page: pages.append([t["row_index"] for t in page])))
+    assert [t["row_index"] for t in tasks] == [2, 4, 5, 6]
+    assert pages == [[2, 4], [5, 6]]
+    assert tasks[0]["MainKW"] == "ベンチ キーワード 0" and tasks[0]["Slug"] == "bench-0"
+    # The gap row comes back without a MainKW (process_batch skips it)
+    assert tasks[1]["MainKW"] == ""
+    assert "Content" not in tasks[0]
+    # Header + Status/MainKW columns + one request per page
+    assert client.counter.counts["read"] - reads == 4
+    assert [t["row_index"] for t in handler.iter_pending_tasks(include_completed=True)] == [2, 3, 4, 5, 6]
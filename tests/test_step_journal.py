@@ -0,0 +1,39 @@
+import time
+
+from step_journal import StepJournal, StepOutputCache
+
+
+def output_cache(tmp_path):
+    return StepOutputCache(StepJournal(str(tmp_path / "journal.sqlite3")))
+
+
+def test_step_keys_chain_on_content(tmp_path):
+    cache = output_cache(tmp_path)
+    base = cache.base_key("gemini", "rules")
+    step1 = cache.step_key(base, "", "STEP 1", "exec 1", "check 1")
+    assert step1 == cache.step_key(base, "", "STEP 1", "exec 1", "check 1")
+    # A different prompt, upstream output or system instruction gives a different key
+    assert step1 != cache.step_key(base, "", "STEP 1", "exec 1 edited", "check 1")
+    assert cache.step_key(step1, "output A", "STEP 2", "exec 2") != cache.step_key(step1, "output B", "STEP 2", "exec 2")
+    assert base != cache.base_key("gemini", "other rules")
+    # Length-prefixed parts: moving text between prompts changes the key
+    assert cache.step_key(base, "", "STEP 1", "ab", "c") != cache.step_key(base, "", "STEP 1", "a", "bc")
+
+
+def test_hits_and_misses(tmp_path):
+    cache = output_cache(tmp_path)
+    turns = [("draft", "prompt", "draft text"), ("refine", "check", "final text")]
+    assert cache.get("key") is None
+    cache.put("key", turns)
+    assert cache.get("key") == turns
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_prune_drops_outputs_older_than_max_age(tmp_path):
+    cache = output_cache(tmp_path)
+    cache.put("old", [("draft", "p", "r")])
+    cache.put("new", [("draft", "p", "r")])
+    cache.journal._execute("UPDATE step_outputs SET created_at = ? WHERE key = 'old'", (time.time() - 31 * 86400,))
+    cache.prune()
+    assert cache.get("old") is None
+    assert cache.get("new") is not None
@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+import wp_handler
+from fakes import WPStubServer
+from wp_handler import BATCH_LIMIT, PostLookupError, WPHandler
+
+
+@pytest.fixture(autouse=True)
+def reset_batch_support():
+    wp_handler._batch_support.clear()
+    yield
+    wp_handler._batch_support.clear()
+
+
+def drafts(*slugs):
+    return [{"title": f"Title {slug}", "content": f"<p>{slug}</p>", "slug": slug} for slug in slugs]
+
+
+def posted(wp, path_suffix):
+    return [path for method, path in wp.requests if method == "POST" and path.endswith(path_suffix)]
+
+
+def test_post_draft_creates_then_updates_draft():
+    with WPStubServer() as wp:
+        handler = WPHandler(wp.site_config())
+        link = handler.post_draft("Title", "<p>body</p>", "single")
+        assert link == f"{wp.url}/?p=1"
+        # Rerun with the same slug updates the draft instead of creating single-2
+        assert WPHandler(wp.site_config()).post_draft("Title 2", "<p>body</p>", "single") == link
+        assert [(p["slug"], p["title"], p["status"]) for p in wp.posts_snapshot()] == [("single", "Title 2", "draft")]
+
+
+def test_post_draft_leaves_published_post_alone():
+    with WPStubServer() as wp:
+        wp.save_post({"title": "Live", "slug": "live", "status": "publish"}, "/wp/v2/posts")
+        link = WPHandler(wp.site_config()).post_draft("New", "<p>body</p>", "live")
+        assert link == f"{wp.url}/?p=1"
+        assert wp.posts_snapshot()[0]["title"] == "Live"
+        assert posted(wp, "/wp/v2/posts/1") == []
+
+
+def test_batch_with_failing_sub_request_keeps_positions():
+    with WPStubServer(fail_slugs={"b"}) as wp:
+        links = WPHandler(wp.site_config()).post_drafts(drafts("a", "b", "c"))
+        assert links[0] and links[2]
+        assert links[1] is None
+        assert sorted(p["slug"] for p in wp.posts_snapshot()) == ["a", "c"]
+        assert len(posted(wp, "/batch/v1")) == 1
+        assert posted(wp, "/wp/v2/posts") == []
+
+
+@pytest.mark.parametrize("status", [404, 405])
+def test_missing_batch_endpoint_falls_back_to_single_posts(status):
+    with WPStubServer(batch_status=status) as wp:
+        handler = WPHandler(wp.site_config())
+        links = handler.post_drafts(drafts("a", "b"))
+        assert all(links)
+        assert len(posted(wp, "/wp/v2/posts")) == 2
+        assert not wp_handler.has_batch_support(handler.url)
+        # Later calls skip the batch endpoint entirely
+        handler.post_drafts(drafts("c"))
+        assert len(posted(wp, "/batch/v1")) == 1
+
+
+def test_post_drafts_chunks_at_batch_limit():
+    slugs = [f"post-{i}" for i in range(BATCH_LIMIT + 1)]
+    with WPStubServer() as wp:
+        links = WPHandler(wp.site_config()).post_drafts(drafts(*slugs))
+        assert len(links) == len(slugs) and all(links)
+        assert len(posted(wp, "/batch/v1")) == 2
+        assert len(wp.posts_snapshot()) == len(slugs)
+
+
+def test_failed_lookup_posts_nothing():
+    with WPStubServer(fail_lookups=1) as wp:
+        handler = WPHandler(wp.site_config())
+        with pytest.raises(PostLookupError):
+            handler.post_draft("Title", "<p>body</p>", "flaky")
+        assert posted(wp, "/wp/v2/posts") == []
+        # The next attempt looks the slug up again
+        assert handler.post_draft("Title", "<p>body</p>", "flaky")
+
+
+def test_failed_lookup_in_bulk_marks_only_those_drafts():
+    with WPStubServer(fail_lookups=1) as wp:
+        links = WPHandler(wp.site_config()).post_drafts(drafts("a", "b"))
+        # The shared lookup failed for "a"; "b" was looked up again on its own and posted
+        assert isinstance(links[0], PostLookupError)
+        assert links[1] == f"{wp.url}/?p=1"
+        assert [p["slug"] for p in wp.posts_snapshot()] == ["b"]
+
+
+def test_concurrent_lookups_of_a_slug_share_one_request():
+    with WPStubServer(latency=0.2) as wp:
+        handler = WPHandler(wp.site_config())
+        threads = [threading.Thread(target=handler.find_post, args=("same",)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert [path for method, path in wp.requests if method == "GET"] == ["/wp-json/wp/v2/posts"]
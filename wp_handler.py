@@ -1,53 +1,291 @@
-import requests
-import base64
-from typing import Dict, Any
-
-class WPHandler:
-    def __init__(self, site_config: Dict[str, str]):
-        self.url = site_config['url'].rstrip('/')
-        self.user = site_config['user']
-        self.password = site_config['app_password']
-        self.api_url = f"{self.url}/wp-json/wp/v2"
-
-    def _get_headers(self):
-        credentials = f"{self.user}:{self.password}"
-        token = base64.b64encode(credentials.encode()).decode()
-        return {
-            "Authorization": f"Basic {token}",
-            "Content-Type": "application/json"
-        }
-
-    def post_draft(self, title: str, content: str, slug: str, image_prompts: str = "") -> str:
-        """
-        Creates a draft post in WordPress. 
-        Returns the edit URL (or public URL if published, but we aim for draft).
-        """
-        # Append image prompts to the bottom of the content for reference, or keep separate?
-        # User asked for URL in Col H, Image Prompts in Col I.
-        # So we just post the content to WP.
-        
-        post_data = {
-            "title": title,
-            "content": content,
-            "status": "draft",
-            "slug": slug
-        }
-
-        try:
-            response = requests.post(
-                f"{self.api_url}/posts",
-                headers=self._get_headers(),
-                json=post_data
-            )
-            response.raise_for_status()
-            result = response.json()
-            # Return the draft link or edit link
-            # 'link' is the view link. 'id' can be constructed to edit link.
-            # Usually users want the Preview Link or Edit Link.
-            # Let's return the standard link for now.
-            return result.get('link')
-        except Exception as e:
-            print(f"Error posting to WP: {e}")
-            if hasattr(e, 'response') and e.response is not None:
-                print(f"Response: {e.response.text}")
-            return None
+import requests
+import threading
+from urllib.parse import unquote
+from requests.adapters import HTTPAdapter
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from metrics import instrument_session
+
+# (connect, read) seconds; a hung WordPress must not stall the pipeline forever
+DEFAULT_TIMEOUT = (10, 120)
+
+# WordPress rejects /batch/v1 requests with more than 25 sub-requests
+BATCH_LIMIT = 25
+
+# Slugs per existing-post lookup (?slug=a,b,c); also the REST per_page maximum
+SLUG_LOOKUP_PAGE = 100
+
+# Existing posts in these statuses are updated in place; published, scheduled and private posts are never touched
+UPDATABLE_STATUSES = ("draft", "pending")
+
+_sessions: Dict[Tuple[str, str], requests.Session] = {}
+_batch_support: Dict[str, bool] = {}  # site URL -> /batch/v1 available (written by parallel publishers)
+_sessions_lock = threading.Lock()     # guards _sessions and _batch_support
+
+
+class PostLookupError(RuntimeError):
+    """Existing posts with a slug could not be looked up; posting now could create a duplicate."""
+
+
+def get_session(url: str, user: str, password: str, pool_size: int = 8) -> requests.Session:
+    """Shared keep-alive session per site and user (auth is set once, connections are reused)."""
+    with _sessions_lock:
+        session = _sessions.get((url, user))
+        if session is None:
+            session = requests.Session()
+            session.auth = (user, password)
+            session.headers.update({"Content-Type": "application/json"})
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            instrument_session(session, "wp")
+            _sessions[(url, user)] = session
+        return session
+
+def has_batch_support(url: str) -> bool:
+    """False once a site answered /batch/v1 with 404/405/501 (unknown sites are assumed to support it)."""
+    with _sessions_lock:
+        return _batch_support.get(url, True)
+
+def _set_batch_support(url: str, supported: bool):
+    with _sessions_lock:
+        _batch_support[url] = supported
+
+class WPHandler:
+    def __init__(self, site_config: Dict[str, str], session: Optional[requests.Session] = None, timeout=DEFAULT_TIMEOUT):
+        self.url = site_config['url'].rstrip('/')
+        self.user = site_config['user']
+        self.password = site_config['app_password']
+        self.api_url = f"{self.url}/wp-json/wp/v2"
+        self.batch_url = f"{self.url}/wp-json/batch/v1"
+        self.timeout = timeout
+        self.session = session or get_session(self.url, self.user, self.password)
+        # Existing posts by normalized slug, filled in bulk by _prefetch_posts (one handler per run)
+        self._posts_by_slug: Dict[str, Dict[str, Any]] = {}
+        self._looked_up = set()
+        self._expected = set()
+        self._fetching: Dict[str, threading.Event] = {}  # slug -> set when its lookup request ends
+        self._index_lock = threading.Lock()
+
+    @staticmethod
+    def normalize_slug(slug: str) -> str:
+        """WordPress stores non-ASCII slugs percent-encoded (lowercase hex); compare them decoded."""
+        return unquote(slug or "").strip().lower()
+
+    def expect_slugs(self, slugs: Iterable[str]):
+        """Registers slugs that will be posted this run; the next lookup fetches them all at once."""
+        with self._index_lock:
+            for slug in slugs:
+                key = self.normalize_slug(slug)
+                if key and key not in self._looked_up:
+                    self._expected.add(key)
+
+    def find_post(self, slug: str) -> Optional[Dict[str, Any]]:
+        """
+        Existing post (any status but trash) with this slug: {"id", "link", "status"} or None.
+        Raises PostLookupError if the lookup failed (unknown is not the same as "no post").
+        """
+        key = self.normalize_slug(slug)
+        if not key:
+            return None
+        with self._index_lock:
+            if key in self._looked_up:
+                return self._posts_by_slug.get(key)
+            pending = self._fetching.get(key)
+            if pending is None:
+                self._expected.add(key)
+        if pending is not None:
+            # Another publisher is already looking this slug up
+            pending.wait()
+        else:
+            self._prefetch_posts()
+        with self._index_lock:
+            if key in self._looked_up:
+                return self._posts_by_slug.get(key)
+        raise PostLookupError(f"Could not look up existing WP posts with slug '{slug}' on {self.url}; not posted to avoid a duplicate.")
+
+    def _prefetch_posts(self):
+        """
+        Looks up every expected slug with ?slug=a,b,c&status=any, SLUG_LOOKUP_PAGE slugs per request.
+        The requests run outside _index_lock; lookups of the same slugs wait for them.
+        """
+        with self._index_lock:
+            slugs = sorted(self._expected - self._looked_up - set(self._fetching))
+            self._expected.clear()
+            done = threading.Event()
+            for slug in slugs:
+                self._fetching[slug] = done
+        try:
+            self._fetch_posts(slugs)
+        finally:
+            with self._index_lock:
+                for slug in slugs:
+                    self._fetching.pop(slug, None)
+            done.set()
+
+    def _fetch_posts(self, slugs: List[str]):
+        for start in range(0, len(slugs), SLUG_LOOKUP_PAGE):
+            chunk = slugs[start:start + SLUG_LOOKUP_PAGE]
+            try:
+                response = self.session.get(
+                    f"{self.api_url}/posts",
+                    params={
+                        "slug": ",".join(chunk),
+                        "status": "any",
+                        "per_page": SLUG_LOOKUP_PAGE,
+                        "context": "edit",
+                        "_fields": "id,slug,link,status",
+                    },
+                    timeout=self.timeout
+                )
+                response.raise_for_status()
+            except Exception as e:
+                # Unknown state: these slugs are looked up again on their next post
+                print(f"Error looking up existing WP posts: {e}")
+                continue
+            with self._index_lock:
+                for post in response.json():
+                    self._remember(post)
+                self._looked_up.update(chunk)
+
+    def _remember(self, post: Dict[str, Any]):
+        key = self.normalize_slug(post.get("slug", ""))
+        if key and post.get("id"):
+            self._posts_by_slug[key] = {"id": post["id"], "link": post.get("link"), "status": post.get("status")}
+            self._looked_up.add(key)
+
+    @staticmethod
+    def is_updatable(post: Dict[str, Any]) -> bool:
+        return post.get("status") in UPDATABLE_STATUSES
+
+    def _skip_existing(self, slug: str, existing: Dict[str, Any]) -> Optional[str]:
+        """Link of an existing post that must not be overwritten (logged); the caller posts nothing."""
+        print(f"WP post '{slug}' on {self.url} is {existing.get('status') or 'in an unknown status'}; left unchanged (only drafts are updated).")
+        return existing.get("link")
+
+    def post_draft(self, title: str, content: str, slug: str, image_prompts: str = "") -> str:
+        """
+        Creates a draft post in WordPress, or updates the existing draft / pending post with the
+        same slug (reruns must not leave slug-2, slug-3 duplicates). The post status is kept on
+        update. A published, scheduled or private post with the slug is left alone and its link
+        is returned.
+        Returns the edit URL (or public URL if published, but we aim for draft).
+        Raises PostLookupError (nothing posted) if existing posts could not be looked up.
+        """
+        # Append image prompts to the bottom of the content for reference, or keep separate?
+        # User asked for URL in Col H, Image Prompts in Col I.
+        # So we just post the content to WP.
+
+        existing = self.find_post(slug)
+        if existing and not self.is_updatable(existing):
+            return self._skip_existing(slug, existing)
+        post_data = self._draft_body(title, content, slug, existing)
+
+        try:
+            response = self.session.post(
+                f"{self.api_url}/posts/{existing['id']}" if existing else f"{self.api_url}/posts",
+                json=post_data,
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            result = response.json()
+            with self._index_lock:
+                self._remember(result)
+            # Return the draft link or edit link
+            # 'link' is the view link. 'id' can be constructed to edit link.
+            # Usually users want the Preview Link or Edit Link.
+            # Let's return the standard link for now.
+            return result.get('link')
+        except Exception as e:
+            print(f"Error posting to WP: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                print(f"Response: {e.response.text}")
+            return None
+
+    def post_drafts(self, drafts: List[Dict[str, str]]) -> List[Optional[str]]:
+        """
+        Bulk variant of post_draft. drafts: [{"title", "content", "slug"}, ...].
+        Sends up to BATCH_LIMIT drafts per /batch/v1 request when the site supports it
+        (WordPress 5.6+), otherwise posts them one by one.
+        Returns the links in the order of drafts: None for a draft that failed, a PostLookupError
+        for a draft that was not posted because existing posts could not be looked up.
+        """
+        self.expect_slugs(d.get("slug", "") for d in drafts)
+        links: List[Any] = []
+        for start in range(0, len(drafts), BATCH_LIMIT):
+            chunk = drafts[start:start + BATCH_LIMIT]
+            chunk_links = self._post_batch(chunk) if has_batch_support(self.url) else None
+            if chunk_links is None:
+                chunk_links = [self._post_single(d) for d in chunk]
+            links.extend(chunk_links)
+        return links
+
+    def _post_single(self, draft: Dict[str, str]):
+        try:
+            return self.post_draft(draft.get("title", ""), draft.get("content", ""), draft.get("slug", ""))
+        except PostLookupError as e:
+            print(e)
+            return e
+
+    def _post_batch(self, drafts: List[Dict[str, str]]) -> Optional[List[Any]]:
+        """One /batch/v1 request; None if the site has no batch endpoint (caller falls back)."""
+        links: List[Any] = [None] * len(drafts)
+        positions = []  # index in drafts of each sub-request
+        sub_requests = []
+        for i, d in enumerate(drafts):
+            try:
+                existing = self.find_post(d.get("slug", ""))
+            except PostLookupError as e:
+                print(e)
+                links[i] = e
+                continue
+            if existing and not self.is_updatable(existing):
+                links[i] = self._skip_existing(d.get("slug", ""), existing)
+                continue
+            positions.append(i)
+            sub_requests.append({
+                "method": "POST",
+                "path": f"/wp/v2/posts/{existing['id']}" if existing else "/wp/v2/posts",
+                "body": self._draft_body(d.get("title", ""), d.get("content", ""), d.get("slug", ""), existing),
+            })
+        if not sub_requests:
+            return links
+        payload = {"validation": "normal", "requests": sub_requests}
+        try:
+            response = self.session.post(self.batch_url, json=payload, timeout=self.timeout)
+            if response.status_code in (404, 405, 501):
+                print(f"WP batch endpoint not available on {self.url} ({response.status_code}); posting drafts one by one.")
+                _set_batch_support(self.url, False)
+                return None
+            response.raise_for_status()
+            _set_batch_support(self.url, True)
+            results = response.json().get("responses", [])
+        except Exception as e:
+            # The batch may have been applied server-side; re-posting singly could duplicate drafts
+            print(f"Error posting WP batch: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                print(f"Response: {e.response.text}")
+            return links
+
+        # Validation failures can come back without per-item responses (those drafts stay None)
+        for i, item in zip(positions, results):
+            body = item.get("body") or {}
+            if 200 <= item.get("status", 500) < 300:
+                links[i] = body.get("link")
+                with self._index_lock:
+                    self._remember(body)
+            else:
+                print(f"Error posting to WP (slug {drafts[i].get('slug')}): {body.get('message', body)}")
+        return links
+
+    @staticmethod
+    def _draft_body(title: str, content: str, slug: str, existing: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        body = {
+            "title": title,
+            "content": content,
+            "status": "draft",
+            "slug": slug
+        }
+        if existing:
+            # Update in place: the post keeps its status (draft or pending review)
+            del body["status"]
+        return body